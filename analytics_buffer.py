@@ -0,0 +1,302 @@
+import os
+import time
+import queue
+import random
+import atexit
+import threading
+from collections import defaultdict
+from sqlalchemy import select
+from app import app, db
+from models import Book, BookAnalytics, DailyBookStats, DailyUniqueViewers, DailySiteViewers
+from hyperloglog import HyperLogLog
+from dimensions import click_event_rows, insert_click_events
+
+# Counter column updated for each event type
+COUNTER_COLUMNS = {
+    'view': 'view_count',
+    'download': 'download_count',
+    'share': 'share_count',
+}
+
+# Events kept longest when the queue backs up; anything else posted to /api/track goes first
+EVENT_PRIORITY = {
+    'download': 2,
+    'share': 1,
+    'view': 0,
+}
+
+def visitor_key(event):
+    """Identify a visitor by IP address and user agent"""
+    return f"{event['ip_address']}|{event['user_agent']}"
+
+class AnalyticsBuffer:
+    """
+    Queue analytics events in memory and write them to the database in batches
+    from a background thread, so requests never wait on an analytics commit.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.flush_size = app.config.get('ANALYTICS_FLUSH_SIZE', 500)
+        self.flush_interval = app.config.get('ANALYTICS_FLUSH_INTERVAL', 2.0)
+        self.sync = app.config.get('ANALYTICS_SYNC', False)
+        self.shed_threshold = app.config.get('ANALYTICS_SHED_THRESHOLD', 0.5)
+        self._queue = queue.Queue(maxsize=app.config.get('ANALYTICS_QUEUE_SIZE', 50000))
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stats = {
+            'events_enqueued': 0,
+            'events_flushed': 0,
+            'events_dropped': 0,
+            'events_shed': 0,
+            'flushes': 0,
+            'flush_failures': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+        atexit.register(self.stop)
+
+    def record(self, event):
+        """
+        Queue a single event dict with book_id, event_type, user_agent,
+        ip_address, referrer and timestamp keys
+        """
+        if self.sync:
+            self._queue.put(event)
+            self._stats['events_enqueued'] += 1
+            self.flush()
+            return True
+
+        self._ensure_started()
+        if self._should_shed(event):
+            self._stats['events_shed'] += 1
+            return True
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._stats['events_dropped'] += 1
+            app.logger.warning("Analytics queue full, dropping event")
+            return False
+
+        self._stats['events_enqueued'] += 1
+        if self._queue.qsize() >= self.flush_size:
+            self._wakeup.set()
+        return True
+
+    def record_many(self, events):
+        """
+        Queue events to be written together in one flush transaction.
+        Returns an outcome per event: 'queued', 'shed' or 'dropped'.
+        """
+        if not self.sync:
+            self._ensure_started()
+        outcomes = []
+        batch = []
+        for event in events:
+            if not self.sync and self._should_shed(event):
+                self._stats['events_shed'] += 1
+                outcomes.append('shed')
+            else:
+                batch.append(event)
+                outcomes.append('queued')
+        if not batch:
+            return outcomes
+
+        # The batch takes one queue slot, so _drain keeps it in a single flush
+        if self.sync:
+            self._queue.put(batch)
+        else:
+            try:
+                self._queue.put_nowait(batch)
+            except queue.Full:
+                self._stats['events_dropped'] += len(batch)
+                app.logger.warning(f"Analytics queue full, dropping {len(batch)} events")
+                return ['dropped' if outcome == 'queued' else outcome for outcome in outcomes]
+
+        self._stats['events_enqueued'] += len(batch)
+        if self.sync:
+            self.flush()
+        elif self._queue.qsize() >= self.flush_size:
+            self._wakeup.set()
+        return outcomes
+
+    def _should_shed(self, event):
+        """
+        Shed low-priority events while the flusher is falling behind, so the
+        queue keeps room for downloads and shares. Unknown event types are
+        dropped first, then views are sampled at a falling rate as the
+        queue fills.
+        """
+        fill = self._queue.qsize() / self._queue.maxsize if self._queue.maxsize else 0
+        if fill < self.shed_threshold:
+            return False
+        priority = EVENT_PRIORITY.get(event['event_type'], -1)
+        if priority < 0:
+            return True
+        if priority == 0:
+            # Keep every view at the threshold and none with the queue 90% full
+            keep = max(0.0, (0.9 - fill) / max(0.9 - self.shed_threshold, 0.01))
+            return random.random() >= keep
+        return False
+
+    def _ensure_started(self):
+        # Gunicorn forks workers after import, so each process needs its own thread
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._flush_lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='analytics-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                while self.flush() >= self.flush_size:
+                    pass
+            except Exception as e:
+                app.logger.error(f"Analytics flusher error: {e}")
+
+    def _drain(self):
+        events = []
+        while len(events) < self.flush_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            # Batches from record_many are queued as lists
+            if isinstance(item, list):
+                events.extend(item)
+            else:
+                events.append(item)
+        return events
+
+    def flush(self):
+        """
+        Write up to flush_size queued events in one transaction.
+        Returns the number of events written.
+        """
+        with self._flush_lock:
+            events = self._drain()
+            if not events:
+                return 0
+
+            started = time.perf_counter()
+            with self.app.app_context():
+                try:
+                    written = self._write_batch(events)
+                except Exception as e:
+                    db.session.rollback()
+                    self._stats['flush_failures'] += 1
+                    self._stats['events_dropped'] += len(events)
+                    app.logger.error(f"Error flushing {len(events)} analytics events: {e}")
+                    return 0
+                finally:
+                    db.session.remove()
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._stats['flushes'] += 1
+            self._stats['events_flushed'] += written
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['total_flush_ms'] += elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            return len(events)
+
+    def _write_batch(self, events):
+        """
+        Write events in one transaction, skipping books deleted since they
+        were queued. If that fails, retry book by book in savepoints so one
+        bad book can't lose everyone else's events. Returns the number written.
+        """
+        book_ids = {event['book_id'] for event in events}
+        existing = set(db.session.execute(select(Book.id).where(Book.id.in_(book_ids))).scalars())
+        if len(existing) < len(book_ids):
+            kept = [event for event in events if event['book_id'] in existing]
+            self._stats['events_dropped'] += len(events) - len(kept)
+            events = kept
+        if not events:
+            db.session.commit()
+            return 0
+
+        # Interned before anything is written; see dimensions.resolve_ids
+        rows = click_event_rows(events)
+        try:
+            self._write(events, rows)
+            db.session.commit()
+            return len(events)
+        except Exception as e:
+            db.session.rollback()
+            self._stats['flush_failures'] += 1
+            app.logger.warning(f"Error flushing {len(events)} analytics events, retrying per book: {e}")
+
+        by_book = defaultdict(list)
+        for event, row in zip(events, rows):
+            by_book[event['book_id']].append((event, row))
+        written = 0
+        for book_id, pairs in by_book.items():
+            try:
+                with db.session.begin_nested():
+                    self._write([event for event, _ in pairs], [row for _, row in pairs])
+                written += len(pairs)
+            except Exception as e:
+                self._stats['events_dropped'] += len(pairs)
+                app.logger.error(f"Error flushing {len(pairs)} analytics events for book {book_id}: {e}")
+        db.session.commit()
+        return written
+
+    def _write(self, events, rows):
+        # Sum counter deltas so each book gets a single UPDATE per flush
+        deltas = defaultdict(lambda: defaultdict(int))
+        daily = defaultdict(int)
+        viewers = defaultdict(HyperLogLog)
+        for event in events:
+            column = COUNTER_COLUMNS.get(event['event_type'])
+            if column:
+                deltas[event['book_id']][column] += 1
+            daily[(event['book_id'], event['timestamp'].date(), event['event_type'])] += 1
+            if event['event_type'] == 'view':
+                viewers[(event['book_id'], event['timestamp'].date())].add(visitor_key(event))
+
+        # In book order, so concurrent flushes from other workers lock rows in the same order and can't deadlock
+        for book_id, columns in sorted(deltas.items()):
+            BookAnalytics.increment(book_id, **columns)
+
+        # Keep the daily rollup in step with the raw events
+        DailyBookStats.increment_many(daily)
+        DailyUniqueViewers.merge_many(viewers)
+        site_viewers = {}
+        for (_, date), sketch in viewers.items():
+            site_viewers.setdefault(date, HyperLogLog()).merge(sketch)
+        DailySiteViewers.merge_many(site_viewers)
+
+        # Bulk insert the raw click events last: other workers' inserts wait from here until this commits
+        insert_click_events(rows)
+
+    def stop(self):
+        """Stop the flusher thread and write everything still queued"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 5)
+        try:
+            while self.flush():
+                pass
+        except Exception as e:
+            app.logger.error(f"Error flushing analytics on shutdown: {e}")
+
+    def stats(self):
+        """Return queue depth and flush counters"""
+        stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+analytics_buffer = AnalyticsBuffer(app)
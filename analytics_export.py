@@ -0,0 +1,194 @@
+import io
+import csv
+import sys
+import json
+import gzip
+import zlib
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import select, or_
+from app import app, db
+from models import ClickEvent, BookAnalytics, HighWaterMark, EventType
+from dimensions import select_click_events, committed_click_event_id
+
+# Bytes of text collected before a chunk is sent
+CHUNK_SIZE = 64 * 1024
+
+DATASETS = {
+    'click_events': ['id', 'book_id', 'event_type', 'user_agent', 'ip_address', 'referrer', 'timestamp'],
+    'book_analytics': ['id', 'book_id', 'view_count', 'download_count', 'share_count', 'created_at', 'updated_at'],
+}
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+class Export:
+    """
+    One export of a dataset, filtered by date range, book and event type.
+
+    Incremental exports continue from a high-water mark: click events are
+    append-only and follow their id, analytics counters change in place
+    and follow updated_at. The mark is either passed in (since) or stored
+    per consumer and advanced by finish() once every row has been sent.
+    Click events stop at the committed-id watermark, which no late commit
+    can fall below; analytics rows newer than EXPORT_SETTLE_SECONDS are
+    left for the next export, so writes still being committed aren't skipped.
+    """
+
+    def __init__(self, dataset, start=None, end=None, book_id=None, event_type=None, since=None, consumer=None):
+        if dataset not in DATASETS:
+            raise ValueError(f"Unknown dataset {dataset!r}")
+        if event_type and dataset != 'click_events':
+            raise ValueError("event_type only applies to click_events")
+        self.dataset = dataset
+        self.columns = DATASETS[dataset]
+        self.start, self.end = start, end
+        self.book_id, self.event_type = book_id, event_type
+        self.cutoff = datetime.utcnow() - timedelta(seconds=app.config['EXPORT_SETTLE_SECONDS'])
+
+        # Streamed responses run in a new session, so the mark is looked up again by name in finish()
+        self.mark_name = f"export:{dataset}:{consumer}" if consumer else None
+        if self.mark_name and since is None:
+            mark = db.session.get(HighWaterMark, self.mark_name)
+            if mark is not None:
+                since = mark.last_timestamp if dataset == 'book_analytics' else mark.last_id
+        self.since = since
+        self.next_since = self._upper_bound()
+        self.count = 0
+
+    def _upper_bound(self):
+        """Where this export stops, and so where the next one starts"""
+        if self.dataset == 'book_analytics':
+            return self.cutoff
+        return max(committed_click_event_id(), self.since or 0)
+
+    def query(self):
+        if self.dataset == 'click_events':
+            model, time_column = ClickEvent, ClickEvent.timestamp
+            query = select_click_events().where(
+                ClickEvent.id > (self.since or 0), ClickEvent.id <= self.next_since
+            ).order_by(ClickEvent.id)
+            if self.event_type:
+                query = query.where(EventType.name == self.event_type)
+        else:
+            model, time_column = BookAnalytics, BookAnalytics.updated_at
+            query = select(*[getattr(BookAnalytics, column) for column in self.columns]).order_by(
+                time_column, BookAnalytics.id
+            )
+            if self.since is not None:
+                query = query.where(time_column > self.since, time_column <= self.next_since)
+            else:
+                # A full export also includes rows written before updated_at was kept
+                query = query.where(or_(time_column <= self.next_since, time_column.is_(None)))
+        if self.start:
+            query = query.where(time_column >= self.start)
+        if self.end:
+            query = query.where(time_column < self.end)
+        if self.book_id:
+            query = query.where(model.book_id == self.book_id)
+        return query
+
+    def rows(self):
+        """Yield result rows through a server-side cursor, a batch at a time"""
+        result = db.session.execute(
+            self.query().execution_options(stream_results=True, yield_per=app.config['EXPORT_BATCH_SIZE'])
+        )
+        for row in result:
+            self.count += 1
+            yield row
+
+    def finish(self):
+        """Store the consumer's new high-water mark after every row was sent"""
+        if self.mark_name is None:
+            return
+        mark = HighWaterMark.get(self.mark_name)
+        if self.dataset == 'book_analytics':
+            mark.last_timestamp = self.next_since
+        else:
+            mark.last_id = self.next_since
+        mark.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def next_since_param(self):
+        return self.next_since.isoformat() if isinstance(self.next_since, datetime) else str(self.next_since)
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def encode(export, file_format):
+    """
+    Yield an export as CSV or NDJSON text in chunks of about CHUNK_SIZE.
+    The export's mark is only advanced after the last row.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if file_format == 'csv' else None
+    if writer:
+        writer.writerow(export.columns)
+    for row in export.rows():
+        values = [_value(value) for value in row]
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(export.columns, values))) + '\n')
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+    export.finish()
+
+def gzip_chunks(chunks):
+    """Compress text chunks into one gzip stream as they're produced"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def parse_since(dataset, value):
+    """Read a since parameter: an id for click events, an ISO timestamp for analytics"""
+    if value is None or value == '':
+        return None
+    return datetime.fromisoformat(value) if dataset == 'book_analytics' else int(value)
+
+def export_to_file(path, dataset, file_format=None, **filters):
+    """Write an export to a file, gzipped if the name ends in .gz (- for stdout). Returns the export."""
+    name = path[:-3] if path.endswith('.gz') else path
+    file_format = file_format or ('csv' if name.endswith('.csv') else 'ndjson')
+    export = Export(dataset, **filters)
+    if path == '-':
+        f = sys.stdout
+    elif path.endswith('.gz'):
+        f = gzip.open(path, 'wt', encoding='utf-8', newline='')
+    else:
+        f = open(path, 'w', encoding='utf-8', newline='')
+    try:
+        for chunk in encode(export, file_format):
+            f.write(chunk)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return export
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export analytics as CSV or NDJSON")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("path", help="output file, .gz to compress, - for stdout")
+    parser.add_argument("--format", choices=sorted(FORMATS), help="default: from the file extension")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="first date or time to include")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="date or time to stop before")
+    parser.add_argument("--book-id", type=int)
+    parser.add_argument("--event-type", help="click_events only")
+    parser.add_argument("--since", help="continue after this id (click_events) or updated_at (book_analytics)")
+    parser.add_argument("--consumer", help="name of a stored high-water mark to continue from and advance")
+    args = parser.parse_args()
+
+    with app.app_context():
+        export = export_to_file(
+            args.path, args.dataset, args.format,
+            start=args.start, end=args.end, book_id=args.book_id, event_type=args.event_type,
+            since=parse_since(args.dataset, args.since), consumer=args.consumer,
+        )
+        print(f"Exported {export.count} {args.dataset} rows; continue with --since {export.next_since_param()}",
+              file=sys.stderr)
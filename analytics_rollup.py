@@ -0,0 +1,113 @@
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert
+from app import app, db
+from models import ClickEvent, DailyBookStats, DailyUniqueViewers, DailySiteViewers, EventType, UserAgent
+from hyperloglog import HyperLogLog
+from analytics_buffer import visitor_key
+from event_filter import is_bot
+
+def backfill(start=None, end=None, chunk_days=7):
+    """
+    Rebuild DailyBookStats and the DailyUniqueViewers and DailySiteViewers
+    sketches from ClickEvent history, one chunk of days per transaction.
+    Each chunk is deleted and recomputed, so running the backfill again over
+    the same range is safe. Returns the number of days processed.
+    """
+    if start is None:
+        first = db.session.query(func.min(ClickEvent.timestamp)).scalar()
+        if first is None:
+            return 0
+        start = first.date()
+    if end is None:
+        # Today is still being written by the analytics flusher
+        end = datetime.utcnow().date()
+
+    day = start
+    processed = 0
+    while day < end:
+        chunk_end = min(day + timedelta(days=chunk_days), end)
+        _rebuild(day, chunk_end)
+        db.session.commit()
+        
+        processed += (chunk_end - day).days
+        app.logger.info(f"Rolled up {day} to {chunk_end - timedelta(days=1)}")
+        day = chunk_end
+    return processed
+
+# Rollup rows written per INSERT while rebuilding
+INSERT_BATCH_SIZE = 1000
+
+def _rebuild(start, end):
+    for model in (DailyBookStats, DailyUniqueViewers):
+        model.query.filter(model.date >= start, model.date < end).delete(synchronize_session=False)
+    
+    # In (book, time) order, so only the current book and day's counts and sketch are held
+    events = db.session.execute(
+        db.select(ClickEvent.book_id, ClickEvent.timestamp, EventType.name, ClickEvent.ip_address, UserAgent.value)
+        .join(EventType, EventType.id == ClickEvent.event_type_id)
+        .outerjoin(UserAgent, UserAgent.id == ClickEvent.user_agent_id)
+        .where(
+            ClickEvent.timestamp >= datetime.combine(start, datetime.min.time()),
+            ClickEvent.timestamp < datetime.combine(end, datetime.min.time())
+        )
+        .order_by(ClickEvent.book_id, ClickEvent.timestamp)
+        .execution_options(yield_per=5000)
+    )
+    filter_bots = app.config['ANALYTICS_FILTER_BOTS']
+    stats_rows = []
+    sketch_rows = []
+    # Each day's sketches are merged once here, so the dashboard doesn't merge every book's per view
+    by_date = {}
+    current = None
+    counts = defaultdict(int)
+    sketch = None
+
+    def finish(flush=False):
+        book_id, date = current
+        stats_rows.extend({'book_id': book_id, 'date': date, 'event_type': event_type, 'count': n}
+                          for event_type, n in counts.items())
+        if sketch is not None:
+            sketch_rows.append({'book_id': book_id, 'date': date, 'sketch': sketch.to_bytes()})
+            by_date.setdefault(date, HyperLogLog()).merge(sketch)
+        for model, rows in ((DailyBookStats, stats_rows), (DailyUniqueViewers, sketch_rows)):
+            if rows and (flush or len(rows) >= INSERT_BATCH_SIZE):
+                db.session.execute(insert(model), rows)
+                rows.clear()
+
+    for book_id, timestamp, event_type, ip_address, user_agent in events:
+        # Older history still holds crawler traffic; skip it as the live path does, for counts and viewers alike
+        if filter_bots and is_bot(user_agent):
+            continue
+        key = (book_id, timestamp.date())
+        if key != current:
+            if current is not None:
+                finish()
+            current = key
+            counts = defaultdict(int)
+            sketch = None
+        counts[event_type] += 1
+        if event_type == 'view':
+            if sketch is None:
+                sketch = HyperLogLog()
+            sketch.add(visitor_key({'ip_address': ip_address, 'user_agent': user_agent}))
+    if current is not None:
+        finish(flush=True)
+    
+    DailySiteViewers.replace(start, end, by_date)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Daily analytics rollups")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="Rebuild rollups from ClickEvent history")
+    backfill_parser.add_argument("--start", type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+                                 help="first day to rebuild (default: oldest event)")
+    backfill_parser.add_argument("--end", type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+                                 help="day to stop before (default: today)")
+    backfill_parser.add_argument("--chunk-days", type=int, default=7)
+    args = parser.parse_args()
+
+    with app.app_context():
+        days = backfill(args.start, args.end, args.chunk_days)
+        print(f"Backfill completed: {days} days rebuilt.")
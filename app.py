@@ -1,9 +1,13 @@
 import os
 import logging
+import tempfile
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
+from db_pool import TimedQueuePool
+import db_routing
 
 # Set up logging
 if os.environ.get('RAILWAY_ENVIRONMENT') == 'production':
@@ -16,47 +20,193 @@ class Base(DeclarativeBase):
     pass
 
 # Initialize extensions
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": db_routing.RoutingSession})
 login_manager = LoginManager()
 
-# Create the app
-app = Flask(__name__)
-
-# Configure secret key
-app.secret_key = os.environ.get("SECRET_KEY") or os.environ.get("SESSION_SECRET") or "change_me_in_production"
-
-# Handle potential Railway PostgreSQL database URL format
-database_url = os.environ.get("DATABASE_URL")
-if database_url and database_url.startswith("postgres://"):
-    database_url = database_url.replace("postgres://", "postgresql://", 1)
-
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-app.config["UPLOAD_FOLDER"] = "static/uploads"
-app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max upload
-
-# Initialize extensions with app
-db.init_app(app)
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# Create upload directory if it doesn't exist
-with app.app_context():
+def _database_url(name):
+    url = os.environ.get(name)
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+def _engine_options(url, pool_size_env):
+    """Engine options for a database URL, with the pool sized from pool_size_env"""
+    options = {
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 300)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "").lower() in ("1", "true", "yes"),
+    }
+    if url and not url.startswith("sqlite"):
+        # Sized per worker by gunicorn.conf.py from its thread count
+        options.update({
+            "poolclass": TimedQueuePool,
+            "pool_size": int(os.environ.get(pool_size_env) or os.environ.get("DB_POOL_SIZE", 5)),
+            "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+            "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        })
+        connect_args = {"connect_timeout": int(os.environ.get("DB_CONNECT_TIMEOUT", 10))}
+        statement_timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+        if statement_timeout:
+            connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+        options["connect_args"] = connect_args
+    return options
+
+def create_app():
+    """
+    Create and configure the application. Nothing here touches the database;
+    tables are created by the migrations in schema.py during the release step.
+    """
+    app = Flask(__name__)
+
+    # Client address and scheme from the X-Forwarded-* headers of this many trusted proxies in
+    # front of the app (Railway's router is one), so rate limits, login throttling and analytics
+    # see each visitor's own IP instead of the proxy's
+    app.config["TRUSTED_PROXY_HOPS"] = int(os.environ.get("TRUSTED_PROXY_HOPS", 1 if os.environ.get("RAILWAY_ENVIRONMENT") else 0))
+    if app.config["TRUSTED_PROXY_HOPS"]:
+        hops = app.config["TRUSTED_PROXY_HOPS"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    # Configure secret key
+    app.secret_key = os.environ.get("SECRET_KEY") or os.environ.get("SESSION_SECRET") or "change_me_in_production"
+
+    # Handle potential Railway PostgreSQL database URL format
+    database_url = _database_url("DATABASE_URL")
+
+    # Configure the database; an optional read replica serves the read-only views (see db_routing.py)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = _engine_options(database_url, "DB_POOL_SIZE")
+    app.config["DATABASE_REPLICA_URL"] = _database_url("DATABASE_REPLICA_URL")
+    if app.config["DATABASE_REPLICA_URL"]:
+        app.config["SQLALCHEMY_BINDS"] = {
+            "replica": {"url": app.config["DATABASE_REPLICA_URL"],
+                        **_engine_options(app.config["DATABASE_REPLICA_URL"], "DB_REPLICA_POOL_SIZE")},
+        }
+    # Clients read from the primary for this long after committing a change, until the replica catches up
+    app.config["DB_READ_YOUR_WRITES_SECONDS"] = float(os.environ.get("DB_READ_YOUR_WRITES_SECONDS", 15))
+    # Seconds between connection pool statistics in the log (0 disables)
+    app.config["DB_POOL_LOG_INTERVAL"] = int(os.environ.get("DB_POOL_LOG_INTERVAL", 60))
+    app.config["UPLOAD_FOLDER"] = "static/uploads"
+    app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max upload
+
+    # Book downloads; DOWNLOAD_OFFLOAD can be "x-accel" (nginx) or "x-sendfile" (Apache/lighttpd)
+    app.config["DOWNLOAD_OFFLOAD"] = os.environ.get("DOWNLOAD_OFFLOAD", "")
+    app.config["DOWNLOAD_ACCEL_PREFIX"] = os.environ.get("DOWNLOAD_ACCEL_PREFIX", "/protected")
+    app.config["DOWNLOAD_MAX_AGE"] = 3600
+    app.config["DOWNLOAD_ETAG_CACHE_SIZE"] = 10000
+    app.config["USE_X_SENDFILE"] = app.config["DOWNLOAD_OFFLOAD"] == "x-sendfile"
+
+    app.config["THUMBNAIL_WORKERS"] = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+
+    # Rendered public pages; PAGE_CACHE_BACKEND is "sqlite" (shared by the web workers and the job
+    # worker, whose invalidations must reach every process), "memory" (single process only) or "none"
+    app.config["PAGE_CACHE_BACKEND"] = os.environ.get("PAGE_CACHE_BACKEND", "sqlite")
+    app.config["PAGE_CACHE_PATH"] = os.environ.get("PAGE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "library_page_cache.sqlite"))
+    app.config["PAGE_CACHE_TTL"] = int(os.environ.get("PAGE_CACHE_TTL", 300))
+    app.config["PAGE_CACHE_MAX_ENTRIES"] = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", 1000))
+
+    # Logged-in users are cached per worker; failed logins lock out the IP and briefly delay
+    # the username, counted in the RATE_LIMIT_PATH file shared by every worker
+    app.config["AUTH_CACHE_TTL"] = int(os.environ.get("AUTH_CACHE_TTL", 60))
+    app.config["LOGIN_MAX_FAILURES"] = int(os.environ.get("LOGIN_MAX_FAILURES", 5))
+    app.config["LOGIN_MAX_USER_DELAY"] = int(os.environ.get("LOGIN_MAX_USER_DELAY", 10))
+    app.config["LOGIN_MAX_IP_FAILURES"] = int(os.environ.get("LOGIN_MAX_IP_FAILURES", 20))
+    app.config["LOGIN_FAILURE_WINDOW"] = int(os.environ.get("LOGIN_FAILURE_WINDOW", 300))
+
+    app.config["BOOKS_PER_PAGE"] = int(os.environ.get("BOOKS_PER_PAGE", 24))
+    app.config["MAX_BOOKS_PER_PAGE"] = 100
+    app.config["SEARCH_MAX_CANDIDATES"] = int(os.environ.get("SEARCH_MAX_CANDIDATES", 1000))
+
+    # Analytics events are buffered in memory and flushed in batches
+    app.config["ANALYTICS_FLUSH_SIZE"] = int(os.environ.get("ANALYTICS_FLUSH_SIZE", 500))
+    app.config["ANALYTICS_FLUSH_INTERVAL"] = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", 2.0))
+    app.config["ANALYTICS_QUEUE_SIZE"] = int(os.environ.get("ANALYTICS_QUEUE_SIZE", 50000))
+    app.config["ANALYTICS_SYNC"] = os.environ.get("ANALYTICS_SYNC", "").lower() in ("1", "true", "yes")
+
+    # Requests running more SQL statements than this are logged (0 disables); tests can make it raise
+    app.config["SQL_QUERY_BUDGET"] = int(os.environ.get("SQL_QUERY_BUDGET", 20))
+    app.config["SQL_QUERY_BUDGET_RAISE"] = os.environ.get("SQL_QUERY_BUDGET_RAISE", "").lower() in ("1", "true", "yes")
+
+    # Prometheus metrics on /metrics, readable by admins or with METRICS_TOKEN as a bearer token.
+    # Each worker writes its samples to METRICS_DIR so any worker can report for all of them.
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+    app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "library_metrics"))
+    app.config["METRICS_SNAPSHOT_INTERVAL"] = 5
+
+    # Profile this fraction of requests and log those slower than PROFILE_SLOW_MS (0 disables)
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    app.config["PROFILE_SLOW_MS"] = int(os.environ.get("PROFILE_SLOW_MS", 1000))
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "")
+
+    # Event types accepted from /api/track/batch, and its limits
+    app.config["TRACK_EVENT_TYPES"] = set(os.environ.get("TRACK_EVENT_TYPES", "view,download,share").split(","))
+    app.config["TRACK_BATCH_MAX_EVENTS"] = int(os.environ.get("TRACK_BATCH_MAX_EVENTS", 100))
+    app.config["TRACK_BATCH_MAX_BYTES"] = 256 * 1024  # after gzip decompression
+
+    # Start shedding low-priority analytics events once the queue is this full (0-1)
+    app.config["ANALYTICS_SHED_THRESHOLD"] = float(os.environ.get("ANALYTICS_SHED_THRESHOLD", 0.5))
+
+    # Token buckets per client IP for the public write endpoints; RATE_LIMIT_BACKEND is
+    # "memory" (per worker), "sqlite" (shared by all workers on a machine) or "none"
+    app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+    app.config["RATE_LIMIT_PATH"] = os.environ.get("RATE_LIMIT_PATH", os.path.join(tempfile.gettempdir(), "library_rate_limits.sqlite"))
+    app.config["RATE_LIMIT_BURST"] = int(os.environ.get("RATE_LIMIT_BURST", 20))
+    app.config["RATE_LIMIT_PER_MINUTE"] = float(os.environ.get("RATE_LIMIT_PER_MINUTE", 60))
+
+    # Events from bots and repeats of the same (ip, book, event) within the window are not recorded
+    app.config["ANALYTICS_FILTER_BOTS"] = os.environ.get("ANALYTICS_FILTER_BOTS", "true").lower() in ("1", "true", "yes")
+    app.config["ANALYTICS_DEDUP_WINDOW"] = int(os.environ.get("ANALYTICS_DEDUP_WINDOW", 600))
+    app.config["ANALYTICS_DEDUP_MAX_ENTRIES"] = int(os.environ.get("ANALYTICS_DEDUP_MAX_ENTRIES", 100000))
+    # Interned user agent and referrer ids cached per worker; see dimensions.py
+    app.config["ANALYTICS_DIMENSION_CACHE_SIZE"] = int(os.environ.get("ANALYTICS_DIMENSION_CACHE_SIZE", 20000))
+
+    # Top-N lists kept by rankings.py; trending scores halve every TRENDING_HALF_LIFE_HOURS
+    app.config["RANKING_SIZE"] = int(os.environ.get("RANKING_SIZE", 50))
+    app.config["TRENDING_HALF_LIFE_HOURS"] = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 24))
+
+    # Analytics exports on /api/export, readable by admins or with EXPORT_TOKEN as a bearer token.
+    # Analytics rows younger than EXPORT_SETTLE_SECONDS wait for the next incremental export.
+    app.config["EXPORT_TOKEN"] = os.environ.get("EXPORT_TOKEN", "")
+    app.config["EXPORT_BATCH_SIZE"] = int(os.environ.get("EXPORT_BATCH_SIZE", 5000))
+    app.config["EXPORT_SETTLE_SECONDS"] = int(os.environ.get("EXPORT_SETTLE_SECONDS", 120))
+
+    # Background jobs run by `python jobs.py work`; failed jobs retry after JOB_RETRY_DELAY, doubling each time
+    app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+    app.config["JOB_RETRY_DELAY"] = int(os.environ.get("JOB_RETRY_DELAY", 30))
+    app.config["JOB_TIMEOUT"] = int(os.environ.get("JOB_TIMEOUT", 900))  # seconds before a running job is taken over
+    app.config["JOB_POLL_INTERVAL"] = float(os.environ.get("JOB_POLL_INTERVAL", 1.0))
+    app.config["JOB_RETENTION_DAYS"] = int(os.environ.get("JOB_RETENTION_DAYS", 7))
+    app.config["RANKINGS_INTERVAL"] = int(os.environ.get("RANKINGS_INTERVAL", 300))
+
+    # Raw click events older than the retention window are archived to ARCHIVE_FOLDER
+    app.config["CLICK_EVENT_RETENTION_MONTHS"] = int(os.environ.get("CLICK_EVENT_RETENTION_MONTHS", 12))
+    app.config["CLICK_EVENT_PARTITIONS_AHEAD"] = 3
+    # Bigger click_event tables aren't partitioned by the release step, which would block inserts for the copy
+    app.config["CLICK_EVENT_CONVERT_MAX_ROWS"] = int(os.environ.get("CLICK_EVENT_CONVERT_MAX_ROWS", 1000000))
+    app.config["ARCHIVE_FOLDER"] = os.environ.get("ARCHIVE_FOLDER", "archive")
+
+    # Initialize extensions with app
+    db.init_app(app)
+    db_routing.init_app(app)
+    login_manager.init_app(app)
+    login_manager.login_view = 'login'
+
+    # Create upload directory if it doesn't exist
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-    
-    # Import models and create tables
-    import models
-    db.create_all()
-    
-    # Import routes
-    from routes import *
+
+    return app
+
+def register_routes():
+    """
+    Add the web views to the app. Only the web entry point needs them, so
+    scripts and background jobs that import the app skip loading the views
+    and everything they pull in.
+    """
+    import routes  # the views add themselves to the app when imported
+
+# Shared instance used by the web server, scripts and helper modules
+app = create_app()
 
 # Set up login manager
 @login_manager.user_loader
 def load_user(user_id):
-    from models import User
-    return User.query.get(int(user_id))
+    from auth_cache import load_principal
+    return load_principal(user_id)
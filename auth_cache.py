@@ -0,0 +1,178 @@
+import os
+import hmac
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from flask_login import UserMixin
+from sqlalchemy import event
+from app import app, db
+from models import User
+
+class SessionUser(UserMixin):
+    """
+    Lightweight, detached copy of a User used as current_user, so requests
+    don't have to load the User row from the database
+    """
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.is_admin = bool(user.is_admin)
+        self.auth_token = auth_token(user)
+
+    def get_id(self):
+        return f"{self.id}:{self.auth_token}"
+
+def auth_token(user):
+    """
+    Short signature of the fields that grant access. It's stored in the
+    signed session, so changing a password or admin flag ends old sessions.
+    """
+    message = f"{user.id}:{user.password_hash}:{bool(user.is_admin)}".encode()
+    return hmac.new(app.secret_key.encode(), message, hashlib.sha256).hexdigest()[:16]
+
+_principals = {}  # user id -> (SessionUser, expires_at)
+_principals_lock = threading.Lock()
+
+def load_principal(session_id):
+    """
+    Resolve the id stored in the session to a SessionUser, using a per-worker
+    TTL cache and falling back to the database on a miss. Returns None if the
+    session's token no longer matches the user.
+    """
+    user_id, _, token = session_id.partition(':')
+    if not token or not user_id.isdigit():
+        return None
+    user_id = int(user_id)
+
+    with _principals_lock:
+        cached = _principals.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        principal = cached[0]
+    else:
+        user = db.session.get(User, user_id)
+        if user is None:
+            invalidate_user(user_id)
+            return None
+        principal = SessionUser(user)
+        with _principals_lock:
+            _principals[user_id] = (principal, time.monotonic() + app.config['AUTH_CACHE_TTL'])
+
+    if not hmac.compare_digest(principal.auth_token, token):
+        return None
+    return principal
+
+def invalidate_user(user_id):
+    """Forget a cached principal in this worker"""
+    with _principals_lock:
+        _principals.pop(user_id, None)
+
+@event.listens_for(User.password_hash, 'set')
+@event.listens_for(User.is_admin, 'set')
+def _on_credentials_change(target, value, oldvalue, initiator):
+    if target.id is not None and value != oldvalue:
+        invalidate_user(target.id)
+
+class LoginThrottle:
+    """
+    Count failed logins per client IP and per username within a window, in
+    a local SQLite file shared by every worker process on the machine.
+    Past its limit an IP is locked out, refused before any password hash is
+    computed, with the lockout doubling on each further failure. A username
+    is never locked out, since anyone could then lock the admin out by
+    guessing at it; past its limit each failure only holds further attempts
+    for it off for a short delay, doubling up to max_user_delay.
+    """
+
+    def __init__(self, path, max_failures, max_ip_failures, window, max_user_delay, max_lockout=3600):
+        self.path = path
+        self.max_failures = max_failures
+        self.max_ip_failures = max_ip_failures
+        self.window = window
+        self.max_user_delay = max_user_delay
+        self.max_lockout = max_lockout
+        self._local = threading.local()
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS login_failures (
+                key TEXT PRIMARY KEY, failures INTEGER, last_failure REAL, locked_until REAL
+            )
+        """)
+
+    def _connect(self):
+        # One connection per thread and process; sqlite3 connections can't be shared across forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _keys(self, username, ip_address):
+        return [f"ip:{ip_address}", f"user:{(username or '').lower()}"]
+
+    def _hold(self, key, failures):
+        """Seconds the key is refused for after its latest failure"""
+        if key.startswith('ip:'):
+            if failures < self.max_ip_failures:
+                return 0
+            return min(self.window * 2 ** (failures - self.max_ip_failures), self.max_lockout)
+        if failures < self.max_failures:
+            return 0
+        return min(2 ** (failures - self.max_failures), self.max_user_delay)
+
+    def retry_after(self, username, ip_address):
+        """Seconds until another attempt is allowed, or 0 if allowed now"""
+        # Wall-clock time, since monotonic clocks aren't comparable across processes
+        now = time.time()
+        try:
+            wait = self._connect().execute(
+                "SELECT MAX(locked_until) FROM login_failures WHERE key IN (?, ?)", self._keys(username, ip_address)
+            ).fetchone()[0] or 0
+        except sqlite3.Error as e:
+            # Fail open; a broken throttle shouldn't lock everyone out
+            app.logger.error(f"Login throttle failed: {e}")
+            return 0
+        return int(wait - now) + 1 if wait > now else 0
+
+    def record_failure(self, username, ip_address):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key in self._keys(username, ip_address):
+                    row = conn.execute("SELECT failures, last_failure, locked_until FROM login_failures WHERE key = ?",
+                                       (key,)).fetchone()
+                    # A full window without failures or lockout starts the count again
+                    failures = row[0] if row and max(row[1], row[2]) + self.window >= now else 0
+                    failures += 1
+                    conn.execute("INSERT OR REPLACE INTO login_failures (key, failures, last_failure, locked_until) "
+                                 "VALUES (?, ?, ?, ?)", (key, failures, now, now + self._hold(key, failures)))
+                # Now and then, drop entries that have gone quiet so the table can't grow without bound
+                if random.random() < 0.01:
+                    conn.execute("DELETE FROM login_failures WHERE MAX(last_failure, locked_until) < ?",
+                                 (now - self.window,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            app.logger.error(f"Login throttle failed: {e}")
+
+    def record_success(self, username, ip_address):
+        # The IP's count stays, so one valid account can't reset a spraying client's limit
+        try:
+            self._connect().execute("DELETE FROM login_failures WHERE key = ?", (self._keys(username, ip_address)[1],))
+        except sqlite3.Error as e:
+            app.logger.error(f"Login throttle failed: {e}")
+
+login_throttle = LoginThrottle(
+    app.config['RATE_LIMIT_PATH'], app.config['LOGIN_MAX_FAILURES'], app.config['LOGIN_MAX_IP_FAILURES'],
+    app.config['LOGIN_FAILURE_WINDOW'], app.config['LOGIN_MAX_USER_DELAY']
+)
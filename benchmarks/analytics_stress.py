@@ -0,0 +1,85 @@
+"""
+Concurrency stress check for BookAnalytics.increment.
+
+Hammers a single book's counters from many threads and verifies that no
+increment is lost. Uses a throwaway SQLite database unless DATABASE_URL is set.
+
+    python -m benchmarks.analytics_stress --threads 16 --increments 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--increments', type=int, default=200, help='increments per thread')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        db_path = os.path.join(tempfile.mkdtemp(), 'stress.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+
+    from app import app, db
+    from models import Book, BookAnalytics
+    from schema import migrate
+
+    with app.app_context():
+        migrate()
+        book = Book(title='Stress Test', author='Benchmark', category='other')
+        db.session.add(book)
+        db.session.commit()
+        book_id = book.id
+
+    errors = []
+    start_barrier = threading.Barrier(args.threads)
+
+    def worker():
+        start_barrier.wait()
+        with app.app_context():
+            for _ in range(args.increments):
+                # Retry on lock timeouts; a retried increment must still count once
+                for attempt in range(20):
+                    try:
+                        BookAnalytics.increment(book_id, view_count=1, download_count=1)
+                        db.session.commit()
+                        break
+                    except Exception as e:
+                        db.session.rollback()
+                        if attempt == 19:
+                            errors.append(e)
+                        time.sleep(0.01 * (attempt + 1))
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    expected = args.threads * args.increments
+    with app.app_context():
+        rows = BookAnalytics.query.filter_by(book_id=book_id).all()
+        db.session.query(BookAnalytics).filter_by(book_id=book_id).delete()
+        db.session.query(Book).filter_by(id=book_id).delete()
+        db.session.commit()
+
+    print(f"{expected} increments from {args.threads} threads in {elapsed:.2f}s "
+          f"({expected / elapsed:.0f}/s), {len(errors)} gave up")
+    if len(rows) != 1:
+        print(f"FAIL: expected 1 analytics row, found {len(rows)}")
+        return 1
+    row = rows[0]
+    if row.view_count != expected or row.download_count != expected:
+        print(f"FAIL: expected {expected}, got views={row.view_count} downloads={row.download_count}")
+        return 1
+    print("OK: counts are exact")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
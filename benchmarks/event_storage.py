@@ -0,0 +1,137 @@
+"""
+Click event storage size and insert cost, before and after compaction.
+
+Fills a click_event table in the old layout (event type, user agent and
+referrer as text, IP as a string), then runs the migration that moves the
+strings into lookup tables and stores IPs natively. Reports bytes per row
+(table and indexes) and insert time per event for both layouts, and checks
+that converted events read back unchanged. Uses a throwaway SQLite
+database unless DATABASE_URL is set; that database is reset.
+
+    python -m benchmarks.event_storage --events 200000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=200)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=5000, help='events per insert statement')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'events.db')}"
+
+    import sqlalchemy as sa
+    from app import app, db
+    from models import Book, ClickEvent
+    from schema import migrate
+    from dimensions import click_event_rows, insert_click_events, select_click_events
+    from benchmarks.generate_data import generate, random_event, reset
+
+    # click_event as it was before the strings moved to lookup tables
+    legacy = sa.Table(
+        'click_event', sa.MetaData(),
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('book_id', sa.Integer, nullable=False),
+        sa.Column('event_type', sa.String(50), nullable=False),
+        sa.Column('user_agent', sa.String(255)),
+        sa.Column('ip_address', sa.String(50)),
+        sa.Column('referrer', sa.String(255)),
+        sa.Column('timestamp', sa.DateTime, nullable=False),
+        sa.Index('ix_click_event_book_id_timestamp', 'book_id', 'timestamp'),
+        sa.Index('ix_click_event_timestamp', 'timestamp'),
+    )
+
+    def table_bytes():
+        """Bytes used by click_event and its indexes, after reclaiming free space"""
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(sa.text("VACUUM FULL click_event"))
+                return conn.execute(sa.text("SELECT pg_total_relation_size('click_event')")).scalar()
+            conn.execute(sa.text("VACUUM"))
+            return conn.execute(sa.text("""
+                SELECT SUM(pgsize) FROM dbstat WHERE name IN (
+                    SELECT name FROM sqlite_master WHERE tbl_name = 'click_event'
+                )
+            """)).scalar()
+
+    def lookup_bytes():
+        with db.engine.connect() as conn:
+            if conn.dialect.name == 'postgresql':
+                return conn.execute(sa.text("""
+                    SELECT pg_total_relation_size('event_type') + pg_total_relation_size('user_agent')
+                        + pg_total_relation_size('referrer')
+                """)).scalar()
+            return conn.execute(sa.text("""
+                SELECT SUM(pgsize) FROM dbstat WHERE name IN (
+                    SELECT name FROM sqlite_master WHERE tbl_name IN ('event_type', 'user_agent', 'referrer')
+                )
+            """)).scalar()
+
+    def timed_insert(batches, write):
+        started = time.perf_counter()
+        for batch in batches:
+            write(batch)
+            db.session.commit()
+        return (time.perf_counter() - started) / args.events * 1e6
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    def event_batches():
+        book_ids = [book_id for (book_id,) in db.session.query(Book.id).all()]
+        events = [random_event(rng, rng.choice(book_ids), args.days, now) for _ in range(args.events)]
+        return [events[start:start + args.batch_size] for start in range(0, len(events), args.batch_size)]
+
+    with app.app_context():
+        reset(db)
+        generate(args.books, 0, args.days, args.seed, with_files=0)
+        with db.engine.begin() as conn:
+            ClickEvent.__table__.drop(conn)
+            legacy.create(conn)
+            conn.execute(sa.text("DELETE FROM schema_version WHERE version = 10"))
+
+        batches = event_batches()
+        legacy_us = timed_insert(batches, lambda batch: db.session.execute(sa.insert(legacy), batch))
+        legacy_bytes = table_bytes()
+        sample = db.session.execute(sa.select(legacy).order_by(legacy.c.id).limit(1000)).all()
+        db.session.commit()
+
+        started = time.perf_counter()
+        migrate()
+        migration_seconds = time.perf_counter() - started
+        compact_bytes = table_bytes()
+        converted = db.session.execute(select_click_events().order_by(ClickEvent.id).limit(1000)).all()
+        db.session.commit()
+
+        # Timed from an empty table like the old layout, interning and inserting as the analytics flusher does
+        db.session.execute(sa.delete(ClickEvent.__table__))
+        db.session.commit()
+        new_batches = event_batches()
+        compact_us = timed_insert(new_batches, lambda batch: insert_click_events(click_event_rows(batch)))
+        lookups = lookup_bytes()
+        database = db.engine.dialect.name
+
+    print(f"{args.events} events on {database}, migrated in {migration_seconds:.1f}s")
+    print(f"{'layout':<10}{'bytes/row':>12}{'insert us/event':>18}")
+    print(f"{'before':<10}{legacy_bytes / args.events:>12.1f}{legacy_us:>18.1f}")
+    print(f"{'after':<10}{compact_bytes / args.events:>12.1f}{compact_us:>18.1f}")
+    print(f"Lookup tables: {lookups} bytes in total")
+
+    mismatched = [before.id for before, after in zip(sample, converted) if tuple(before) != tuple(after)]
+    if mismatched or len(sample) != len(converted):
+        print(f"Converted events differ from the originals, e.g. ids {mismatched[:5]}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Synthetic data generator for benchmarks.
+
+Fills the database with a reproducible catalogue: N books, their
+BookAnalytics counters and M click events spread over the last D days.
+Popularity follows a Zipf-like curve and traffic has a daily cycle, so a
+few books get most of the events, as in production. The same --seed always
+produces the same data.
+
+    python -m benchmarks.generate_data --books 1000 --events 200000 --days 90 --seed 42 --reset
+
+Some books get a small file under static/uploads/benchmark for the download
+scenario. Daily rollups, search and rankings are rebuilt afterwards.
+"""
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+
+ADMIN_USERNAME = 'benchmark-admin'
+ADMIN_PASSWORD = 'benchmark-admin'
+
+FILE_FOLDER = os.path.join('uploads', 'benchmark')
+
+WORDS = ('river night garden silent empire glass winter machine letters stone city '
+         'ocean history quiet light house theory ember atlas signal').split()
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Safari/605.1.15',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+]
+USER_AGENT_WEIGHTS = (35, 20, 20, 10, 12, 3)
+
+REFERRERS = [None, 'https://www.google.com/', 'https://duckduckgo.com/', 'https://t.co/', 'https://news.ycombinator.com/']
+REFERRER_WEIGHTS = (50, 30, 5, 10, 5)
+
+EVENT_TYPES = ('view', 'download', 'share')
+EVENT_WEIGHTS = (90, 8, 2)
+
+def _title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title()
+
+def random_event(rng, book_id, days, now):
+    """A click event dict for book_id at a random time in the last days"""
+    # The order of the draws is part of what a seed produces; append new ones at the end
+    event_type = rng.choices(EVENT_TYPES, EVENT_WEIGHTS)[0]
+    today = now.replace(hour=0, minute=0, second=0)
+    day = rng.randrange(days)
+    # More traffic in the afternoon and evening than overnight
+    hour = min(int(rng.triangular(0, 24, 19)), 23)
+    timestamp = today - timedelta(days=day) + timedelta(hours=hour, minutes=rng.randrange(60))
+    if timestamp > now:
+        timestamp -= timedelta(days=1)
+    return {
+        'book_id': book_id,
+        'event_type': event_type,
+        'user_agent': rng.choices(USER_AGENTS, USER_AGENT_WEIGHTS)[0],
+        'ip_address': f'10.{rng.randrange(4)}.{rng.randrange(256)}.{rng.randrange(1, 255)}',
+        'referrer': rng.choices(REFERRERS, REFERRER_WEIGHTS)[0],
+        'timestamp': timestamp,
+    }
+
+def reset(db):
+    """Drop every table and migrate an empty schema"""
+    from schema import migrate
+    db.drop_all()
+    db.session.execute(db.text("DROP TABLE IF EXISTS schema_version"))
+    db.session.execute(db.text("DROP TABLE IF EXISTS book_fts"))
+    db.session.commit()
+    migrate()
+
+def _write_files(count, size_kb, rng):
+    """Create count book files of about size_kb; books share them like deduplicated uploads"""
+    folder = os.path.join('static', FILE_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(FILE_FOLDER, f'book-{i}.pdf')
+        with open(os.path.join('static', path), 'wb') as f:
+            f.write(b'%PDF-1.4\n' + rng.randbytes(size_kb * 1024))
+        paths.append(path)
+    return paths
+
+def generate(books=1000, events=100000, days=90, seed=42, with_files=0.2, file_size_kb=256, batch_size=10000):
+    """
+    Add the synthetic data set to the current database and return a
+    description of it, for inclusion in benchmark results
+    """
+    from sqlalchemy import insert
+    from app import db
+    from models import Book, BookAnalytics, ClickEvent, User
+    from forms import CATEGORY_CHOICES
+    from search import reindex_all
+    from analytics_rollup import backfill
+    from rankings import update_rankings
+    from dimensions import click_event_rows
+
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    categories = [value for value, _ in CATEGORY_CHOICES]
+    file_paths = _write_files(10, file_size_kb, rng) if with_files else []
+
+    if User.query.filter_by(username=ADMIN_USERNAME).first() is None:
+        admin = User(username=ADMIN_USERNAME, email='benchmark-admin@example.com', is_admin=True)
+        admin.set_password(ADMIN_PASSWORD)
+        db.session.add(admin)
+
+    rows = []
+    for i in range(books):
+        created_at = now - timedelta(days=rng.uniform(0, days * 2))
+        rows.append({
+            'title': _title(rng),
+            'author': f'Author {rng.randrange(max(books // 5, 1))}',
+            'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))),
+            'publisher': f'Publisher {rng.randrange(50)}',
+            'year': rng.randint(1900, now.year),
+            'isbn': f'979{seed % 100:02d}{i:08d}',
+            'category': rng.choice(categories),
+            'file_path': rng.choice(file_paths) if file_paths and rng.random() < with_files else None,
+            'created_at': created_at,
+            'updated_at': created_at,
+        })
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(insert(Book), rows[start:start + batch_size])
+    db.session.commit()
+    book_ids = [book_id for (book_id,) in db.session.query(Book.id).order_by(Book.id).all()][-books:]
+
+    # Popularity rank is shuffled so it isn't tied to the insertion order
+    ranked = book_ids[:]
+    rng.shuffle(ranked)
+    popularity = [1 / (rank + 1) ** 1.1 for rank in range(len(ranked))]
+    counts = {book_id: {'view': 0, 'download': 0, 'share': 0} for book_id in book_ids}
+
+    written = 0
+    while written < events:
+        batch = []
+        for book_id in rng.choices(ranked, weights=popularity, k=min(batch_size, events - written)):
+            event = random_event(rng, book_id, days, now)
+            counts[book_id][event['event_type']] += 1
+            batch.append(event)
+        db.session.execute(insert(ClickEvent.__table__), click_event_rows(batch))
+        db.session.commit()
+        written += len(batch)
+
+    db.session.execute(insert(BookAnalytics), [{
+        'book_id': book_id,
+        'view_count': totals['view'],
+        'download_count': totals['download'],
+        'share_count': totals['share'],
+        'created_at': now,
+        'updated_at': now,
+    } for book_id, totals in counts.items()])
+    db.session.commit()
+
+    reindex_all()
+    backfill(now.date() - timedelta(days=days), now.date() + timedelta(days=1))
+    update_rankings()
+
+    return {
+        'books': books,
+        'events': events,
+        'days': days,
+        'seed': seed,
+        'books_with_files': sum(1 for row in rows if row['file_path']),
+        'database': db.engine.dialect.name,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=100000, help='click events to generate')
+    parser.add_argument('--days', type=int, default=90, help='days of history the events cover')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--with-files', type=float, default=0.2, help='fraction of books with a downloadable file')
+    parser.add_argument('--file-size-kb', type=int, default=256)
+    parser.add_argument('--reset', action='store_true', help='drop all tables first')
+    args = parser.parse_args()
+
+    from app import app, db
+    from schema import migrate
+
+    with app.app_context():
+        if args.reset:
+            reset(db)
+        else:
+            migrate()
+        dataset = generate(args.books, args.events, args.days, args.seed, args.with_files, args.file_size_kb)
+    print(f"Generated {dataset['books']} books and {dataset['events']} events over {dataset['days']} days "
+          f"on {dataset['database']} (seed {dataset['seed']})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
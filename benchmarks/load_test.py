@@ -0,0 +1,130 @@
+"""
+HTTP load test for the public endpoints.
+
+Drives a running server with concurrent clients and reports throughput and
+latency per scenario, so worker profiles can be compared:
+
+    GUNICORN_PROFILE=sync gunicorn main:app &
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --concurrency 32
+    GUNICORN_PROFILE=gthread gunicorn main:app &
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --concurrency 32
+
+Book ids are discovered through /api/books; download_book only uses books
+that have an uploaded file.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+def discover_books(base_url, limit):
+    """Collect (id, url) pairs for up to limit books through the listing API"""
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.netloc, timeout=30)
+    books, cursor = [], None
+    while len(books) < limit:
+        path = '/api/books?per_page=100' + (f'&cursor={cursor}' if cursor else '')
+        conn.request('GET', path)
+        page = json.loads(conn.getresponse().read())
+        books.extend(book['id'] for book in page['books'])
+        cursor = page.get('next_cursor')
+        if not cursor:
+            break
+    conn.close()
+    return books[:limit]
+
+def run_scenario(base_url, paths, concurrency, duration, headers):
+    """Hit random paths from concurrency keep-alive clients for duration seconds"""
+    parts = urlsplit(base_url)
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        rng = random.Random()
+        conn = http.client.HTTPConnection(parts.netloc, timeout=30)
+        local_latencies, local_errors = [], 0
+        while time.perf_counter() < deadline:
+            path = rng.choice(paths)
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(parts.netloc, timeout=30)
+                continue
+            local_latencies.append((time.perf_counter() - started) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--books', type=int, default=200, help='number of books to spread requests over')
+    parser.add_argument('--download-ids', help='comma-separated ids of books with files (default: all discovered)')
+    parser.add_argument('--scenarios', default='index,book_detail,download_book')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    book_ids = discover_books(args.url, args.books)
+    if not book_ids:
+        print("No books found; seed the database first")
+        return 1
+    download_ids = [int(i) for i in args.download_ids.split(',')] if args.download_ids else book_ids
+
+    scenarios = {
+        'index': (['/'], {}),
+        'book_detail': ([f'/book/{book_id}' for book_id in book_ids], {}),
+        # Conditional requests are excluded so every hit transfers the file
+        'download_book': ([f'/book/{book_id}/download' for book_id in download_ids], {}),
+    }
+
+    results = {}
+    print(f"{'scenario':<16}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in args.scenarios.split(','):
+        paths, headers = scenarios[name]
+        result = run_scenario(args.url, paths, args.concurrency, args.duration, headers)
+        results[name] = result
+        print(f"{name:<16}{result['requests']:>10}{result['errors']:>8}{result['rps']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'url': args.url, 'concurrency': args.concurrency, 'results': results}, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+SQL query budget check for the main pages.
+
+Requests each page through the test client against a small and a larger
+catalogue and compares the number of SQL statements each one runs. A page
+whose count grows with the catalogue has an N+1 query; a page over
+--budget fails the check.
+
+    python -m benchmarks.query_budget --small 10 --large 200
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+PAGES = [
+    ('index', '/', False),
+    ('list_books', '/api/books', False),
+    ('search', '/api/search?q=book', False),
+    ('book_detail', '/book/{book_id}', False),
+    ('admin_dashboard', '/admin', True),
+    ('manage_books', '/admin/books', True),
+    ('admin_analytics', '/admin/analytics', True),
+]
+
+def seed(db, Book, BookAnalytics, count):
+    books = [Book(title=f'Book {i}', author=f'Author {i % 17}', category='fiction') for i in range(count)]
+    db.session.add_all(books)
+    db.session.flush()
+    db.session.add_all(BookAnalytics(book_id=book.id, view_count=i, download_count=i // 2)
+                       for i, book in enumerate(books))
+    db.session.commit()
+    return books[0].id
+
+def measure(count):
+    """Return {page: statement count} for a fresh database holding count books"""
+    from app import app, db
+    from models import Book, BookAnalytics, User
+    from schema import migrate
+    from search import reindex_all
+    from auth_cache import SessionUser, invalidate_user
+
+    with app.app_context():
+        db.drop_all()
+        db.session.execute(db.text("DROP TABLE IF EXISTS schema_version"))
+        db.session.execute(db.text("DROP TABLE IF EXISTS book_fts"))
+        db.session.commit()
+        migrate()
+        book_id = seed(db, Book, BookAnalytics, count)
+        reindex_all()
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        admin.set_password('budget-check')
+        db.session.add(admin)
+        db.session.commit()
+        session_id = SessionUser(admin).get_id()
+        # A principal cached for the previous database's admin would have a stale token
+        invalidate_user(admin.id)
+
+    counts = {}
+    for name, path, needs_admin in PAGES:
+        client = app.test_client()
+        if needs_admin:
+            with client.session_transaction() as session:
+                session['_user_id'] = session_id
+                session['_fresh'] = True
+        response = client.get(path.format(book_id=book_id))
+        if response.status_code != 200:
+            raise RuntimeError(f"{name} returned {response.status_code}")
+        counts[name] = int(response.headers['X-Query-Count'])
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--small', type=int, default=10, help='books in the small catalogue')
+    parser.add_argument('--large', type=int, default=200, help='books in the large catalogue')
+    parser.add_argument('--budget', type=int, default=10, help='maximum statements per page')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'budget.db')}"
+    # Cached pages would hide the queries being measured
+    os.environ['PAGE_CACHE_BACKEND'] = 'none'
+    os.environ['ANALYTICS_SYNC'] = 'false'
+
+    from app import app, register_routes
+    register_routes()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, SQL_QUERY_BUDGET=args.budget, SQL_QUERY_BUDGET_RAISE=True)
+
+    try:
+        small = measure(args.small)
+        large = measure(args.large)
+    except Exception as e:
+        print(f"Query budget check failed: {e}")
+        return 1
+
+    ok = True
+    print(f"{'page':<18}{args.small:>8} books{args.large:>8} books")
+    for name, _, _ in PAGES:
+        status = ''
+        if large[name] != small[name]:
+            status = '  grows with the catalogue'
+            ok = False
+        print(f"{name:<18}{small[name]:>14}{large[name]:>14}{status}")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Ranking read latency as click history grows.
+
+Adds click events in stages, runs the incremental rankings update after
+each stage, then times reads of the precomputed trending list against the
+same list computed on demand from ClickEvent. Precomputed reads should
+stay flat while the on-demand query grows with the event volume.
+Uses a throwaway SQLite database unless DATABASE_URL is set.
+
+    python -m benchmarks.ranking_benchmark --books 2000 --stages 10000,100000,500000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def time_reads(read, repeats):
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        read()
+        samples.append((time.perf_counter() - started) * 1000)
+    return percentile(samples, 0.5), percentile(samples, 0.95)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--stages', default='10000,100000,500000', help='total events after each stage')
+    parser.add_argument('--repeats', type=int, default=200, help='reads timed per stage')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    stages = [int(stage) for stage in args.stages.split(',')]
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'rankings.db')}"
+
+    from sqlalchemy import func, insert
+    from app import app, db
+    from models import Book, BookAnalytics, ClickEvent, EVENT_TYPE_IDS
+    from schema import migrate
+    from rankings import EVENT_WEIGHTS, get_ranking, update_rankings
+    from dimensions import click_event_rows
+
+    rng = random.Random(args.seed)
+    categories = ['fiction', 'science', 'history', 'children', 'poetry']
+    weights = [1 / (rank + 1) for rank in range(args.books)]  # a few books get most of the traffic
+
+    def on_demand():
+        since = datetime.utcnow() - timedelta(days=7)
+        score = func.sum(db.case(
+            *[(ClickEvent.event_type_id == EVENT_TYPE_IDS[event_type], weight)
+              for event_type, weight in EVENT_WEIGHTS.items()],
+            else_=0
+        ))
+        rows = (
+            db.session.query(ClickEvent.book_id, score)
+            .filter(ClickEvent.timestamp >= since)
+            .group_by(ClickEvent.book_id)
+            .order_by(score.desc())
+            .limit(10)
+            .all()
+        )
+        return Book.query.filter(Book.id.in_([book_id for book_id, _ in rows])).all()
+
+    with app.app_context():
+        migrate()
+        books = [Book(title=f'Book {i}', author=f'Author {i % 97}', category=categories[i % len(categories)])
+                 for i in range(args.books)]
+        db.session.add_all(books)
+        db.session.flush()
+        db.session.add_all(BookAnalytics(book_id=book.id) for book in books)
+        db.session.commit()
+        book_ids = [book.id for book in books]
+
+        print(f"{'events':>10}{'update ms':>12}{'read p50':>10}{'read p95':>10}{'on-demand p50':>15}{'on-demand p95':>15}")
+        results = []
+        total = 0
+        now = datetime.utcnow()
+        for target in stages:
+            while total < target:
+                count = min(10000, target - total)
+                chosen = rng.choices(book_ids, weights=weights, k=count)
+                db.session.execute(insert(ClickEvent.__table__), click_event_rows([{
+                    'book_id': book_id,
+                    'event_type': rng.choices(('view', 'download', 'share'), (90, 8, 2))[0],
+                    'ip_address': f'10.0.{rng.randrange(256)}.{rng.randrange(256)}',
+                    'timestamp': now - timedelta(minutes=rng.randrange(7 * 24 * 60)),
+                } for book_id in chosen]))
+                db.session.commit()
+                total += count
+
+            update_ms = update_rankings()['seconds'] * 1000
+            read_p50, read_p95 = time_reads(lambda: get_ranking('trending'), args.repeats)
+            demand_p50, demand_p95 = time_reads(on_demand, max(args.repeats // 20, 3))
+            results.append(read_p95)
+            print(f"{total:>10}{update_ms:>12.0f}{read_p50:>10.2f}{read_p95:>10.2f}{demand_p50:>15.2f}{demand_p95:>15.2f}")
+
+    # Allow for timer noise; a read that scales with events grows far more than this
+    if results[-1] > max(results[0] * 3, results[0] + 2):
+        print("Precomputed ranking reads got slower as events grew")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
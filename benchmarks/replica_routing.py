@@ -0,0 +1,137 @@
+"""
+Read replica routing check.
+
+Copies a seeded SQLite database to a second file that stands in for the
+replica, marks every book title in the copy, and then requests pages
+through the test client while counting statements on each engine. Checks
+that the read-only views read from the replica, that an admin edit is
+written to the primary, that the admin reads from the primary until
+DB_READ_YOUR_WRITES_SECONDS have passed while other clients keep using the
+replica, and that pages about to be cached are rendered from the primary
+only shortly after their cache entries were invalidated.
+
+    python -m benchmarks.replica_routing --books 20
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+from collections import Counter
+
+REPLICA_MARK = ' [replica]'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=20)
+    parser.add_argument('--window', type=float, default=1.0, help='DB_READ_YOUR_WRITES_SECONDS for the check')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    primary_path = os.path.join(folder, 'primary.db')
+    replica_path = os.path.join(folder, 'replica.db')
+    os.environ['DATABASE_URL'] = f"sqlite:///{primary_path}"
+    os.environ['DATABASE_REPLICA_URL'] = f"sqlite:///{replica_path}"
+    os.environ['DB_READ_YOUR_WRITES_SECONDS'] = str(args.window)
+    os.environ['PAGE_CACHE_BACKEND'] = 'none'
+    os.environ['ANALYTICS_SYNC'] = 'false'
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import app, db, register_routes
+    from models import Book, BookAnalytics, User
+    from schema import migrate
+    from search import reindex_all
+    from auth_cache import SessionUser
+    import page_cache
+    register_routes()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+    with app.app_context():
+        migrate()
+        books = [Book(title=f'Book {i}', author=f'Author {i % 7}', category='fiction') for i in range(args.books)]
+        db.session.add_all(books)
+        db.session.flush()
+        db.session.add_all(BookAnalytics(book_id=book.id) for book in books)
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        admin.set_password('replica-check')
+        db.session.add(admin)
+        db.session.commit()
+        reindex_all()
+        book_id = books[0].id
+        session_id = SessionUser(admin).get_id()
+        engines = {db.engines[None]: 'primary', db.engines['replica']: 'replica'}
+        for engine in engines:
+            engine.dispose()
+
+    # The replica starts as a copy of the primary; marked titles show where a page read from
+    with sqlite3.connect(primary_path) as source, sqlite3.connect(replica_path) as target:
+        source.backup(target)
+        target.execute("UPDATE book SET title = title || ?", (REPLICA_MARK,))
+
+    statements = Counter()
+    main_thread = threading.get_ident()
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        # Analytics are flushed from a background thread; only count the requests
+        if threading.get_ident() == main_thread:
+            statements[engines.get(conn.engine, 'other')] += 1
+
+    failures = []
+
+    def request(label, client, path, expect, method='get', **kwargs):
+        statements.clear()
+        response = getattr(client, method)(path, **kwargs)
+        used = dict(statements)
+        print(f"{label:<44}{response.status_code:>5}{used.get('primary', 0):>9}{used.get('replica', 0):>9}")
+        if response.status_code >= 400:
+            failures.append(f"{label}: status {response.status_code}")
+        elif expect not in used or len(used) != 1:
+            failures.append(f"{label}: expected only {expect} statements, got {used}")
+        return response
+
+    anonymous = app.test_client()
+    admin_client = app.test_client()
+    with admin_client.session_transaction() as session:
+        session['_user_id'] = session_id
+        session['_fresh'] = True
+
+    print(f"{'request':<44}{'status':>5}{'primary':>9}{'replica':>9}")
+    response = request('catalogue API', anonymous, '/api/books', 'replica')
+    if REPLICA_MARK not in response.get_data(as_text=True):
+        failures.append("catalogue API: titles didn't come from the replica")
+    request('search API', anonymous, '/api/search?q=book', 'replica')
+    request('rankings API', anonymous, '/api/rankings/most_viewed', 'replica')
+    request('admin books before the edit', admin_client, '/admin/books', 'replica')
+
+    request('admin edit', admin_client, f'/admin/books/edit/{book_id}', 'primary', method='post',
+            data={'title': 'Edited title', 'author': 'Author 0', 'category': 'fiction'})
+    response = request('admin books right after the edit', admin_client, '/admin/books', 'primary')
+    if 'Edited title' not in response.get_data(as_text=True):
+        failures.append("admin books right after the edit: the edit isn't shown")
+    request('anonymous catalogue after the edit', anonymous, '/api/books', 'replica')
+    time.sleep(args.window + 0.1)
+    request('admin books after the window', admin_client, '/admin/books', 'replica')
+
+    # A page that will be cached must not be rendered from a replica that may lag an invalidation
+    page_cache.cache_backend = page_cache.MemoryBackend(100, 60)
+    request('uncached book page with the page cache', anonymous, f'/book/{book_id}', 'replica')
+    page_cache.invalidate_book(book_id)
+    request('book page right after an invalidation', anonymous, f'/book/{book_id}', 'primary')
+    time.sleep(args.window + 0.1)
+    page_cache.cache_backend.clear()
+    request('book page after the window', anonymous, f'/book/{book_id}', 'replica')
+    page_cache.cache_backend = None
+    request('book page without the page cache', anonymous, f'/book/{book_id}', 'replica')
+
+    if failures:
+        print('\n'.join(['', 'Routing check failed:'] + failures))
+        return 1
+    print('\nRouting check passed')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
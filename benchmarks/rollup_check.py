@@ -0,0 +1,96 @@
+"""
+Daily rollup consistency check.
+
+Fills click_event with generated history, crawler traffic included, runs
+the rollup backfill and compares every book and day against counts and
+sketches computed directly from the same events. Views and unique viewers
+must both leave out bots when ANALYTICS_FILTER_BOTS is on, and both keep
+them when it's off, so the dashboard shows them side by side consistently.
+Uses a throwaway SQLite database unless DATABASE_URL is set; that database
+is reset.
+
+    python -m benchmarks.rollup_check --events 20000
+"""
+import os
+import sys
+import random
+import argparse
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=50)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'rollup.db')}"
+
+    from sqlalchemy import insert
+    from app import app, db
+    from models import Book, ClickEvent, DailyBookStats, DailyUniqueViewers, DailySiteViewers
+    from analytics_rollup import backfill
+    from analytics_buffer import visitor_key
+    from event_filter import is_bot
+    from hyperloglog import HyperLogLog
+    from dimensions import click_event_rows
+    from benchmarks.generate_data import random_event, reset
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    with app.app_context():
+        reset(db)
+        books = [Book(title=f'Book {i}', author=f'Author {i % 7}', category='fiction') for i in range(args.books)]
+        db.session.add_all(books)
+        db.session.commit()
+        book_ids = [book.id for book in books]
+        events = [random_event(rng, rng.choice(book_ids), args.days, now) for _ in range(args.events)]
+        # Clients that sent no user agent count as bots too
+        for event in rng.sample(events, len(events) // 50):
+            event['user_agent'] = None
+        db.session.execute(insert(ClickEvent.__table__), click_event_rows(events))
+        db.session.commit()
+
+        failures = []
+        for filter_bots in (True, False):
+            app.config['ANALYTICS_FILTER_BOTS'] = filter_bots
+            start, end = now.date() - timedelta(days=args.days), now.date() + timedelta(days=1)
+            backfill(start, end)
+
+            counts = defaultdict(int)
+            sketches = defaultdict(HyperLogLog)
+            site = defaultdict(HyperLogLog)
+            for event in events:
+                if filter_bots and is_bot(event['user_agent']):
+                    continue
+                day = event['timestamp'].date()
+                counts[(event['book_id'], day, event['event_type'])] += 1
+                if event['event_type'] == 'view':
+                    sketches[(event['book_id'], day)].add(visitor_key(event))
+                    site[day].add(visitor_key(event))
+
+            stored_counts = {(row.book_id, row.date, row.event_type): row.count for row in DailyBookStats.query}
+            stored_sketches = {(row.book_id, row.date): row.sketch for row in DailyUniqueViewers.query}
+            stored_site = {row.date: row.sketch for row in DailySiteViewers.query}
+            label = 'bots filtered' if filter_bots else 'bots kept'
+            if stored_counts != dict(counts):
+                failures.append(f"{label}: daily event counts differ from the click events")
+            if stored_sketches != {key: sketch.to_bytes() for key, sketch in sketches.items()}:
+                failures.append(f"{label}: unique viewer sketches differ from the click events")
+            if stored_site != {day: sketch.to_bytes() for day, sketch in site.items()}:
+                failures.append(f"{label}: site-wide viewer sketches differ from the click events")
+            views = sum(n for (_, _, event_type), n in counts.items() if event_type == 'view')
+            print(f"{label:<16}{views:>8} views{sum(s.count() for s in site.values()):>8} daily unique viewers")
+
+    if failures:
+        print('\n'.join(['', 'Rollup check failed:'] + failures))
+        return 1
+    print('\nRollup check passed')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Search latency benchmark.
+
+Seeds a catalogue of synthetic books, builds the full-text index and times
+/api/search for text, prefix, ISBN and category queries. Exits non-zero if
+the p95 latency of any query type exceeds the budget, or if a query broader
+than SEARCH_MAX_CANDIDATES loses its best title match or any of its matches. Uses a throwaway
+SQLite database unless DATABASE_URL is set.
+
+    python -m benchmarks.search_benchmark --books 100000 --budget-ms 50
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+SYLLABLES = "ka ri mo te lu sa ven dor mi pla ton gre bel ash or nu fi kel zan ro".split()
+SURNAMES = "smith garcia chen okafor muller rossi tanaka novak silva kim".split()
+CATEGORIES = ['fiction', 'non-fiction', 'science', 'technology', 'business',
+              'self-help', 'biography', 'history', 'other']
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def make_vocabulary(rng, size=5000):
+    """Build a synthetic vocabulary of distinct pseudo-words"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def zipf_choice(rng, words):
+    """Pick a word with a Zipf-like skew, like natural-language text"""
+    return words[min(int(rng.paretovariate(1.0)) - 1, len(words) - 1)]
+
+def seed_books(db, Book, count, rng, words):
+    """Insert count synthetic books in bulk and return the ISBNs used"""
+    from sqlalchemy import insert
+    start = datetime(2020, 1, 1)
+    isbns = []
+    rows = []
+    for i in range(count):
+        isbn = f"978{i:010d}"
+        isbns.append(isbn)
+        rows.append({
+            'title': ' '.join(zipf_choice(rng, words).title() for _ in range(rng.randint(2, 5))),
+            'author': f"{rng.choice(words).title()} {rng.choice(SURNAMES).title()}",
+            'description': ' '.join(zipf_choice(rng, words) for _ in range(40)),
+            'publisher': f"{rng.choice(SURNAMES).title()} Press",
+            'year': rng.randint(1900, 2025),
+            'isbn': isbn,
+            'category': rng.choice(CATEGORIES),
+            'created_at': start + timedelta(minutes=i),
+            'updated_at': start + timedelta(minutes=i),
+        })
+        if len(rows) == 5000:
+            db.session.execute(insert(Book), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(Book), rows)
+    db.session.commit()
+    return isbns
+
+def match_count(db, term):
+    """Number of books /api/search matches for a one-word query, which is a prefix match"""
+    from sqlalchemy import text
+    if db.engine.dialect.name == 'postgresql':
+        sql = "SELECT count(*) FROM book WHERE search_vector @@ to_tsquery('simple', :term || ':*')"
+    else:
+        sql = "SELECT count(*) FROM book_fts WHERE book_fts MATCH '\"' || :term || '\"*'"
+    return db.session.execute(text(sql), {'term': term}).scalar()
+
+def check_results(app, db, Book, words, client):
+    """
+    Check a query broader than SEARCH_MAX_CANDIDATES: the oldest book, retitled
+    to the query word, must rank in the top 10, and paging must reach every match
+    exactly once with has_next false only on the last page.
+    Returns a list of failures.
+    """
+    from search import index_book
+    candidates = app.config['SEARCH_MAX_CANDIDATES']
+    with app.app_context():
+        word = next((word for word in words[20:500] if candidates < match_count(db, word) <= candidates * 3), None)
+        if word is None:
+            return [f"no word matches between {candidates} and {candidates * 3} books"]
+        oldest = Book.query.order_by(Book.id).first()
+        oldest.title = word.title()
+        index_book(oldest)
+        db.session.commit()
+        oldest_id, expected = oldest.id, match_count(db, word)
+
+    failures = []
+    seen = []
+    page = 1
+    while True:
+        data = client.get('/api/search', query_string={'q': word, 'page': page, 'per_page': 100}).get_json()
+        seen.extend(book['id'] for book in data['books'])
+        if page == 1 and oldest_id not in seen[:10]:
+            failures.append(f"'{word}': the oldest book, titled '{word.title()}', isn't in the top 10 results")
+        if not data['has_next'] or page > expected // 100 + 1:
+            break
+        page += 1
+    if len(seen) != expected or len(set(seen)) != expected:
+        failures.append(f"'{word}': paging returned {len(set(seen))} distinct of {len(seen)} results, expected {expected}")
+    rank = seen.index(oldest_id) + 1 if oldest_id in seen else None
+    print(f"'{word}' matches {expected} books over {page} pages; the oldest book, titled '{word.title()}', ranks {rank}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200, help='queries per query type')
+    parser.add_argument('--budget-ms', type=float, default=50.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        db_path = os.path.join(tempfile.mkdtemp(), 'search.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+
+    from app import app, db, register_routes
+    from models import Book
+    from schema import migrate
+    from search import reindex_all
+    register_routes()
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        migrate()
+        print(f"Seeding {args.books} books...")
+        started = time.perf_counter()
+        words = make_vocabulary(rng)
+        rng.shuffle(words)
+        isbns = seed_books(db, Book, args.books, rng, words)
+        reindex_all()
+        print(f"Seeded and indexed in {time.perf_counter() - started:.1f}s")
+
+    scenarios = {
+        'text': lambda: {'q': f"{zipf_choice(rng, words)} {zipf_choice(rng, words)}"},
+        'prefix': lambda: {'q': zipf_choice(rng, words)[:4]},
+        'author': lambda: {'q': rng.choice(SURNAMES)},
+        'text+category': lambda: {'q': zipf_choice(rng, words), 'category': rng.choice(CATEGORIES)},
+        'isbn': lambda: {'q': rng.choice(isbns)},
+        'category': lambda: {'category': rng.choice(CATEGORIES), 'page': rng.randint(1, 20)},
+    }
+
+    client = app.test_client()
+    failures = check_results(app, db, Book, words, client)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    failed = bool(failures)
+    print(f"{'query':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, make_params in scenarios.items():
+        timings = []
+        for _ in range(args.queries):
+            params = make_params()
+            started = time.perf_counter()
+            response = client.get('/api/search', query_string=params)
+            timings.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.data
+        p95 = percentile(timings, 95)
+        print(f"{name:<16}{percentile(timings, 50):>10.2f}{p95:>10.2f}{percentile(timings, 99):>10.2f}")
+        failed = failed or p95 > args.budget_ms
+
+    if failed:
+        print(f"FAIL: broad query results or p95 above {args.budget_ms} ms budget")
+        return 1
+    print(f"OK: broad query results complete and every query type within {args.budget_ms} ms at p95")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
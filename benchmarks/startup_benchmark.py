@@ -0,0 +1,104 @@
+"""
+Startup time benchmark.
+
+Measures, over several runs in fresh interpreters:
+- app import: configuring the app, as scripts and background jobs do
+- web import: the app plus every view, as the gunicorn master does
+- worker fork: forking a preloaded master until the child has served its
+  first request, as gunicorn does when scaling out or recycling workers
+
+Importing the app must not touch the database, so the import runs point
+DATABASE_URL at a database that can't be opened. Exits non-zero if a median
+goes over its budget.
+
+    python -m benchmarks.startup_benchmark --runs 10
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Opening this fails, so any database access during import shows up as an error
+UNREACHABLE_DATABASE_URL = 'sqlite:////nonexistent-startup-benchmark/library.db'
+
+IMPORT_SCRIPT = """
+import time, json
+started = time.perf_counter()
+import {module}
+print(json.dumps({{'ms': (time.perf_counter() - started) * 1000}}))
+"""
+
+FORK_SCRIPT = """
+import os, time, json
+import main
+from app import app, db
+
+results = []
+for _ in range({forks}):
+    read_fd, write_fd = os.pipe()
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        # What gunicorn's post_fork hook and a worker's first request do
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+        app.test_client().get('/startup-benchmark-probe')
+        os.write(write_fd, b'x')
+        os._exit(0)
+    os.read(read_fd, 1)
+    results.append((time.perf_counter() - started) * 1000)
+    os.waitpid(pid, 0)
+    os.close(read_fd)
+    os.close(write_fd)
+print(json.dumps({{'ms': results}}))
+"""
+
+def run_python(script, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    completed = subprocess.run(
+        [sys.executable, '-c', script], cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else 'failed')
+    return json.loads(completed.stdout.strip().splitlines()[-1])['ms']
+
+def summarize(name, samples, budget):
+    median = statistics.median(samples)
+    status = 'ok' if median <= budget else 'OVER BUDGET'
+    print(f"{name:<14}{median:>10.1f}{max(samples):>10.1f}{budget:>10.0f}  {status}")
+    return median <= budget
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--forks', type=int, default=10, help='workers forked per run')
+    parser.add_argument('--app-budget-ms', type=float, default=750.0)
+    parser.add_argument('--web-budget-ms', type=float, default=1500.0)
+    parser.add_argument('--fork-budget-ms', type=float, default=100.0)
+    args = parser.parse_args()
+
+    app_samples, web_samples, fork_samples = [], [], []
+    for _ in range(args.runs):
+        try:
+            app_samples.append(run_python(IMPORT_SCRIPT.format(module='app'), UNREACHABLE_DATABASE_URL))
+            web_samples.append(run_python(IMPORT_SCRIPT.format(module='main'), UNREACHABLE_DATABASE_URL))
+        except RuntimeError as e:
+            print(f"Import failed without a database: {e}")
+            return 1
+        if hasattr(os, 'fork'):
+            fork_samples.extend(run_python(FORK_SCRIPT.format(forks=args.forks), UNREACHABLE_DATABASE_URL))
+
+    print(f"{'step':<14}{'median ms':>10}{'max ms':>10}{'budget':>10}")
+    ok = summarize('app import', app_samples, args.app_budget_ms)
+    ok = summarize('web import', web_samples, args.web_budget_ms) and ok
+    if fork_samples:
+        ok = summarize('worker fork', fork_samples, args.fork_budget_ms) and ok
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Benchmark suite for the main request paths.
+
+Runs scripted scenarios in-process through the Flask test client, so it
+needs no server or network, and reports latency percentiles, throughput
+and SQL statements per request for each one. Results are saved as JSON;
+pass an earlier results file with --compare to fail on regressions.
+
+    python -m benchmarks.suite --generate --books 1000 --events 200000 --output results/base.json
+    python -m benchmarks.suite --output results/new.json --compare results/base.json
+
+Uses a throwaway SQLite database unless DATABASE_URL is set, e.g. to a
+local PostgreSQL database. --generate resets that database and fills it
+with benchmarks.generate_data first.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+SCENARIOS = ('index', 'book_detail', 'download_book', 'track', 'admin_analytics')
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+def build_requests(db):
+    """Return {scenario: function(client, rng) -> response} for the current database"""
+    from models import Book, BookAnalytics
+
+    # Requests follow popularity, so hot books get most of the traffic as in production
+    rows = db.session.query(Book.id, Book.file_path, BookAnalytics.view_count).outerjoin(
+        BookAnalytics, BookAnalytics.book_id == Book.id).all()
+    if not rows:
+        raise RuntimeError("The database has no books; run with --generate")
+    book_ids = [book_id for book_id, _, _ in rows]
+    weights = [(views or 0) + 1 for _, _, views in rows]
+    file_ids = [book_id for book_id, file_path, _ in rows if file_path]
+    file_weights = [(views or 0) + 1 for _, file_path, views in rows if file_path]
+
+    def index(client, rng):
+        return client.get('/')
+
+    def book_detail(client, rng):
+        return client.get(f"/book/{rng.choices(book_ids, weights)[0]}")
+
+    def download_book(client, rng):
+        return client.get(f"/book/{rng.choices(file_ids, file_weights)[0]}/download")
+
+    def track(client, rng):
+        return client.post('/api/track', json={
+            'book_id': rng.choices(book_ids, weights)[0],
+            'event_type': rng.choices(('view', 'download', 'share'), (90, 8, 2))[0],
+        }, environ_base={'REMOTE_ADDR': f'10.9.{rng.randrange(256)}.{rng.randrange(1, 255)}'},
+           headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) benchmark-suite'})
+
+    def admin_analytics(client, rng):
+        return client.get('/admin/analytics')
+
+    scenarios = {
+        'index': index,
+        'book_detail': book_detail,
+        'track': track,
+        'admin_analytics': admin_analytics,
+    }
+    if file_ids:
+        scenarios['download_book'] = download_book
+    return scenarios
+
+def run_scenario(app, make_request, requests, concurrency, seed, session_id):
+    """Send requests spread over concurrency threads; return the scenario's statistics"""
+    latencies, statements, errors = [], [], []
+    lock = threading.Lock()
+    per_thread = max(requests // concurrency, 1)
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        client = app.test_client()
+        if session_id:
+            with client.session_transaction() as session:
+                session['_user_id'] = session_id
+                session['_fresh'] = True
+        local_latencies, local_statements, local_errors = [], [], 0
+        for _ in range(per_thread):
+            started = time.perf_counter()
+            response = make_request(client, rng)
+            response.get_data()
+            local_latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                local_errors += 1
+            if 'X-Query-Count' in response.headers:
+                local_statements.append(int(response.headers['X-Query-Count']))
+            response.close()
+        with lock:
+            latencies.extend(local_latencies)
+            statements.extend(local_statements)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'sql_median': percentile(statements, 50),
+        'sql_max': max(statements, default=0),
+    }
+
+def compare(baseline, results, tolerance, min_ms):
+    """
+    Return the regressions of results against a baseline run: p95 latency
+    or throughput worse by more than tolerance (and p95 by at least
+    min_ms), or more SQL statements per request
+    """
+    problems = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance) and result['p95_ms'] - base['p95_ms'] >= min_ms:
+            problems.append(f"{name}: p95 {base['p95_ms']} ms -> {result['p95_ms']} ms")
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            problems.append(f"{name}: throughput {base['rps']} -> {result['rps']} req/s")
+        if result['sql_max'] > base['sql_max']:
+            problems.append(f"{name}: SQL statements per request {base['sql_max']} -> {result['sql_max']}")
+        if result['errors'] > base['errors']:
+            problems.append(f"{name}: errors {base['errors']} -> {result['errors']}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--page-cache', action='store_true', help='keep the page cache on (default off)')
+    parser.add_argument('--generate', action='store_true', help='reset the database and generate data first')
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='results file of an earlier run to check against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore p95 slowdowns smaller than this')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'suite.db')}"
+        args.generate = True
+    if not args.page_cache:
+        # Cached pages would hide the queries being measured
+        os.environ['PAGE_CACHE_BACKEND'] = 'none'
+    # Measure the endpoints, not the limiter turning the benchmark away
+    os.environ['RATE_LIMIT_BACKEND'] = 'none'
+
+    from app import app, db, register_routes
+    register_routes()
+    app.config.update(TESTING=True, SQL_QUERY_BUDGET=0)
+    from sqlalchemy import func
+    from models import Book, ClickEvent, User
+    from schema import migrate
+    from auth_cache import SessionUser
+    from analytics_buffer import analytics_buffer
+    from benchmarks.generate_data import ADMIN_USERNAME, generate, reset
+
+    with app.app_context():
+        if args.generate:
+            started = time.perf_counter()
+            reset(db)
+            dataset = generate(args.books, args.events, args.days, args.seed)
+            print(f"Generated {args.books} books and {args.events} events in {time.perf_counter() - started:.1f}s")
+        else:
+            migrate()
+            dataset = {
+                'books': Book.query.count(),
+                'events': db.session.query(func.count(ClickEvent.id)).scalar(),
+                'database': db.engine.dialect.name,
+            }
+        admin = User.query.filter_by(username=ADMIN_USERNAME).first() or User.query.filter_by(is_admin=True).first()
+        session_id = SessionUser(admin).get_id() if admin else None
+        scenarios = build_requests(db)
+        db.session.remove()
+
+    results = {}
+    print(f"{'scenario':<18}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'SQL':>6}")
+    for name in args.scenarios.split(','):
+        if name not in scenarios:
+            print(f"{name:<18}skipped")
+            continue
+        needs_admin = name == 'admin_analytics'
+        if needs_admin and session_id is None:
+            print(f"{name:<18}skipped (no admin user)")
+            continue
+        run_scenario(app, scenarios[name], args.warmup, 1, args.seed, session_id if needs_admin else None)
+        result = run_scenario(app, scenarios[name], args.requests, args.concurrency, args.seed,
+                              session_id if needs_admin else None)
+        results[name] = result
+        print(f"{name:<18}{result['requests']:>9}{result['errors']:>8}{result['rps']:>9.1f}{result['p50_ms']:>9.2f}"
+              f"{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['sql_max']:>6}")
+    analytics_buffer.stop()
+
+    report = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'page_cache': args.page_cache,
+            'dataset': dataset,
+        },
+        'results': results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        base_dataset = baseline['meta'].get('dataset', {})
+        for key in ('books', 'database'):
+            if key in base_dataset and base_dataset[key] != dataset.get(key):
+                print(f"Note: the baseline ran with {key}={base_dataset[key]}, this run with {key}={dataset.get(key)}")
+        problems = compare(baseline, results, args.tolerance, args.min_ms)
+        if problems:
+            print(f"Regressions against {args.compare} ({baseline['meta'].get('git_commit')}):")
+            for problem in problems:
+                print(f"  {problem}")
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
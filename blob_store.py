@@ -0,0 +1,153 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+from sqlalchemy import delete
+from werkzeug.utils import secure_filename
+from app import app, db
+from models import Blob, Book
+import metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+def blob_path(sha256, subfolder, extension):
+    """Path of a blob relative to the static folder"""
+    return os.path.join('uploads', subfolder, sha256[:2], f"{sha256}{extension}")
+
+def stage_upload(file, subfolder):
+    """
+    Save an upload as-is under the staging folder, without hashing it, so
+    the request can return quickly. finalize_staged moves it into the
+    store later. Returns the path relative to the static folder, which
+    can be served until then.
+    """
+    extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+    relative_dir = os.path.join('uploads', 'staging', subfolder)
+    os.makedirs(os.path.join('static', relative_dir), exist_ok=True)
+    relative_path = os.path.join(relative_dir, f"{uuid.uuid4().hex}{extension}")
+    full_path = os.path.join('static', relative_path)
+
+    size = 0
+    try:
+        with open(f"{full_path}.tmp", 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                out.write(chunk)
+                size += len(chunk)
+        os.replace(f"{full_path}.tmp", full_path)
+    except Exception:
+        if os.path.exists(f"{full_path}.tmp"):
+            os.remove(f"{full_path}.tmp")
+        raise
+
+    metrics.upload_bytes.inc(size, kind=subfolder)
+    return relative_path
+
+def is_staged(file_path):
+    return bool(file_path) and file_path.startswith(os.path.join('uploads', 'staging', ''))
+
+def finalize_staged(staged_path, subfolder):
+    """
+    Hash a staged upload and link it into the store under its content
+    hash, leaving the staged file in place for the caller to remove once
+    nothing serves it. Doesn't add a reference; the caller acquires the
+    blob in the transaction that points a book at it.
+    Returns (blob path, sha256, size), or None if the staged file is gone.
+    """
+    full_path = os.path.join('static', staged_path)
+    if not os.path.exists(full_path):
+        return None
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+
+    sha256 = digest.hexdigest()
+    relative_path = blob_path(sha256, subfolder, os.path.splitext(staged_path)[1])
+    final_path = os.path.join('static', relative_path)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    if os.path.exists(final_path):
+        # Refresh the mtime so garbage collection's grace period covers the reuse
+        os.utime(final_path)
+    else:
+        # A hard link is instant and atomic; copy where the filesystem has none
+        try:
+            os.link(full_path, f"{final_path}.tmp")
+        except OSError:
+            shutil.copyfile(full_path, f"{final_path}.tmp")
+        os.replace(f"{final_path}.tmp", final_path)
+    return relative_path, sha256, size
+
+def release(file_path):
+    """
+    Drop a reference to a stored file. Files saved before the blob store
+    existed have no Blob row and are deleted right away; blobs are left
+    for collect_garbage once nothing references them.
+    """
+    if Blob.release(file_path):
+        return True
+
+    full_path = os.path.join('static', file_path)
+    if os.path.exists(full_path):
+        os.remove(full_path)
+        return True
+    return False
+
+def collect_garbage(grace_minutes=60, dry_run=False):
+    """
+    Delete blobs with no references, and files under the upload folder that
+    no Blob or Book points at. Files younger than grace_minutes are kept so
+    uploads still in flight aren't removed. Returns the number of files removed.
+    """
+    removed = 0
+    cutoff = time.time() - grace_minutes * 60
+
+    for blob in Blob.query.filter(Blob.ref_count <= 0).all():
+        full_path = os.path.join('static', blob.path)
+        if os.path.exists(full_path) and os.path.getmtime(full_path) > cutoff:
+            continue
+        if not dry_run:
+            # Re-check the count in the DELETE in case an upload reused the blob meanwhile
+            result = db.session.execute(delete(Blob).where(Blob.id == blob.id, Blob.ref_count <= 0))
+            db.session.commit()
+            if not result.rowcount:
+                continue
+            if os.path.exists(full_path):
+                os.remove(full_path)
+        app.logger.info(f"Removed unreferenced blob {blob.path}")
+        removed += 1
+
+    known = {path for (path,) in db.session.query(Blob.path)}
+    known.update(path for (path,) in db.session.query(Book.cover_path).filter(Book.cover_path.isnot(None)))
+    known.update(path for (path,) in db.session.query(Book.file_path).filter(Book.file_path.isnot(None)))
+    # Resized covers generated by thumbnails.py
+    for (variants,) in db.session.query(Book.cover_variants).filter(Book.cover_variants.isnot(None)):
+        known.update(path for formats in variants.values() for path in formats.values())
+
+    for root, _, files in os.walk(app.config['UPLOAD_FOLDER']):
+        for name in files:
+            full_path = os.path.join(root, name)
+            relative_path = os.path.relpath(full_path, 'static')
+            if relative_path in known or os.path.getmtime(full_path) > cutoff:
+                continue
+            app.logger.info(f"Removing orphaned file {relative_path}")
+            if not dry_run:
+                os.remove(full_path)
+            removed += 1
+    return removed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content-addressed upload storage")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    gc_parser = subparsers.add_parser("gc", help="Remove unreferenced and orphaned upload files")
+    gc_parser.add_argument("--grace-minutes", type=int, default=60)
+    gc_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    with app.app_context():
+        removed = collect_garbage(args.grace_minutes, args.dry_run)
+        print(f"{'Would remove' if args.dry_run else 'Removed'} {removed} files.")
@@ -0,0 +1,207 @@
+import csv
+import sys
+import gzip
+import json
+import time
+import argparse
+from datetime import datetime
+from sqlalchemy import insert, update, select
+from werkzeug.datastructures import MultiDict
+from app import app, db
+from models import Book, BookAnalytics
+from forms import BookMetadataForm
+from search import index_books
+import page_cache
+
+# Book columns read from and written to catalogue files
+BOOK_FIELDS = ['title', 'author', 'description', 'book_url', 'publisher', 'year', 'isbn', 'category']
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+def _format(path, file_format):
+    if file_format:
+        return file_format
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'jsonl'
+
+def read_records(path, file_format=None):
+    """
+    Yield (line number, record dict) from a CSV or JSONL file one row at a
+    time. A JSONL line that doesn't parse is yielded as its text, which
+    validate_record reports as invalid like any other bad row.
+    """
+    f = _open(path, 'r')
+    try:
+        if _format(path, file_format) == 'csv':
+            for line_number, row in enumerate(csv.DictReader(f), start=2):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError:
+                        yield line_number, line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def validate_record(record):
+    """
+    Check a record against the same rules as the admin book form.
+    Returns (values, errors).
+    """
+    if not isinstance(record, dict):
+        return None, {'record': ['Not a JSON object']}
+    formdata = MultiDict({
+        field: '' if record.get(field) is None else str(record[field]).strip()
+        for field in BOOK_FIELDS
+    })
+    form = BookMetadataForm(formdata=formdata)
+    if not form.validate():
+        return None, form.errors
+    values = {field: form[field].data for field in BOOK_FIELDS}
+    # Keep empty optional text fields as NULL, like a fresh form submission
+    for field in ('description', 'book_url', 'publisher', 'isbn'):
+        values[field] = values[field] or None
+    return values, None
+
+def _write_batch(batch):
+    """
+    Insert or update one batch of validated books in a single transaction.
+    Books whose ISBN already exists are updated; the rest are inserted in
+    bulk together with their BookAnalytics rows. Returns (inserted, updated).
+    """
+    # The last record wins when a batch repeats an ISBN
+    by_isbn = {}
+    without_isbn = []
+    for values in batch:
+        if values['isbn']:
+            by_isbn[values['isbn']] = values
+        else:
+            without_isbn.append(values)
+
+    existing = dict(db.session.execute(
+        select(Book.isbn, Book.id).where(Book.isbn.in_(list(by_isbn)))
+    ).all()) if by_isbn else {}
+
+    now = datetime.utcnow()
+    updates = [dict(values, id=existing[isbn], updated_at=now) for isbn, values in by_isbn.items() if isbn in existing]
+    inserts = [dict(values, created_at=now, updated_at=now)
+               for values in without_isbn + [v for isbn, v in by_isbn.items() if isbn not in existing]]
+
+    new_ids = []
+    if inserts:
+        new_ids = list(db.session.execute(insert(Book).returning(Book.id), inserts).scalars())
+        db.session.execute(insert(BookAnalytics), [
+            {'book_id': book_id, 'view_count': 0, 'download_count': 0, 'share_count': 0,
+             'created_at': now, 'updated_at': now}
+            for book_id in new_ids
+        ])
+    if updates:
+        db.session.execute(update(Book), updates)
+
+    index_books(new_ids + [values['id'] for values in updates])
+    db.session.commit()
+
+    for values in updates:
+        page_cache.invalidate(f"book:{values['id']}")
+    return len(inserts), len(updates)
+
+def import_catalogue(path, file_format=None, batch_size=1000, dry_run=False, max_errors=20):
+    """Stream books from a CSV or JSONL file into the database in batches"""
+    started = time.perf_counter()
+    stats = {'read': 0, 'inserted': 0, 'updated': 0, 'invalid': 0}
+    batch = []
+
+    def flush():
+        if batch and not dry_run:
+            inserted, updated = _write_batch(batch)
+            stats['inserted'] += inserted
+            stats['updated'] += updated
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        print(f"  {stats['read']} read, {stats['inserted']} inserted, {stats['updated']} updated, "
+              f"{stats['invalid']} invalid ({stats['read'] / elapsed:.0f} rows/s)")
+
+    for line_number, record in read_records(path, file_format):
+        stats['read'] += 1
+        values, errors = validate_record(record)
+        if errors:
+            stats['invalid'] += 1
+            if stats['invalid'] <= max_errors:
+                print(f"Line {line_number}: {errors}")
+            continue
+        batch.append(values)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    if stats['inserted'] or stats['updated']:
+        page_cache.invalidate('catalogue')
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+def export_catalogue(path, file_format=None, batch_size=1000):
+    """
+    Stream every book to a CSV or JSONL file. Rows are fetched through a
+    server-side cursor in batches, so memory use doesn't grow with the catalogue.
+    """
+    started = time.perf_counter()
+    columns = [getattr(Book, field) for field in BOOK_FIELDS]
+    result = db.session.execute(
+        select(Book.id, *columns).order_by(Book.id).execution_options(stream_results=True, yield_per=batch_size)
+    )
+
+    count = 0
+    f = _open(path, 'w')
+    try:
+        if _format(path, file_format) == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(['id'] + BOOK_FIELDS)
+            for row in result:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in result:
+                f.write(json.dumps(dict(zip(['id'] + BOOK_FIELDS, row))) + '\n')
+                count += 1
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Exported {count} books in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)", file=sys.stderr)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk catalogue import and export")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Import books from a CSV or JSONL file (- for stdin)")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--dry-run", action="store_true", help="validate without writing")
+
+    export_parser = subparsers.add_parser("export", help="Export books to a CSV or JSONL file (- for stdout)")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the file extension")
+    export_parser.add_argument("--batch-size", type=int, default=1000)
+
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.action == "import":
+            stats = import_catalogue(args.path, args.format, args.batch_size, args.dry_run)
+            print(f"Import completed: {stats['inserted']} inserted, {stats['updated']} updated, "
+                  f"{stats['invalid']} invalid in {stats['seconds']:.1f}s "
+                  f"({stats['read'] / stats['seconds'] if stats['seconds'] else 0:.0f} rows/s)")
+        else:
+            export_catalogue(args.path, args.format, args.batch_size)
@@ -0,0 +1,34 @@
+import time
+import threading
+from sqlalchemy.pool import QueuePool
+
+# Callables given the seconds each checkout waited for a connection
+checkout_observers = []
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a free connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self._waits = [0, 0.0, 0.0]  # checkouts, total and longest wait since take_wait_stats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            with self._wait_lock:
+                self._waits[0] += 1
+                self._waits[1] += waited
+                self._waits[2] = max(self._waits[2], waited)
+            for observer in checkout_observers:
+                observer(waited)
+
+    def take_wait_stats(self):
+        """Return (checkouts, total wait, longest wait) since the last call and start counting again"""
+        with self._wait_lock:
+            stats = tuple(self._waits)
+            self._waits = [0, 0.0, 0.0]
+        return stats
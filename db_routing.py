@@ -0,0 +1,89 @@
+import time
+import threading
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.sql.expression import SelectBase
+from flask import current_app, g, session, has_app_context
+from flask_sqlalchemy.session import Session
+from flask_login import current_user
+
+# SQLALCHEMY_BINDS key of the read replica engine
+REPLICA_BIND = 'replica'
+
+# Client session key holding the time until which the user reads from the primary
+PRIMARY_UNTIL_KEY = '_db_primary_until'
+
+class RoutingSession(Session):
+    """
+    Session that sends SELECTs, including text().columns() ones, to the
+    read replica in views marked with replica_reads. Writes, SELECT ... FOR
+    UPDATE and every statement after this session's first write go to the
+    primary, so a request always reads what it wrote.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if isinstance(clause, SelectBase) and getattr(clause, '_for_update_arg', None) is None:
+                if not self.info.get('wrote') and has_app_context() and g.get('db_replica'):
+                    return self._db.engines[REPLICA_BIND]
+            else:
+                # Flushes come without a clause; anything that isn't a SELECT counts as a write
+                self.info['wrote'] = True
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _note_commit(db_session):
+    if db_session.info.get('wrote') and has_app_context():
+        g.db_committed = True
+
+def replica_reads(view):
+    """
+    Route a read-only view's queries to the read replica, if one is
+    configured, unless this user committed a change in the last
+    DB_READ_YOUR_WRITES_SECONDS
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_app.config['DATABASE_REPLICA_URL'] and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time():
+            g.db_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def use_primary():
+    """Send the rest of this request's reads to the primary"""
+    g.pop('db_replica', None)
+
+def _log_pools(app):
+    with app.app_context():
+        engines = dict(app.extensions['sqlalchemy'].engines)
+    for name, engine in engines.items():
+        pool = engine.pool
+        if not hasattr(pool, 'take_wait_stats'):
+            continue
+        checkouts, total_wait, max_wait = pool.take_wait_stats()
+        app.logger.info(
+            f"DB pool {name or 'primary'}: {pool.checkedout()} in use, {pool.checkedin()} idle, "
+            f"{max(pool.overflow(), 0)} overflow of {pool.size()}+{pool._max_overflow}; "
+            f"{checkouts} checkouts, wait avg {total_wait / checkouts * 1000 if checkouts else 0:.1f} ms, "
+            f"max {max_wait * 1000:.1f} ms"
+        )
+
+def init_app(app):
+    """Register read-your-writes tracking and periodic pool statistics logging"""
+    next_log = [time.monotonic() + app.config['DB_POOL_LOG_INTERVAL']]
+    log_lock = threading.Lock()
+
+    @app.after_request
+    def _after_request(response):
+        # Only logged-in users edit content; anonymous writes such as view counts don't pin a client
+        if g.pop('db_committed', False) and app.config['DATABASE_REPLICA_URL'] and current_user.is_authenticated:
+            # Give the replica time to catch up before this user reads from it again
+            session[PRIMARY_UNTIL_KEY] = time.time() + app.config['DB_READ_YOUR_WRITES_SECONDS']
+        interval = app.config['DB_POOL_LOG_INTERVAL']
+        if interval and time.monotonic() >= next_log[0] and log_lock.acquire(blocking=False):
+            try:
+                next_log[0] = time.monotonic() + interval
+                _log_pools(app)
+            finally:
+                log_lock.release()
+        return response
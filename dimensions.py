@@ -0,0 +1,161 @@
+import threading
+from sqlalchemy import select, insert, func, text
+from app import app, db
+from models import ClickEvent, EventType, UserAgent, Referrer, _pack_ip, _upsert_insert
+
+# Arbitrary key for the PostgreSQL advisory lock that orders click event inserts
+CLICK_EVENT_LOCK_KEY = 724312
+
+class Dimension:
+    """
+    Values of a lookup table, such as user agents, interned to integer ids.
+    Ids never change once assigned, so each worker caches them without
+    invalidation; the cache is emptied when it reaches max_entries.
+    """
+
+    def __init__(self, column, max_entries):
+        self.table = column.table
+        self.column = column
+        self.max_entries = max_entries
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def cached(self, values):
+        """Return ({value: id} for the cached values, set of values that need loading)"""
+        wanted = {value for value in values if value is not None}
+        found = {}
+        for value in wanted:
+            value_id = self._ids.get(value)
+            if value_id is not None:
+                found[value] = value_id
+        missing = wanted - found.keys()
+        self._stats['hits'] += len(found)
+        self._stats['misses'] += len(missing)
+        return found, missing
+
+    def load(self, conn, values):
+        """Look up values on conn, adding the new ones, and cache their ids"""
+        query = select(self.column, self.table.c.id).where(self.column.in_(values))
+        rows = dict(conn.execute(query).all())
+        new = [value for value in values if value not in rows]
+        if new:
+            upsert = _upsert_insert()
+            if upsert is not None:
+                stmt = upsert(self.table).values([{self.column.name: value} for value in new])
+                stmt = stmt.on_conflict_do_nothing(index_elements=[self.column.name])
+                rows.update(conn.execute(stmt.returning(self.column, self.table.c.id)).all())
+            else:
+                conn.execute(insert(self.table), [{self.column.name: value} for value in new])
+            if len(rows) < len(values):
+                # Added by another worker since the lookup
+                rows.update(conn.execute(query).all())
+        with self._lock:
+            if len(self._ids) + len(rows) > self.max_entries:
+                self._ids.clear()
+            self._ids.update(rows)
+        return rows
+
+    def ids(self, values):
+        """Return {value: id} for the values, adding new ones to the table"""
+        return resolve_ids([(self, values)])[0]
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['entries'] = len(self._ids)
+        return stats
+
+event_types = Dimension(EventType.__table__.c.name, 1000)
+user_agents = Dimension(UserAgent.__table__.c.value, app.config['ANALYTICS_DIMENSION_CACHE_SIZE'])
+referrers = Dimension(Referrer.__table__.c.value, app.config['ANALYTICS_DIMENSION_CACHE_SIZE'])
+
+def resolve_ids(requests):
+    """
+    Return a {value: id} dict for each (dimension, values) pair. Values
+    missing from the caches are loaded together in one transaction,
+    committed on its own connection so ids stay valid if the caller's
+    transaction rolls back. Callers must not hold an open write
+    transaction on SQLite, which would block this one.
+    """
+    results, pending = [], []
+    for dimension, values in requests:
+        found, missing = dimension.cached(values)
+        results.append(found)
+        if missing:
+            pending.append((found, dimension, missing))
+    if pending:
+        with db.engine.begin() as conn:
+            for found, dimension, missing in pending:
+                found.update(dimension.load(conn, missing))
+    return results
+
+def click_event_rows(events):
+    """
+    ClickEvent rows for analytics event dicts (book_id, event_type,
+    user_agent, ip_address, referrer, timestamp), with their strings interned
+    """
+    type_ids, user_agent_ids, referrer_ids = resolve_ids([
+        (event_types, [event['event_type'] for event in events]),
+        (user_agents, [event.get('user_agent') for event in events]),
+        (referrers, [event.get('referrer') for event in events]),
+    ])
+    return [{
+        'book_id': event['book_id'],
+        'event_type_id': type_ids[event['event_type']],
+        'user_agent_id': user_agent_ids.get(event.get('user_agent')),
+        'ip_address': event.get('ip_address'),
+        'referrer_id': referrer_ids.get(event.get('referrer')),
+        'timestamp': event['timestamp'],
+    } for event in events]
+
+def insert_click_events(rows):
+    """
+    Insert click_event_rows() in the session's transaction. On SQLite the
+    rows go straight to the driver with IPs packed and timestamps in
+    SQLAlchemy's storage format, which skips its per-row parameter
+    processing; elsewhere a Core insert batches them.
+
+    Writers take turns from this insert until they commit, so ids become
+    visible in order; see committed_click_event_id. SQLite already allows
+    one writer at a time.
+    """
+    conn = db.session.connection()
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CLICK_EVENT_LOCK_KEY})
+        conn.execute(insert(ClickEvent.__table__), rows)
+        return
+    conn.exec_driver_sql(SQLITE_INSERT, [(
+        row['book_id'],
+        row['event_type_id'],
+        row['user_agent_id'],
+        _pack_ip(row['ip_address']) if row['ip_address'] else None,
+        row['referrer_id'],
+        row['timestamp'].isoformat(' ', 'microseconds'),
+    ) for row in rows])
+
+def committed_click_event_id():
+    """
+    Highest click event id this session can see. insert_click_events
+    commits ids in order, so no event at or below it can appear later and
+    readers can follow click events by id without missing late commits.
+    """
+    return db.session.scalar(select(func.max(ClickEvent.id))) or 0
+
+SQLITE_INSERT = (
+    "INSERT INTO click_event (book_id, event_type_id, user_agent_id, ip_address, referrer_id, timestamp) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+def select_click_events():
+    """Select ClickEvent rows with their interned values joined back in as text"""
+    return select(
+        ClickEvent.id,
+        ClickEvent.book_id,
+        EventType.name.label('event_type'),
+        UserAgent.value.label('user_agent'),
+        ClickEvent.ip_address,
+        Referrer.value.label('referrer'),
+        ClickEvent.timestamp,
+    ).join(EventType, EventType.id == ClickEvent.event_type_id).outerjoin(
+        UserAgent, UserAgent.id == ClickEvent.user_agent_id
+    ).outerjoin(Referrer, Referrer.id == ClickEvent.referrer_id)
@@ -0,0 +1,124 @@
+import os
+import re
+import hashlib
+import mimetypes
+import threading
+import unicodedata
+from urllib.parse import quote
+from datetime import datetime, timezone
+from flask import request, send_file, abort, make_response
+from app import app
+import metrics
+
+# Content hashes keyed by (path, size, mtime) so a changed file is rehashed
+_etag_cache = {}
+_etag_lock = threading.Lock()
+
+# Blob store file names are already the content's SHA-256
+BLOB_NAME_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Characters that aren't allowed in a file name on common systems
+UNSAFE_FILENAME_CHARS = re.compile(r'[\x00-\x1f\x7f/\\:*?"<>|]+')
+
+def download_filename(title, file_path):
+    """
+    Name to save a book download as: its title, non-ASCII letters included,
+    with the stored file's extension, or the stored file's own name if
+    nothing usable is left of the title
+    """
+    stem = ' '.join(UNSAFE_FILENAME_CHARS.sub(' ', title or '').split()).strip('. ')
+    if not stem:
+        return os.path.basename(file_path)
+    return stem + os.path.splitext(file_path)[1]
+
+def _disposition_params(download_name):
+    # As send_file does: an ASCII filename plus an RFC 5987 filename* for anything else
+    try:
+        download_name.encode('ascii')
+        return {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+
+def file_etag(path):
+    """
+    Return the SHA-256 of a file's content, hashing it in chunks the first
+    time and caching the result until the file changes
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if BLOB_NAME_PATTERN.match(stem):
+        return stem
+
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _etag_lock:
+        etag = _etag_cache.get(key)
+    if etag:
+        return etag
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+
+    with _etag_lock:
+        if len(_etag_cache) >= app.config['DOWNLOAD_ETAG_CACHE_SIZE']:
+            _etag_cache.clear()
+        _etag_cache[key] = etag
+    return etag
+
+def send_book_file(file_path, download_name=None):
+    """
+    Send a stored book file, given its path relative to the static folder.
+    Range requests get 206 responses and If-None-Match / If-Modified-Since
+    get 304s. With DOWNLOAD_OFFLOAD set to 'x-accel' the body is left to a
+    front proxy via X-Accel-Redirect; with 'x-sendfile' Flask emits
+    X-Sendfile instead.
+    """
+    full_path = os.path.join('static', file_path)
+    if not os.path.isfile(full_path):
+        abort(404)
+
+    download_name = download_name or os.path.basename(file_path)
+    etag = file_etag(full_path)
+    last_modified = datetime.fromtimestamp(os.path.getmtime(full_path), tz=timezone.utc)
+
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel':
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + file_path
+        response.headers['Content-Type'] = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        response.headers.set('Content-Disposition', 'attachment', **_disposition_params(download_name))
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.max_age = app.config['DOWNLOAD_MAX_AGE']
+        # Answer conditional requests here; the proxy only serves the body
+        response = response.make_conditional(request)
+        if response.status_code == 200:
+            metrics.download_bytes.inc(os.path.getsize(full_path), mode='offload')
+        return response
+
+    response = send_file(
+        os.path.abspath(full_path),
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=etag,
+        last_modified=last_modified,
+        max_age=app.config['DOWNLOAD_MAX_AGE']
+    )
+    if response.status_code in (200, 206):
+        mode = 'offload' if app.config['USE_X_SENDFILE'] else 'app'
+        metrics.download_bytes.inc(response.content_length or 0, mode=mode)
+    return response
+
+def is_new_download(response):
+    """
+    Return True if a download response starts a new transfer, so resumed
+    range requests and 304s aren't counted as extra downloads
+    """
+    if request.method != 'GET' or response.status_code not in (200, 206):
+        return False
+    if request.range and request.range.ranges:
+        return request.range.ranges[0][0] == 0
+    return True
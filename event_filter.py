@@ -0,0 +1,85 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from app import app
+
+# User agent fragments of crawlers, link previewers, monitors and scripted clients
+BOT_SIGNATURES = [
+    r'\bbot\b', r'bot/', r'bot-', r'crawl', r'spider', r'slurp', r'archiver', r'scrap',
+    r'facebookexternalhit', r'embedly', r'preview', r'whatsapp',
+    r'headless', r'phantomjs', r'selenium', r'puppeteer', r'playwright', r'lighthouse',
+    r'pingdom', r'uptime', r'monitor', r'statuscake', r'datadog', r'newrelic',
+    r'curl/', r'wget/', r'python-requests', r'python-urllib', r'aiohttp', r'httpx',
+    r'go-http-client', r'java/', r'okhttp', r'libwww-perl', r'node-fetch', r'axios/',
+]
+BOT_PATTERN = re.compile('|'.join(BOT_SIGNATURES), re.IGNORECASE)
+
+def is_bot(user_agent):
+    """True for a missing user agent or one matching a known bot signature"""
+    return not user_agent or BOT_PATTERN.search(user_agent) is not None
+
+class RecentKeys:
+    """
+    Keys seen in the last ttl seconds, holding at most max_entries.
+    The oldest keys are forgotten first when the limit is reached.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._expiry = OrderedDict()  # key -> expires_at, oldest first
+        self._lock = threading.Lock()
+
+    def check_and_add(self, key):
+        """Return True if the key was already seen within the window, else remember it"""
+        now = time.monotonic()
+        with self._lock:
+            while self._expiry:
+                oldest, expires_at = next(iter(self._expiry.items()))
+                if expires_at > now:
+                    break
+                del self._expiry[oldest]
+            if key in self._expiry:
+                return True
+            self._expiry[key] = now + self.ttl
+            if len(self._expiry) > self.max_entries:
+                self._expiry.popitem(last=False)
+            return False
+
+    def __len__(self):
+        return len(self._expiry)
+
+class EventFilter:
+    """
+    Drop analytics events from bots, and repeats of the same (ip, book,
+    event) within the dedup window, before they're queued for writing.
+    Each worker keeps its own window.
+    """
+
+    def __init__(self, app):
+        self.filter_bots = app.config['ANALYTICS_FILTER_BOTS']
+        self.window = app.config['ANALYTICS_DEDUP_WINDOW']
+        self._recent = RecentKeys(self.window, app.config['ANALYTICS_DEDUP_MAX_ENTRIES'])
+        self._stats = {'events_accepted': 0, 'events_bots': 0, 'events_duplicates': 0}
+
+    def accept(self, event):
+        """Return True if the event should be recorded"""
+        if self.filter_bots and is_bot(event['user_agent']):
+            self._stats['events_bots'] += 1
+            return False
+        # Without a client address every visitor would look like a repeat of the first
+        if self.window and event['ip_address'] and self._recent.check_and_add(
+            (event['ip_address'], event['book_id'], event['event_type'])
+        ):
+            self._stats['events_duplicates'] += 1
+            return False
+        self._stats['events_accepted'] += 1
+        return True
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['dedup_entries'] = len(self._recent)
+        return stats
+
+event_filter = EventFilter(app)
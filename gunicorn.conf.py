@@ -0,0 +1,76 @@
+"""
+Gunicorn settings, picked up automatically by `gunicorn main:app`.
+
+GUNICORN_PROFILE selects the worker model:
+- gthread (default): a few processes with a thread pool each; the safe
+  choice for the sync SQLAlchemy/psycopg2 stack
+- gevent: cooperative greenlets for very high connection counts; needs
+  the gevent extra (gevent, psycogreen)
+- sync: one request at a time per process, the gunicorn default
+"""
+import os
+import multiprocessing
+
+profile = os.environ.get("GUNICORN_PROFILE", "gthread")
+cpu_count = multiprocessing.cpu_count()
+
+if profile == "gevent":
+    # Patch before the app is preloaded so its locks and sockets are cooperative
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+if profile == "gevent":
+    worker_class = "gevent"
+    workers = int(os.environ.get("WEB_CONCURRENCY", cpu_count))
+    worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 100))
+    concurrency_per_worker = worker_connections
+elif profile == "gthread":
+    worker_class = "gthread"
+    workers = int(os.environ.get("WEB_CONCURRENCY", cpu_count + 1))
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))
+    concurrency_per_worker = threads
+else:
+    worker_class = "sync"
+    workers = int(os.environ.get("WEB_CONCURRENCY", cpu_count * 2 + 1))
+    concurrency_per_worker = 1
+
+# Size each worker's connection pool for its request concurrency plus the
+# analytics flusher thread, unless set explicitly; cover variants are made
+# by the job worker. gevent workers share a capped pool and queue for
+# connections beyond it.
+background_threads = 1
+os.environ.setdefault("DB_POOL_SIZE", str(min(concurrency_per_worker, 20) + background_threads))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(min(concurrency_per_worker, 10)))
+
+# Import the app and register routes once in the master
+preload_app = True
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so slow leaks can't accumulate
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = "-"
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared with the children
+    from app import app, db
+    with app.app_context():
+        # Includes the read replica's pool when DATABASE_REPLICA_URL is set
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def worker_exit(server, worker):
+    # Write out analytics events still buffered in this worker
+    from analytics_buffer import analytics_buffer
+    analytics_buffer.stop()
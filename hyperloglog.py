@@ -0,0 +1,83 @@
+import math
+import struct
+import hashlib
+
+# 2**10 registers gives about a 3% standard error in at most 1 KB per sketch
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+
+# 2 ** -value for each possible register value
+_INVERSE_POWERS = [2.0 ** -value for value in range(65)]
+
+# First byte of a serialized sketch
+SPARSE = 0
+DENSE = 1
+
+class HyperLogLog:
+    """
+    Approximate distinct counter. Sketches of the same precision merge by
+    taking the larger value of each register, so per-day sketches can be
+    combined into counts for any range of days.
+    """
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers is not None else bytearray(REGISTERS)
+
+    def add(self, value):
+        """Add a string value to the sketch"""
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - PRECISION)
+        remainder = hashed & ((1 << (64 - PRECISION)) - 1)
+        # Position of the first 1 bit in the remaining bits, counting from 1
+        rank = (64 - PRECISION) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold another sketch into this one"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def merge_bytes(self, data):
+        """Fold in a serialized sketch, touching only the registers a sparse one sets"""
+        if not data:
+            return self
+        if data[0] == DENSE:
+            self.registers = bytearray(map(max, self.registers, data[1:]))
+            return self
+        registers = self.registers
+        for index, value in struct.iter_unpack('>HB', data[1:]):
+            if value > registers[index]:
+                registers[index] = value
+        return self
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+        estimate = alpha * REGISTERS * REGISTERS / sum(map(_INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * REGISTERS and zeros:
+            # Linear counting is more accurate while most registers are empty
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """
+        Serialize compactly: small sketches as (register, value) pairs,
+        3 bytes each, and fuller ones as the raw registers
+        """
+        used = [(index, value) for index, value in enumerate(self.registers) if value]
+        if len(used) * 3 < REGISTERS:
+            return bytes([SPARSE]) + b''.join(struct.pack('>HB', index, value) for index, value in used)
+        return bytes([DENSE]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        if data[0] == DENSE:
+            return cls(data[1:])
+        sketch = cls()
+        for index, value in struct.iter_unpack('>HB', data[1:]):
+            sketch.registers[index] = value
+        return sketch
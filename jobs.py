@@ -0,0 +1,341 @@
+import os
+import time
+import signal
+import socket
+import threading
+import argparse
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func, or_, and_
+from app import app, db
+from models import Job, Book, Blob, _upsert_insert
+import blob_store
+import page_cache
+
+# Job kind -> function called with the job's payload as keyword arguments.
+# Handlers must be safe to run again: a job is retried if it fails or its
+# worker dies, even when some of its work was already done.
+handlers = {}
+
+def handler(kind):
+    def register(func):
+        handlers[kind] = func
+        return func
+    return register
+
+def enqueue(kind, payload=None, key=None, delay=0, max_attempts=None):
+    """
+    Add a job to the current transaction; workers see it once the caller
+    commits. A job with the same key, in any state, makes this a no-op.
+    Returns True if the job was added.
+    """
+    now = datetime.utcnow()
+    row = {
+        'kind': kind,
+        'payload': payload or {},
+        'key': key,
+        'status': 'queued',
+        'attempts': 0,
+        'max_attempts': max_attempts or app.config['JOB_MAX_ATTEMPTS'],
+        'run_at': now + timedelta(seconds=delay),
+        'created_at': now,
+    }
+    if key is not None:
+        upsert = _upsert_insert()
+        if upsert is not None:
+            result = db.session.execute(upsert(Job).values(**row).on_conflict_do_nothing(index_elements=['key']))
+            return bool(result.rowcount)
+        if db.session.query(Job.id).filter_by(key=key).first() is not None:
+            return False
+    db.session.add(Job(**row))
+    return True
+
+def _ready(now):
+    # Running jobs whose worker stopped reporting are taken over
+    stale = now - timedelta(seconds=app.config['JOB_TIMEOUT'])
+    return or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running', Job.locked_at < stale),
+    )
+
+def claim(worker):
+    """
+    Take the next due job for this worker, or return None. Workers race
+    with a conditional update, so each job is claimed once; PostgreSQL
+    also skips rows another worker is claiming.
+    """
+    now = datetime.utcnow()
+    candidates = db.session.execute(
+        select(Job.id).where(_ready(now)).order_by(Job.run_at, Job.id).limit(10)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    for job_id in candidates:
+        result = db.session.execute(
+            update(Job).where(Job.id == job_id, _ready(now))
+            .values(status='running', locked_by=worker, locked_at=now, attempts=Job.attempts + 1)
+        )
+        if result.rowcount:
+            db.session.commit()
+            return db.session.get(Job, job_id)
+    db.session.commit()
+    return None
+
+def _heartbeat(engine, job_id, worker, stopped):
+    """
+    Refresh a running job's locked_at until stopped is set, so a handler that
+    runs longer than JOB_TIMEOUT isn't taken over by another worker while its
+    own worker is still alive
+    """
+    while not stopped.wait(app.config['JOB_TIMEOUT'] / 3):
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    update(Job).where(Job.id == job_id, Job.status == 'running', Job.locked_by == worker)
+                    .values(locked_at=datetime.utcnow())
+                )
+        except Exception as e:
+            app.logger.warning(f"Job {job_id} heartbeat failed: {e}")
+
+def run_job(job):
+    """
+    Run a claimed job. The handler's uncommitted changes are committed with
+    the job's done status; on failure they're rolled back and the job is
+    retried with exponential backoff until it runs out of attempts.
+    """
+    job_id, kind, payload = job.id, job.kind, dict(job.payload)
+    started = time.perf_counter()
+    # On its own connection, outside the handler's transaction
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(db.engine, job_id, job.locked_by, stopped), daemon=True)
+    heartbeat.start()
+    try:
+        if kind not in handlers:
+            raise LookupError(f"No handler for job kind {kind!r}")
+        handlers[kind](**payload)
+        job = db.session.get(Job, job_id)
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        job.last_error = None
+        db.session.commit()
+        app.logger.info(f"Job {job_id} ({kind}) done in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return True
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()[-4000:]
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+        db.session.commit()
+        app.logger.error(f"Job {job_id} ({kind}) attempt {job.attempts} failed: {e}")
+        return False
+    finally:
+        stopped.set()
+        heartbeat.join()
+
+def schedule_periodic(now=None):
+    """
+    Queue the recurring maintenance jobs. Keys are derived from the period,
+    so any number of workers can call this and each job is queued once.
+    """
+    now = now or datetime.utcnow()
+    today = now.date()
+    yesterday = today - timedelta(days=1)
+    interval = app.config['RANKINGS_INTERVAL']
+    enqueue('update_rankings', key=f"update_rankings:{int(now.timestamp()) // interval}", max_attempts=1)
+    # Yesterday's rollups were kept up to date live; rebuild them once the day is complete
+    enqueue('rollup_day', {'day': yesterday.isoformat()}, key=f"rollup_day:{yesterday.isoformat()}")
+    enqueue('maintain_partitions', key=f"maintain_partitions:{today.isoformat()}")
+    enqueue('collect_garbage', key=f"collect_garbage:{today.isoformat()}")
+    enqueue('prune_jobs', key=f"prune_jobs:{today.isoformat()}")
+    db.session.commit()
+
+def work(worker=None, once=False):
+    """
+    Claim and run jobs until stopped with SIGTERM or SIGINT. With once,
+    return when no job is due instead of waiting for more.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        # Finish the current job before exiting
+        signal.signal(signum, lambda *args: stopping.append(True))
+
+    processed = 0
+    last_schedule = 0.0
+    while not stopping:
+        if time.monotonic() - last_schedule >= 60:
+            schedule_periodic()
+            last_schedule = time.monotonic()
+        job = claim(worker)
+        if job is None:
+            if once:
+                break
+            time.sleep(app.config['JOB_POLL_INTERVAL'])
+            continue
+        run_job(job)
+        processed += 1
+    db.session.remove()
+    return processed
+
+def _last_line(text):
+    lines = (text or '').strip().splitlines()
+    return lines[-1] if lines else None
+
+def status(recent_failures=10):
+    """Job counts by kind and status, and the latest failures"""
+    counts = {}
+    for kind, job_status, count in db.session.execute(
+        select(Job.kind, Job.status, func.count()).group_by(Job.kind, Job.status)
+    ):
+        counts.setdefault(kind, {})[job_status] = count
+    oldest = db.session.execute(
+        select(func.min(Job.run_at)).where(Job.status == 'queued', Job.run_at <= datetime.utcnow())
+    ).scalar()
+    failures = db.session.execute(
+        select(Job.id, Job.kind, Job.payload, Job.attempts, Job.last_error, Job.finished_at)
+        .where(Job.status == 'failed').order_by(Job.finished_at.desc()).limit(recent_failures)
+    ).all()
+    return {
+        'counts': counts,
+        'oldest_due_seconds': round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+        'recent_failures': [{
+            'id': job_id,
+            'kind': kind,
+            'payload': payload,
+            'attempts': attempts,
+            'error': _last_line(last_error),
+            'finished_at': finished_at.isoformat() if finished_at else None,
+        } for job_id, kind, payload, attempts, last_error, finished_at in failures],
+    }
+
+def retry_failed(kind=None):
+    """Queue failed jobs again with fresh attempts. Returns the number requeued."""
+    query = update(Job).where(Job.status == 'failed')
+    if kind:
+        query = query.where(Job.kind == kind)
+    result = db.session.execute(query.values(status='queued', attempts=0, run_at=datetime.utcnow(), finished_at=None))
+    db.session.commit()
+    return result.rowcount
+
+# Upload and deletion follow-ups queued by the admin views
+
+def queue_upload(book, field):
+    """Queue moving a book's staged cover_path or file_path into the blob store"""
+    staged_path = getattr(book, field)
+    enqueue('finalize_upload', {'book_id': book.id, 'field': field, 'staged_path': staged_path},
+            key=f"finalize_upload:{staged_path}")
+
+def queue_release(book_id, file_path, replaced_by=None):
+    """
+    Queue dropping a book's reference to a stored file it no longer uses,
+    because the upload at replaced_by took its place or the book was deleted
+    """
+    if file_path:
+        # Keyed on the change, so a retry can't release the same reference twice
+        enqueue('release_file', {'path': file_path},
+                key=f"release_file:{book_id}:{file_path}:{replaced_by or 'deleted'}")
+
+@handler('finalize_upload')
+def finalize_upload(book_id, field, staged_path):
+    """
+    Hash a staged upload, point the book at its blob and queue its cover
+    variants. The staged copy is served until pages that embed its path
+    have expired from the page cache, then removed.
+    """
+    subfolder = 'covers' if field == 'cover_path' else 'books'
+    column = getattr(Book, field)
+    stored = blob_store.finalize_staged(staged_path, subfolder)
+    if stored is None:
+        app.logger.warning(f"Staged upload {staged_path} for book {book_id} is gone")
+    else:
+        blob_path, sha256, size = stored
+        # Only if the book still uses this upload; it may have been replaced or deleted meanwhile
+        result = db.session.execute(update(Book).where(Book.id == book_id, column == staged_path).values({field: blob_path}))
+        if result.rowcount:
+            Blob.acquire(sha256, blob_path, size)
+            if field == 'cover_path':
+                db.session.execute(update(Book).where(Book.id == book_id).values(cover_variants=None))
+                # Keyed on the upload, not the blob: a book can return to a cover it had before
+                enqueue('cover_variants', {'book_id': book_id, 'cover_path': blob_path},
+                        key=f"cover_variants:{staged_path}")
+    enqueue('remove_staged', {'path': staged_path}, key=f"remove_staged:{staged_path}",
+            delay=app.config['PAGE_CACHE_TTL'])
+    db.session.commit()
+    page_cache.invalidate_book(book_id)
+
+@handler('cover_variants')
+def cover_variants(book_id, cover_path):
+    import thumbnails
+    if thumbnails.Image is None:
+        app.logger.warning("Pillow is not installed; skipping cover variants")
+        return
+    if thumbnails.process_cover(book_id, cover_path) is None:
+        raise RuntimeError(f"Could not generate cover variants for {cover_path}")
+
+@handler('remove_staged')
+def remove_staged(path):
+    if not blob_store.is_staged(path):
+        raise ValueError(f"{path} is not a staged upload")
+    full_path = os.path.join('static', path)
+    if os.path.exists(full_path):
+        os.remove(full_path)
+
+@handler('release_file')
+def release_file(path):
+    blob_store.release(path)
+
+@handler('update_rankings')
+def update_rankings():
+    import rankings
+    rankings.update_rankings()
+
+@handler('rollup_day')
+def rollup_day(day):
+    from analytics_rollup import backfill
+    day = datetime.strptime(day, '%Y-%m-%d').date()
+    backfill(day, day + timedelta(days=1))
+
+@handler('maintain_partitions')
+def maintain_partitions():
+    """Create upcoming click event partitions and archive expired events"""
+    import partitions
+    partitions.ensure_partitions()
+    partitions.apply_retention()
+
+@handler('collect_garbage')
+def collect_garbage():
+    blob_store.collect_garbage()
+
+@handler('prune_jobs')
+def prune_jobs():
+    """Delete finished jobs past the retention period; failed ones stay until retried"""
+    cutoff = datetime.utcnow() - timedelta(days=app.config['JOB_RETENTION_DAYS'])
+    db.session.execute(delete(Job).where(Job.status == 'done', Job.finished_at < cutoff))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Background job queue")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    work_parser = subparsers.add_parser("work", help="Run jobs as they become due")
+    work_parser.add_argument("--once", action="store_true", help="exit when no job is due")
+    subparsers.add_parser("status", help="Show job counts and recent failures")
+    retry_parser = subparsers.add_parser("retry", help="Queue failed jobs again")
+    retry_parser.add_argument("--kind", help="only jobs of this kind")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.action == "work":
+            processed = work(once=args.once)
+            print(f"Worker stopped after {processed} jobs.")
+        elif args.action == "status":
+            summary = status()
+            for kind, counts in sorted(summary['counts'].items()):
+                print(f"{kind:<20}" + "  ".join(f"{name}={count}" for name, count in sorted(counts.items())))
+            print(f"Oldest due job waiting: {summary['oldest_due_seconds']}s")
+            for failure in summary['recent_failures']:
+                print(f"Failed #{failure['id']} {failure['kind']} after {failure['attempts']} attempts: {failure['error']}")
+        else:
+            print(f"Requeued {retry_failed(args.kind)} failed jobs.")
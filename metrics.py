@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import random
+import pstats
+import cProfile
+import threading
+from io import StringIO
+from flask import g, request
+from app import app, db
+import db_pool
+import query_stats
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+class Metric:
+    """
+    One named metric with its samples keyed by label values. Values live in
+    this process; workers share them through snapshot files (see collect).
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(key): value for key, value in self._values.items()}
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Mirror a running total kept by another component"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Per-bucket counts (not cumulative), then the sum and the count
+            sample = self._values.get(key)
+            if sample is None:
+                sample = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[index] += 1
+                    break
+            sample[-2] += value
+            sample[-1] += 1
+
+registry = []
+# Functions run before metrics are read, to copy in values kept elsewhere
+collectors = []
+
+http_requests = Counter('http_requests_total', 'HTTP requests handled', ['endpoint', 'method', 'status'])
+http_latency = Histogram('http_request_duration_seconds', 'Time to produce a response', ['endpoint'])
+http_db_statements = Histogram('http_request_db_statements', 'SQL statements run per request', ['endpoint'], COUNT_BUCKETS)
+http_db_time = Histogram('http_request_db_seconds', 'Time spent in SQL per request', ['endpoint'])
+db_statements = Counter('db_statements_total', 'SQL statements executed')
+db_statement_time = Histogram('db_statement_duration_seconds', 'SQL statement execution time')
+db_pool_wait = Histogram('db_pool_checkout_wait_seconds', 'Time waited for a pooled database connection')
+db_pool_connections = Gauge('db_pool_connections', 'Database connections by state', ['database', 'state'])
+upload_bytes = Counter('upload_bytes_total', 'Bytes received in file uploads', ['kind'])
+download_bytes = Counter('download_bytes_total', 'Bytes of book files sent', ['mode'])
+analytics_events = Counter('analytics_events_total', 'Analytics events by outcome', ['outcome'])
+analytics_flushes = Counter('analytics_flushes_total', 'Analytics buffer flushes', ['result'])
+analytics_flush_time = Counter('analytics_flush_seconds_total', 'Time spent writing analytics batches')
+rate_limited_requests = Counter('rate_limited_requests_total', 'Requests refused by the rate limiter', ['endpoint'])
+analytics_queue_depth = Gauge('analytics_queue_depth', 'Analytics events waiting to be written')
+
+db_pool.checkout_observers.append(db_pool_wait.observe)
+
+def _observe_statement(elapsed):
+    db_statements.inc()
+    db_statement_time.observe(elapsed)
+
+# Statement counts and timings come from query_stats, which owns the SQL hooks
+query_stats.statement_observers.append(_observe_statement)
+
+def _collect_pool():
+    with app.app_context():
+        engines = dict(db.engines)
+    for name, engine in engines.items():
+        pool, database = engine.pool, name or 'primary'
+        if hasattr(pool, 'checkedout'):
+            db_pool_connections.set(pool.checkedout(), database=database, state='checked_out')
+            db_pool_connections.set(pool.checkedin(), database=database, state='idle')
+            db_pool_connections.set(max(pool.overflow(), 0), database=database, state='overflow')
+
+def _collect_analytics():
+    from analytics_buffer import analytics_buffer
+    from event_filter import event_filter
+    stats = dict(analytics_buffer.stats(), **event_filter.stats())
+    for outcome in ('enqueued', 'flushed', 'dropped', 'shed', 'bots', 'duplicates'):
+        analytics_events.set(stats[f'events_{outcome}'], outcome=outcome)
+    analytics_flushes.set(stats['flushes'], result='ok')
+    analytics_flushes.set(stats['flush_failures'], result='failed')
+    analytics_flush_time.set(stats['total_flush_ms'] / 1000)
+    analytics_queue_depth.set(stats['queue_depth'])
+
+def _collect_rate_limits():
+    import rate_limit
+    for endpoint, count in rate_limit.stats().items():
+        rate_limited_requests.set(count, endpoint=endpoint)
+
+collectors.extend([_collect_pool, _collect_analytics, _collect_rate_limits])
+
+def _snapshot():
+    for collector in collectors:
+        try:
+            collector()
+        except Exception as e:
+            app.logger.error(f"Metrics collector {collector.__name__} failed: {e}")
+    return {metric.name: metric.snapshot() for metric in registry}
+
+def _snapshot_path(pid):
+    return os.path.join(app.config['METRICS_DIR'], f'{pid}.json')
+
+_last_write = 0.0
+
+def write_snapshot():
+    """Save this worker's metrics where the worker answering /metrics can read them"""
+    global _last_write
+    _last_write = time.monotonic()
+    os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    path = _snapshot_path(os.getpid())
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(f'{path}.tmp', path)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def collect():
+    """
+    Sum the samples of every live worker on this machine. Each gunicorn
+    worker keeps its own metrics, so the worker serving /metrics merges the
+    snapshots the others write after their requests with its own.
+    """
+    merged = {metric.name: {} for metric in registry}
+    snapshots = [_snapshot()]
+    folder = app.config['METRICS_DIR']
+    if os.path.isdir(folder):
+        for filename in os.listdir(folder):
+            if not filename.endswith('.json') or filename == f'{os.getpid()}.json':
+                continue
+            pid = int(filename[:-5]) if filename[:-5].isdigit() else None
+            if pid is None or not _pid_alive(pid):
+                # Samples from recycled workers go away; Prometheus treats the drop as a counter reset
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(folder, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    for snapshot in snapshots:
+        for name, samples in snapshot.items():
+            if name not in merged:
+                continue
+            for key, value in samples.items():
+                current = merged[name].get(key)
+                if current is None:
+                    merged[name][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    merged[name][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[name][key] = current + value
+    return merged
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def render():
+    """Return all metrics in the Prometheus text exposition format"""
+    merged = collect()
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for key, value in sorted(merged[metric.name].items()):
+            label_values = json.loads(key)
+            if metric.kind != 'histogram':
+                lines.append(f'{metric.name}{_format_labels(metric.labelnames, label_values)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                labels = _format_labels(metric.labelnames, label_values, [('le', bound)])
+                lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(metric.labelnames, label_values, [('le', '+Inf')])
+            lines.append(f'{metric.name}_bucket{labels} {value[-1]}')
+            labels = _format_labels(metric.labelnames, label_values)
+            lines.append(f'{metric.name}_sum{labels} {value[-2]}')
+            lines.append(f'{metric.name}_count{labels} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+# Only one request per worker is profiled at a time
+_profile_lock = threading.Lock()
+
+@app.before_request
+def _start_request():
+    g.metrics_started = time.perf_counter()
+
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        g.profiler = (profiler, time.perf_counter())
+        profiler.enable()
+
+@app.after_request
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    http_latency.observe(elapsed, endpoint=endpoint)
+
+    totals = query_stats.request_totals()
+    if totals is not None:
+        http_db_statements.observe(totals[0], endpoint=endpoint)
+        http_db_time.observe(totals[1], endpoint=endpoint)
+
+    if time.monotonic() - _last_write >= app.config['METRICS_SNAPSHOT_INTERVAL']:
+        try:
+            write_snapshot()
+        except OSError as e:
+            app.logger.error(f"Could not write metrics snapshot: {e}")
+    return response
+
+@app.teardown_request
+def _finish_profile(exception=None):
+    profiling = g.pop('profiler', None)
+    if profiling is None:
+        return
+    profiler, started = profiling
+    profiler.disable()
+    _profile_lock.release()
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms < app.config['PROFILE_SLOW_MS']:
+        return
+    output = StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(25)
+    app.logger.warning(f"Slow request {request.method} {request.path} took {elapsed_ms:.0f} ms:\n{output.getvalue()}")
+    if app.config['PROFILE_DIR']:
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], f"{int(time.time())}-{os.getpid()}-{request.endpoint}.prof"))
@@ -1,7 +1,32 @@
+import re
+import socket
 import datetime
+import ipaddress
+from sqlalchemy import insert, update, delete, tuple_
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.exc import IntegrityError
 from app import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from hyperloglog import HyperLogLog
+
+def normalize_isbn(value):
+    """Strip hyphens and spaces from an ISBN, so hyphenated and bare forms match"""
+    return re.sub(r'[\s-]', '', value).upper() if value else value
+
+def _upsert_insert():
+    """
+    Return the dialect insert() that supports ON CONFLICT for the current
+    database, or None if it has no upsert
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -18,11 +43,20 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
 class Book(db.Model):
+    __table_args__ = (
+        # Supports keyset pagination ordered by (created_at, id)
+        db.Index('ix_book_created_at_id', 'created_at', 'id'),
+        # Exact-match search paths
+        db.Index('ix_book_isbn', 'isbn'),
+        db.Index('ix_book_category_created_at_id', 'category', 'created_at', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     author = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text)
     cover_path = db.Column(db.String(255))
+    cover_variants = db.Column(db.JSON(none_as_null=True))  # {size: {format: path}}, filled in by thumbnails.py
     file_path = db.Column(db.String(255))
     book_url = db.Column(db.String(500))  # For external book URLs
     publisher = db.Column(db.String(255))
@@ -34,8 +68,22 @@ class Book(db.Model):
     
     # Relationship with analytics
     analytics = db.relationship('BookAnalytics', backref='book', lazy=True)
+    
+    def cover_variant(self, size, image_format='webp'):
+        """
+        Path of a resized cover ('grid', 'detail' or 'retina'), falling back
+        to the original upload until the variants have been generated
+        """
+        variant = (self.cover_variants or {}).get(size, {}).get(image_format)
+        return variant or self.cover_path
 
 class BookAnalytics(db.Model):
+    __table_args__ = (
+        db.Index('uq_book_analytics_book_id', 'book_id', unique=True),
+        db.Index('ix_book_analytics_view_count', 'view_count'),
+        db.Index('ix_book_analytics_download_count', 'download_count'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
     view_count = db.Column(db.Integer, default=0)
@@ -43,12 +91,460 @@ class BookAnalytics(db.Model):
     share_count = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    
+    @classmethod
+    def increment(cls, book_id, view_count=0, download_count=0, share_count=0):
+        """
+        Atomically add to a book's counters in the database, creating the row
+        if it doesn't exist yet. Returns the new (view, download, share) counts
+        when the database supports RETURNING, otherwise None.
+        """
+        deltas = {
+            'view_count': view_count,
+            'download_count': download_count,
+            'share_count': share_count,
+        }
+        now = datetime.datetime.utcnow()
+        dialect = db.session.get_bind().dialect
+        counters = (cls.view_count, cls.download_count, cls.share_count)
+        
+        # Fast path: the row almost always exists, so try a plain UPDATE first
+        stmt = (
+            update(cls)
+            .where(cls.book_id == book_id)
+            .values(updated_at=now, **{name: getattr(cls, name) + n for name, n in deltas.items()})
+        )
+        if dialect.update_returning:
+            row = db.session.execute(stmt.returning(*counters)).first()
+            if row is not None:
+                return tuple(row)
+        elif db.session.execute(stmt).rowcount:
+            return None
+        
+        # Missing row: upsert so concurrent creators can't insert duplicates
+        upsert = _upsert_insert()
+        if upsert is None:
+            return cls._increment_fallback(book_id, deltas, now)
+        
+        stmt = upsert(cls).values(book_id=book_id, created_at=now, updated_at=now, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['book_id'],
+            set_=dict(
+                updated_at=now,
+                **{name: getattr(cls, name) + getattr(stmt.excluded, name) for name in deltas}
+            )
+        )
+        if dialect.insert_returning:
+            return tuple(db.session.execute(stmt.returning(*counters)).one())
+        db.session.execute(stmt)
+        return None
+    
+    @classmethod
+    def _increment_fallback(cls, book_id, deltas, now):
+        # Databases without ON CONFLICT: insert in a savepoint and retry the
+        # UPDATE if another transaction created the row first
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(cls).values(book_id=book_id, created_at=now, updated_at=now, **deltas))
+        except IntegrityError:
+            db.session.execute(
+                update(cls)
+                .where(cls.book_id == book_id)
+                .values(updated_at=now, **{name: getattr(cls, name) + n for name, n in deltas.items()})
+            )
+        return None
+
+def ip_to_text(value):
+    """Text form of an IP address as stored by IPAddress"""
+    if value is None:
+        return None
+    if isinstance(value, (bytes, memoryview)):
+        return str(ipaddress.ip_address(bytes(value)))
+    return str(value)
+
+def _pack_ip(value):
+    # inet_pton is much faster than ipaddress on the write path
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, value)
+        except (OSError, TypeError, ValueError):
+            continue
+    return None
+
+class IPAddress(TypeDecorator):
+    """
+    An IPv4 or IPv6 address: inet on PostgreSQL, 4 or 16 packed bytes
+    elsewhere. Values are read and written as text; anything that isn't a
+    valid address is stored as NULL.
+    """
+    impl = db.LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import INET
+            return dialect.type_descriptor(INET())
+        return dialect.type_descriptor(db.LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        packed = _pack_ip(value) if value is not None else None
+        if packed is None:
+            return None
+        return value if dialect.name == 'postgresql' else packed
+
+    def process_result_value(self, value, dialect):
+        return ip_to_text(value)
+
+# Built-in event types keep fixed ids so queries can filter on them without a lookup
+EVENT_TYPE_IDS = {'view': 1, 'download': 2, 'share': 3}
+
+class EventType(db.Model):
+    """Names of tracked event types; custom types get the next free id"""
+    id = db.Column(db.SmallInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    name = db.Column(db.String(50), nullable=False, unique=True)
+
+class UserAgent(db.Model):
+    """Distinct user agent strings, referenced by ClickEvent"""
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(255), nullable=False, unique=True)
+
+class Referrer(db.Model):
+    """Distinct referrer URLs, referenced by ClickEvent"""
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(255), nullable=False, unique=True)
 
 class ClickEvent(db.Model):
+    # On PostgreSQL this table is partitioned by month; see partitions.py.
+    # Repeated strings are interned in lookup tables by dimensions.py.
+    __table_args__ = (
+        db.Index('ix_click_event_book_id_timestamp', 'book_id', 'timestamp'),
+        db.Index('ix_click_event_timestamp', 'timestamp'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    event_type_id = db.Column(db.SmallInteger, db.ForeignKey('event_type.id'), nullable=False)
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('user_agent.id'))
+    ip_address = db.Column(IPAddress)
+    referrer_id = db.Column(db.Integer, db.ForeignKey('referrer.id'))
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class DailyBookStats(db.Model):
+    """Per-day event counts for each book, rolled up from ClickEvent"""
+    __table_args__ = (
+        db.Index('uq_daily_book_stats', 'book_id', 'date', 'event_type', unique=True),
+        db.Index('ix_daily_book_stats_date', 'date'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
-    event_type = db.Column(db.String(50), nullable=False)  # 'view', 'download', 'share'
-    user_agent = db.Column(db.String(255))
-    ip_address = db.Column(db.String(50))
-    referrer = db.Column(db.String(255))
-    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    date = db.Column(db.Date, nullable=False)
+    event_type = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    @classmethod
+    def increment_many(cls, counts):
+        """
+        Atomically add to the rollup rows for a {(book_id, date, event_type): n}
+        mapping, creating rows that don't exist yet
+        """
+        if not counts:
+            return
+        # Sorted, so concurrent flushes lock the rows in the same order and can't deadlock
+        rows = [
+            {'book_id': book_id, 'date': date, 'event_type': event_type, 'count': n}
+            for (book_id, date, event_type), n in sorted(counts.items())
+        ]
+        
+        upsert = _upsert_insert()
+        if upsert is not None:
+            stmt = upsert(cls)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['book_id', 'date', 'event_type'],
+                set_={'count': cls.count + stmt.excluded.count}
+            )
+            db.session.execute(stmt, rows)
+            return
+        
+        for row in rows:
+            result = db.session.execute(
+                update(cls)
+                .where(cls.book_id == row['book_id'], cls.date == row['date'], cls.event_type == row['event_type'])
+                .values(count=cls.count + row['count'])
+            )
+            if not result.rowcount:
+                db.session.execute(insert(cls).values(**row))
+
+class DailyUniqueViewers(db.Model):
+    """
+    HyperLogLog sketch of the distinct visitors who viewed a book on a day.
+    Sketches merge, so unique viewers over any range of days can be
+    estimated without reading ClickEvent.
+    """
+    __table_args__ = (
+        db.Index('uq_daily_unique_viewers', 'book_id', 'date', unique=True),
+        db.Index('ix_daily_unique_viewers_date', 'date'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    sketch = db.Column(db.LargeBinary, nullable=False)
+    
+    @classmethod
+    def merge_many(cls, sketches):
+        """
+        Fold a {(book_id, date): HyperLogLog} mapping into the stored sketches.
+        Missing rows are created empty first, so the rows can be locked and
+        concurrent flushes from other workers can't overwrite each other.
+        """
+        if not sketches:
+            return
+        empty = HyperLogLog().to_bytes()
+        # Rows are created and locked in (book_id, date) order, the same in every flush, so flushes can't deadlock
+        rows = [{'book_id': book_id, 'date': date, 'sketch': empty} for book_id, date in sorted(sketches)]
+        
+        upsert = _upsert_insert()
+        if upsert is not None:
+            db.session.execute(upsert(cls).on_conflict_do_nothing(index_elements=['book_id', 'date']), rows)
+        else:
+            for row in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert(cls).values(**row))
+                except IntegrityError:
+                    pass
+        
+        stored = db.session.execute(
+            db.select(cls.id, cls.book_id, cls.date, cls.sketch)
+            .where(tuple_(cls.book_id, cls.date).in_(list(sketches)))
+            .order_by(cls.book_id, cls.date)
+            .with_for_update()
+        ).all()
+        db.session.execute(update(cls), [
+            {'id': row.id, 'sketch': HyperLogLog.from_bytes(row.sketch).merge(sketches[(row.book_id, row.date)]).to_bytes()}
+            for row in stored
+        ])
+    
+    @classmethod
+    def estimate(cls, start, book_ids):
+        """Return {book_id: unique viewers} for the given books from start onwards"""
+        by_book = {}
+        query = db.select(cls.book_id, cls.sketch).where(cls.date >= start, cls.book_id.in_(book_ids))
+        for book_id, data in db.session.execute(query):
+            by_book.setdefault(book_id, HyperLogLog()).merge_bytes(data)
+        return {book_id: sketch.count() for book_id, sketch in by_book.items()}
+
+class DailySiteViewers(db.Model):
+    """
+    HyperLogLog sketch of the distinct visitors who viewed any book on a
+    day, kept up to date by the analytics flusher and rebuilt from that
+    day's DailyUniqueViewers by the rollup
+    """
+    __table_args__ = (
+        db.Index('uq_daily_site_viewers_date', 'date', unique=True),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    sketch = db.Column(db.LargeBinary, nullable=False)
+    
+    @classmethod
+    def replace(cls, start, end, sketches):
+        """Store the {date: HyperLogLog} sketches for the days from start up to, but not including, end"""
+        db.session.execute(delete(cls).where(cls.date >= start, cls.date < end))
+        if sketches:
+            db.session.execute(insert(cls), [
+                {'date': date, 'sketch': sketch.to_bytes()} for date, sketch in sketches.items()
+            ])
+    
+    @classmethod
+    def merge_many(cls, sketches):
+        """
+        Fold a {date: HyperLogLog} mapping into the stored sketches, creating
+        and locking the rows in date order like DailyUniqueViewers.merge_many
+        """
+        if not sketches:
+            return
+        empty = HyperLogLog().to_bytes()
+        rows = [{'date': date, 'sketch': empty} for date in sorted(sketches)]
+        
+        upsert = _upsert_insert()
+        if upsert is not None:
+            db.session.execute(upsert(cls).on_conflict_do_nothing(index_elements=['date']), rows)
+        else:
+            for row in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert(cls).values(**row))
+                except IntegrityError:
+                    pass
+        
+        stored = db.session.execute(
+            db.select(cls.id, cls.date, cls.sketch)
+            .where(cls.date.in_(list(sketches)))
+            .order_by(cls.date)
+            .with_for_update()
+        ).all()
+        db.session.execute(update(cls), [
+            {'id': row.id, 'sketch': HyperLogLog.from_bytes(row.sketch).merge(sketches[row.date]).to_bytes()}
+            for row in stored
+        ])
+    
+    @classmethod
+    def estimate(cls, start):
+        """
+        Return {date: unique viewers} from start onwards. Days without a
+        stored sketch, from before it was kept, are merged from the per-book
+        sketches.
+        """
+        counts = {
+            date: HyperLogLog.from_bytes(data).count()
+            for date, data in db.session.execute(
+                db.select(cls.date, cls.sketch).where(cls.date >= start)
+            )
+        }
+        pending = {}
+        for date, data in db.session.execute(
+            db.select(DailyUniqueViewers.date, DailyUniqueViewers.sketch)
+            .where(DailyUniqueViewers.date >= start, DailyUniqueViewers.date.notin_(list(counts)))
+        ):
+            pending.setdefault(date, HyperLogLog()).merge_bytes(data)
+        counts.update((date, sketch.count()) for date, sketch in pending.items())
+        return dict(sorted(counts.items()))
+
+class Blob(db.Model):
+    """
+    A stored upload, addressed by its SHA-256. Books that upload the same
+    content share one blob; ref_count tracks how many paths point at it.
+    """
+    __table_args__ = (
+        db.Index('uq_blob_path', 'path', unique=True),
+        db.Index('ix_blob_sha256', 'sha256'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    path = db.Column(db.String(255), nullable=False)  # Relative to the static folder
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    @classmethod
+    def acquire(cls, sha256, path, size):
+        """Add a reference to a blob, registering it if it's new"""
+        upsert = _upsert_insert()
+        if upsert is not None:
+            stmt = upsert(cls).values(sha256=sha256, path=path, size=size, ref_count=1,
+                                      created_at=datetime.datetime.utcnow())
+            stmt = stmt.on_conflict_do_update(index_elements=['path'], set_={'ref_count': cls.ref_count + 1})
+            db.session.execute(stmt)
+            return
+        
+        result = db.session.execute(update(cls).where(cls.path == path).values(ref_count=cls.ref_count + 1))
+        if not result.rowcount:
+            db.session.add(cls(sha256=sha256, path=path, size=size, ref_count=1))
+    
+    @classmethod
+    def release(cls, path):
+        """
+        Drop a reference to a blob. Returns False if the path isn't a
+        tracked blob. Unreferenced blobs are removed by garbage collection.
+        """
+        result = db.session.execute(
+            update(cls).where(cls.path == path, cls.ref_count > 0).values(ref_count=cls.ref_count - 1)
+        )
+        if result.rowcount:
+            return True
+        return db.session.query(cls.id).filter_by(path=path).first() is not None
+
+class BookRanking(db.Model):
+    """
+    Precomputed top-N lists, one row per position. category is '' for the
+    list across the whole catalogue. Rebuilt by rankings.update_rankings.
+    """
+    __table_args__ = (
+        db.Index('uq_book_ranking', 'ranking', 'category', 'position', unique=True),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    ranking = db.Column(db.String(50), nullable=False)  # 'most_viewed', 'most_downloaded', 'trending'
+    category = db.Column(db.String(100), nullable=False, default='')
+    position = db.Column(db.Integer, nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    book = db.relationship('Book')
+
+class TrendingScore(db.Model):
+    """Time-decayed activity score per book, as of the last rankings update"""
+    __table_args__ = (
+        db.Index('ix_trending_score_score', 'score'),
+    )
+    
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False, default=0.0)
+    
+    @classmethod
+    def add_many(cls, deltas):
+        """Add to the scores of a {book_id: points} mapping, creating missing rows"""
+        if not deltas:
+            return
+        rows = [{'book_id': book_id, 'score': points} for book_id, points in deltas.items()]
+        
+        upsert = _upsert_insert()
+        if upsert is not None:
+            stmt = upsert(cls)
+            stmt = stmt.on_conflict_do_update(index_elements=['book_id'], set_={'score': cls.score + stmt.excluded.score})
+            db.session.execute(stmt, rows)
+            return
+        
+        for row in rows:
+            result = db.session.execute(
+                update(cls).where(cls.book_id == row['book_id']).values(score=cls.score + row['score'])
+            )
+            if not result.rowcount:
+                db.session.execute(insert(cls).values(**row))
+
+class HighWaterMark(db.Model):
+    """Position reached by an incremental job, such as the last ClickEvent id it processed"""
+    name = db.Column(db.String(100), primary_key=True)
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    last_timestamp = db.Column(db.DateTime)  # for jobs that follow an updated_at column instead
+    updated_at = db.Column(db.DateTime)  # None until the job first completes
+    
+    @classmethod
+    def get(cls, name):
+        """Return the mark for name, locked for update where the database supports it"""
+        mark = db.session.execute(db.select(cls).where(cls.name == name).with_for_update()).scalar_one_or_none()
+        if mark is None:
+            mark = cls(name=name, last_id=0)
+            db.session.add(mark)
+        return mark
+
+class Job(db.Model):
+    """
+    A unit of background work for jobs.py. Jobs are added in the same
+    transaction as the change that needs them, so they're never lost or
+    run for a change that was rolled back.
+    """
+    __table_args__ = (
+        db.Index('uq_job_key', 'key', unique=True),
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    # Idempotency key; a second job with the same key isn't added
+    key = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'done', 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
@@ -0,0 +1,253 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from flask import session
+from flask_login import current_user
+from app import app
+import db_routing
+
+class MemoryBackend:
+    """
+    In-process LRU cache with per-entry TTL. Each process has its own copy
+    and only sees its own invalidations, so this suits a single process;
+    with several gunicorn workers or a job worker use SQLiteBackend.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at, tags)
+        self._tag_keys = {}
+        self._generations = {}
+        self._invalidated_at = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def generation(self, tags):
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def last_invalidated(self, tags):
+        with self._lock:
+            return max((self._invalidated_at.get(tag, 0) for tag in tags), default=0)
+
+    def set(self, key, value, tags, generation):
+        with self._lock:
+            # Drop pages rendered before an invalidation of any of their tags
+            if tuple(self._generations.get(tag, 0) for tag in tags) != generation:
+                return False
+            self._remove(key)
+            self._entries[key] = (value, time.time() + self.ttl, tags)
+            for tag in tags:
+                self._tag_keys.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, tag):
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            self._invalidated_at[tag] = time.time()
+            for key in self._tag_keys.pop(tag, set()):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tag_keys.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for tag in entry[2]:
+                keys = self._tag_keys.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+
+class SQLiteBackend:
+    """
+    Cache stored in a local SQLite file, shared by every worker process on
+    the machine, so an invalidation is seen by all of them at once.
+    """
+
+    def __init__(self, path, max_entries, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires_at REAL);
+                CREATE TABLE IF NOT EXISTS entry_tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key));
+                CREATE TABLE IF NOT EXISTS generations (tag TEXT PRIMARY KEY, generation INTEGER);
+                CREATE TABLE IF NOT EXISTS invalidations (tag TEXT PRIMARY KEY, invalidated_at REAL);
+                CREATE INDEX IF NOT EXISTS ix_entries_expires_at ON entries (expires_at);
+            """)
+
+    def _connect(self):
+        # One connection per thread and process; sqlite3 connections can't be shared across forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM entries WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _generation(self, conn, tags):
+        generations = dict(conn.execute(
+            f"SELECT tag, generation FROM generations WHERE tag IN ({','.join('?' * len(tags))})", tags
+        ).fetchall()) if tags else {}
+        return tuple(generations.get(tag, 0) for tag in tags)
+
+    def generation(self, tags):
+        return self._generation(self._connect(), list(tags))
+
+    def last_invalidated(self, tags):
+        tags = list(tags)
+        if not tags:
+            return 0
+        return self._connect().execute(
+            f"SELECT MAX(invalidated_at) FROM invalidations WHERE tag IN ({','.join('?' * len(tags))})", tags
+        ).fetchone()[0] or 0
+
+    def set(self, key, value, tags, generation):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._generation(conn, list(tags)) != generation:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, value, now + self.ttl))
+            conn.executemany("INSERT OR IGNORE INTO entry_tags (tag, key) VALUES (?, ?)",
+                             [(tag, key) for tag in tags])
+            # Keep the file bounded: expire old entries, then trim the soonest to expire
+            conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+            conn.execute("""
+                DELETE FROM entries WHERE key IN (
+                    SELECT key FROM entries ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            conn.execute("DELETE FROM entry_tags WHERE key NOT IN (SELECT key FROM entries)")
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def invalidate(self, tag):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                INSERT INTO generations (tag, generation) VALUES (?, 1)
+                ON CONFLICT (tag) DO UPDATE SET generation = generation + 1
+            """, (tag,))
+            conn.execute("INSERT OR REPLACE INTO invalidations (tag, invalidated_at) VALUES (?, ?)", (tag, time.time()))
+            conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entry_tags WHERE tag = ?)", (tag,))
+            conn.execute("DELETE FROM entry_tags WHERE tag = ?", (tag,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM entry_tags")
+
+def _create_backend():
+    backend = app.config['PAGE_CACHE_BACKEND']
+    if backend == 'sqlite':
+        return SQLiteBackend(app.config['PAGE_CACHE_PATH'], app.config['PAGE_CACHE_MAX_ENTRIES'], app.config['PAGE_CACHE_TTL'])
+    if backend == 'memory':
+        return MemoryBackend(app.config['PAGE_CACHE_MAX_ENTRIES'], app.config['PAGE_CACHE_TTL'])
+    return None
+
+cache_backend = _create_backend()
+
+def page_key(name, **params):
+    """Build a cache key from a page name and the parameters that change its content"""
+    return name + '|' + '&'.join(f"{k}={params[k]}" for k in sorted(params) if params[k] is not None)
+
+def is_cacheable():
+    """
+    Pages for logged-in users and responses carrying flashed messages are
+    personal, so they're neither served from nor written to the cache
+    """
+    return cache_backend is not None and not current_user.is_authenticated and '_flashes' not in session
+
+def get_page(key):
+    """Return a cached page body, or None"""
+    if not is_cacheable():
+        return None
+    try:
+        return cache_backend.get(key)
+    except Exception as e:
+        app.logger.error(f"Page cache read failed: {e}")
+        return None
+
+def begin_render(tags):
+    """
+    Note the current invalidation state of the tags before rendering, so a
+    page rendered while an admin edit is committed isn't cached afterwards.
+    Shortly after the tags were invalidated the page is rendered from the
+    primary, which a lagging replica may not have caught up with yet.
+    """
+    if not is_cacheable():
+        return None
+    try:
+        generation = cache_backend.generation(tags)
+        invalidated_at = cache_backend.last_invalidated(tags)
+    except Exception as e:
+        app.logger.error(f"Page cache read failed: {e}")
+        return None
+    if time.time() - invalidated_at < app.config['DB_READ_YOUR_WRITES_SECONDS']:
+        db_routing.use_primary()
+    return generation
+
+def set_page(key, body, tags, generation):
+    """Cache a rendered page body under the given invalidation tags"""
+    if generation is None or not is_cacheable():
+        return False
+    try:
+        return cache_backend.set(key, body, tags, generation)
+    except Exception as e:
+        app.logger.error(f"Page cache write failed: {e}")
+        return False
+
+def invalidate(*tags):
+    """Drop every cached page carrying any of the tags"""
+    if cache_backend is None:
+        return
+    for tag in tags:
+        try:
+            cache_backend.invalidate(tag)
+        except Exception as e:
+            app.logger.error(f"Page cache invalidation failed for {tag}: {e}")
+
+def invalidate_book(book_id):
+    """Invalidate the pages that show a book: its detail page and the catalogue listing"""
+    invalidate('catalogue', f'book:{book_id}')
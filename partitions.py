@@ -0,0 +1,267 @@
+import os
+import gzip
+import json
+import argparse
+from datetime import date, datetime
+from sqlalchemy import text
+from app import app, db
+from models import ip_to_text
+
+# Columns exported to the archive, in file order
+ARCHIVE_COLUMNS = ['id', 'book_id', 'event_type', 'user_agent', 'ip_address', 'referrer', 'timestamp']
+
+# Archived events keep their text values, joined back from the lookup tables
+ARCHIVE_SELECT = """
+    SELECT e.id, e.book_id, t.name, u.value, e.ip_address, r.value, e.timestamp
+    FROM {table} e
+    JOIN event_type t ON t.id = e.event_type_id
+    LEFT JOIN user_agent u ON u.id = e.user_agent_id
+    LEFT JOIN referrer r ON r.id = e.referrer_id
+"""
+
+def _month_start(value):
+    return date(value.year, value.month, 1)
+
+def _add_months(value, months):
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+def _partition_name(month):
+    return f"click_event_y{month.year}m{month.month:02d}"
+
+def _is_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+def is_partitioned():
+    """Return True if click_event is a partitioned table"""
+    if not _is_postgresql():
+        return False
+    with db.engine.connect() as conn:
+        return conn.execute(text("""
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = 'click_event' AND c.relnamespace = 'public'::regnamespace
+        """)).scalar() is not None
+
+def convert_to_partitioned(max_rows=None):
+    """
+    Rebuild click_event on PostgreSQL as a table partitioned by month on
+    timestamp, copying existing rows across. Runs in one transaction that
+    holds click_event locked, blocking event inserts, for the whole copy, so
+    tables over max_rows (CLICK_EVENT_CONVERT_MAX_ROWS by default, 0 for no
+    limit) are left alone for a maintenance window.
+    """
+    if not _is_postgresql() or is_partitioned():
+        return False
+    max_rows = app.config['CLICK_EVENT_CONVERT_MAX_ROWS'] if max_rows is None else max_rows
+
+    with db.engine.begin() as conn:
+        if max_rows:
+            # The planner's estimate, so the check doesn't scan the table; -1 if it was never analyzed
+            rows = conn.execute(text("SELECT reltuples FROM pg_class WHERE oid = 'click_event'::regclass")).scalar()
+            if rows < 0:
+                rows = conn.execute(text("SELECT COUNT(*) FROM click_event")).scalar()
+            if rows > max_rows:
+                app.logger.warning(
+                    f"click_event has about {int(rows)} rows, over CLICK_EVENT_CONVERT_MAX_ROWS ({max_rows}); "
+                    f"not partitioning it. Run python partitions.py convert in a maintenance window."
+                )
+                return False
+        # Fail rather than wait behind a long transaction while every insert queues behind this lock
+        conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+        first = conn.execute(text("SELECT MIN(timestamp) FROM click_event")).scalar()
+        conn.execute(text("ALTER TABLE click_event RENAME TO click_event_legacy"))
+        conn.execute(text("ALTER INDEX IF EXISTS ix_click_event_book_id_timestamp RENAME TO ix_click_event_legacy_book_id_timestamp"))
+        conn.execute(text("ALTER INDEX IF EXISTS ix_click_event_timestamp RENAME TO ix_click_event_legacy_timestamp"))
+        conn.execute(text("""
+            CREATE TABLE click_event (
+                id INTEGER NOT NULL DEFAULT nextval('click_event_id_seq'),
+                book_id INTEGER NOT NULL REFERENCES book (id),
+                event_type_id SMALLINT NOT NULL REFERENCES event_type (id),
+                user_agent_id INTEGER REFERENCES user_agent (id),
+                ip_address INET,
+                referrer_id INTEGER REFERENCES referrer (id),
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+        """))
+        conn.execute(text("CREATE INDEX ix_click_event_book_id_timestamp ON click_event (book_id, timestamp)"))
+        conn.execute(text("CREATE INDEX ix_click_event_timestamp ON click_event (timestamp)"))
+        # Catches rows outside every monthly range so inserts never fail
+        conn.execute(text("CREATE TABLE click_event_default PARTITION OF click_event DEFAULT"))
+
+        month = _month_start(first or datetime.utcnow())
+        while month <= _add_months(_month_start(datetime.utcnow()), app.config['CLICK_EVENT_PARTITIONS_AHEAD']):
+            _create_partition(conn, month)
+            month = _add_months(month, 1)
+
+        conn.execute(text("""
+            INSERT INTO click_event (id, book_id, event_type_id, user_agent_id, ip_address, referrer_id, timestamp)
+            SELECT id, book_id, event_type_id, user_agent_id, ip_address, referrer_id, COALESCE(timestamp, now())
+            FROM click_event_legacy
+        """))
+        conn.execute(text("ALTER SEQUENCE click_event_id_seq OWNED BY click_event.id"))
+        conn.execute(text("DROP TABLE click_event_legacy"))
+    return True
+
+def _create_partition(conn, month):
+    """
+    Add the partition for a month. Rows that went to the default partition
+    while the month had none are moved into it, since PostgreSQL won't attach
+    a range the default partition holds rows for.
+    """
+    name = _partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar() is not None:
+        return
+    bounds = {
+        'start': datetime.combine(month, datetime.min.time()),
+        'end': datetime.combine(_add_months(month, 1), datetime.min.time())
+    }
+    conn.execute(text(f"CREATE TABLE {name} (LIKE click_event INCLUDING DEFAULTS)"))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM click_event_default WHERE timestamp >= :start AND timestamp < :end RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """), bounds)
+    # Attaching adds the parent's keys, indexes and foreign keys to the new table
+    conn.execute(text(f"""
+        ALTER TABLE click_event ATTACH PARTITION {name}
+        FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')
+    """))
+
+def ensure_partitions(months_ahead=None):
+    """Create monthly partitions from the current month up to months_ahead"""
+    if not is_partitioned():
+        return 0
+    months_ahead = app.config['CLICK_EVENT_PARTITIONS_AHEAD'] if months_ahead is None else months_ahead
+    current = _month_start(datetime.utcnow())
+    with db.engine.begin() as conn:
+        for offset in range(months_ahead + 1):
+            _create_partition(conn, _add_months(current, offset))
+    return months_ahead + 1
+
+def _archive_path(month, sequence=0):
+    folder = os.path.join(app.config['ARCHIVE_FOLDER'], 'click_event')
+    os.makedirs(folder, exist_ok=True)
+    suffix = f".{sequence}" if sequence else ""
+    return os.path.join(folder, f"{month.year}-{month.month:02d}{suffix}.jsonl.gz")
+
+def _publish(tmp_path, month):
+    """Give a finished archive the first free name for its month, never replacing one"""
+    sequence = 0
+    while True:
+        path = _archive_path(month, sequence)
+        try:
+            # link() fails if the name is taken, unlike replace()
+            os.link(tmp_path, path)
+        except FileExistsError:
+            sequence += 1
+            continue
+        os.remove(tmp_path)
+        return path
+
+def _export(conn, sql, params, month):
+    """Stream query rows into a gzip JSONL archive file; returns the row count"""
+    tmp_path = f"{_archive_path(month)}.{os.getpid()}.tmp"
+    count = 0
+    result = conn.execution_options(stream_results=True, yield_per=5000).execute(text(sql), params)
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as archive:
+            for row in result:
+                record = dict(zip(ARCHIVE_COLUMNS, row))
+                record['ip_address'] = ip_to_text(record['ip_address'])
+                # SQLite returns raw strings for text() queries
+                if isinstance(record['timestamp'], datetime):
+                    record['timestamp'] = record['timestamp'].isoformat()
+                archive.write(json.dumps(record) + '\n')
+                count += 1
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    # Only a complete archive gets a final name; a month archived again
+    # (late rows, a retried run) gets YYYY-MM.1.jsonl.gz and so on
+    _publish(tmp_path, month)
+    return count
+
+def _archive_rows(table, cutoff):
+    """Archive and delete a table's click events before cutoff, a month per transaction"""
+    archived = []
+    while True:
+        with db.engine.begin() as conn:
+            oldest = conn.execute(text(f"SELECT MIN(timestamp) FROM {table} WHERE timestamp < :cutoff"),
+                                  {'cutoff': cutoff}).scalar()
+            if oldest is None:
+                break
+            if isinstance(oldest, str):
+                oldest = datetime.fromisoformat(oldest)
+            month = _month_start(oldest)
+            bounds = {
+                'start': datetime.combine(month, datetime.min.time()),
+                'end': min(datetime.combine(_add_months(month, 1), datetime.min.time()), cutoff)
+            }
+            count = _export(conn, ARCHIVE_SELECT.format(table=table) + """
+                WHERE e.timestamp >= :start AND e.timestamp < :end ORDER BY e.id
+            """, bounds, month)
+            conn.execute(text(f"DELETE FROM {table} WHERE timestamp >= :start AND timestamp < :end"), bounds)
+        archived.append((month, count))
+        app.logger.info(f"Archived and deleted {table} rows for {month:%Y-%m} ({count} rows)")
+    return archived
+
+def apply_retention(retention_months=None):
+    """
+    Archive click events older than the retention window to gzip JSONL files,
+    then remove them. On PostgreSQL whole monthly partitions are detached and
+    dropped, and expired rows in the default partition are deleted; elsewhere
+    the rows are deleted month by month.
+    Returns a list of (month, rows archived).
+    """
+    retention_months = app.config['CLICK_EVENT_RETENTION_MONTHS'] if retention_months is None else retention_months
+    cutoff = datetime.combine(_add_months(_month_start(datetime.utcnow()), -retention_months), datetime.min.time())
+    archived = []
+
+    if is_partitioned():
+        with db.engine.connect() as conn:
+            partitions = conn.execute(text("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = 'click_event' AND c.relname LIKE 'click_event_y%'
+                ORDER BY c.relname
+            """)).scalars().all()
+
+        for name in partitions:
+            month = date(int(name[13:17]), int(name[18:20]), 1)
+            if month >= cutoff.date():
+                continue
+            with db.engine.begin() as conn:
+                count = _export(conn, ARCHIVE_SELECT.format(table=name) + " ORDER BY e.id", {}, month)
+                conn.execute(text(f"ALTER TABLE click_event DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+            archived.append((month, count))
+            app.logger.info(f"Archived and dropped partition {name} ({count} rows)")
+        # Rows for months that had no partition when they were written
+        return archived + _archive_rows('click_event_default', cutoff)
+
+    return _archive_rows('click_event', cutoff)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ClickEvent partitioning and retention")
+    parser.add_argument("action", choices=["convert", "maintain"],
+                        help="convert: partition an existing PostgreSQL table of any size, blocking "
+                             "click event inserts until done; "
+                             "maintain: create upcoming partitions and archive expired ones")
+    parser.add_argument("--retention-months", type=int)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.action == "convert":
+            if convert_to_partitioned(max_rows=0):
+                print("click_event converted to a partitioned table.")
+            else:
+                print("Nothing to convert.")
+        else:
+            print(f"Ensured {ensure_partitions()} upcoming partitions.")
+            for month, count in apply_retention(args.retention_months):
+                print(f"Archived {month:%Y-%m}: {count} rows")
+            print("Maintenance completed!")
@@ -0,0 +1,112 @@
+import re
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a request runs more SQL statements than SQL_QUERY_BUDGET allows"""
+
+_local = threading.local()
+
+# Requests that ran the most statements in this worker: endpoint -> (count, top statements)
+_worst = {}
+_worst_lock = threading.Lock()
+
+def _normalize(statement):
+    """Collapse literals and whitespace so repeats of one query group together"""
+    statement = re.sub(r"'[^']*'|\b\d+\b", '?', statement)
+    return re.sub(r'\s+', ' ', statement).strip()[:200]
+
+def _current():
+    # Explicit counters from count_queries() take precedence over the request's
+    counter = getattr(_local, 'counter', None)
+    if counter is None and has_request_context():
+        counter = g.get('sql_statements')
+    return counter
+
+# Callables given the seconds each SQL statement took, from any thread
+statement_observers = []
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _current()
+    if counter is not None:
+        counter[_normalize(statement)] += 1
+    # Kept on the execution context, so a statement that fails leaves nothing behind
+    if context is not None:
+        context._sql_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_sql_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'sql_seconds' in g:
+        g.sql_seconds += elapsed
+    for observer in statement_observers:
+        observer(elapsed)
+
+def request_totals():
+    """(statements, seconds in SQL) for the current request so far, or None outside one"""
+    statements = g.get('sql_statements') if has_request_context() else None
+    if statements is None:
+        return None
+    return sum(statements.values()), g.get('sql_seconds', 0.0)
+
+@contextmanager
+def count_queries():
+    """
+    Count the statements run by this thread inside the block:
+
+        with count_queries() as statements:
+            ...
+        total = sum(statements.values())
+    """
+    previous = getattr(_local, 'counter', None)
+    _local.counter = Counter()
+    try:
+        yield _local.counter
+    finally:
+        _local.counter = previous
+
+def worst_endpoints(limit=10):
+    """Endpoints with the most statements in a single request, highest first"""
+    with _worst_lock:
+        return sorted(((endpoint, count, top) for endpoint, (count, top) in _worst.items()),
+                      key=lambda item: item[1], reverse=True)[:limit]
+
+@app.before_request
+def _start_counting():
+    g.sql_statements = Counter()
+    g.sql_seconds = 0.0
+
+@app.after_request
+def _check_budget(response):
+    # Left in g for metrics, whose after_request hook may run after this one
+    statements = g.get('sql_statements')
+    if statements is None:
+        return response
+    total = sum(statements.values())
+    endpoint = request.endpoint or request.path
+
+    with _worst_lock:
+        if total > _worst.get(endpoint, (0, None))[0]:
+            _worst[endpoint] = (total, statements.most_common(3))
+
+    if app.debug or app.testing:
+        response.headers['X-Query-Count'] = str(total)
+
+    budget = app.config['SQL_QUERY_BUDGET']
+    if budget and total > budget:
+        top = '; '.join(f"{count}x {statement}" for statement, count in statements.most_common(3))
+        message = f"{endpoint} ran {total} SQL statements (budget {budget}): {top}"
+        if app.config['SQL_QUERY_BUDGET_RAISE']:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
@@ -1,14 +1,20 @@
 import os
 import sys
-from app import app, db
-import models  # Import all models to ensure they're registered
+from app import app
+from schema import migrate
+from partitions import convert_to_partitioned, ensure_partitions
 
 def setup_database():
-    """Initialize the database tables"""
+    """Create the database tables and apply pending migrations"""
     with app.app_context():
-        print("Creating database tables...")
-        db.create_all()
-        print("Database tables created successfully!")
+        print("Applying database migrations...")
+        for version, name in migrate():
+            print(f"  {version}: {name}")
+        print("Database schema is up to date!")
+        
+        if convert_to_partitioned():
+            print("Click events converted to monthly partitions.")
+        ensure_partitions()
 
 def run_admin_setup():
     """Run the admin setup script"""
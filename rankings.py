@@ -0,0 +1,165 @@
+import time
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, update, delete, insert
+from sqlalchemy.orm import defer
+from app import app, db
+from models import Book, BookAnalytics, ClickEvent, BookRanking, TrendingScore, HighWaterMark, EVENT_TYPE_IDS
+from dimensions import committed_click_event_id
+import page_cache
+
+RANKINGS = ('most_viewed', 'most_downloaded', 'trending')
+
+# Points one event adds to a book's trending score
+EVENT_WEIGHTS = {'view': 1.0, 'download': 3.0, 'share': 5.0}
+WEIGHTS_BY_TYPE_ID = {EVENT_TYPE_IDS[event_type]: weight for event_type, weight in EVENT_WEIGHTS.items()}
+
+# Scores that have decayed below this are dropped
+MIN_TRENDING_SCORE = 0.01
+
+def _decay_factor(hours):
+    return 0.5 ** (hours / app.config['TRENDING_HALF_LIFE_HOURS'])
+
+def _seed_trending(now, last_id):
+    """
+    First run: score the last few half-lives of events, decayed by day,
+    instead of counting all of history at full weight
+    """
+    since = now - timedelta(hours=app.config['TRENDING_HALF_LIFE_HOURS'] * 7)
+    day_column = func.date(ClickEvent.timestamp)
+    rows = db.session.execute(
+        select(ClickEvent.book_id, day_column, ClickEvent.event_type_id, func.count())
+        .where(ClickEvent.timestamp >= since, ClickEvent.id <= last_id)
+        .group_by(ClickEvent.book_id, day_column, ClickEvent.event_type_id)
+    )
+    deltas = defaultdict(float)
+    for book_id, day, event_type_id, count in rows:
+        if isinstance(day, str):
+            day = datetime.strptime(day, '%Y-%m-%d').date()
+        # Treat each day's events as happening at noon
+        age = (now - datetime.combine(day, datetime.min.time()) - timedelta(hours=12)).total_seconds() / 3600
+        deltas[book_id] += WEIGHTS_BY_TYPE_ID.get(event_type_id, 0) * count * _decay_factor(max(age, 0))
+    TrendingScore.add_many(deltas)
+
+def _update_trending(now):
+    """
+    Decay the stored scores to now and add the events recorded since the
+    last run, so each run only reads new ClickEvent rows.
+    Returns the number of new events scored.
+    """
+    mark = HighWaterMark.get('trending')
+    # Retention can empty the table; the mark never moves back
+    last_id = max(committed_click_event_id(), mark.last_id)
+
+    if mark.updated_at is None:
+        _seed_trending(now, last_id)
+        new_events = 0
+    else:
+        hours = max((now - mark.updated_at).total_seconds() / 3600, 0)
+        db.session.execute(update(TrendingScore).values(score=TrendingScore.score * _decay_factor(hours)))
+        db.session.execute(delete(TrendingScore).where(TrendingScore.score < MIN_TRENDING_SCORE))
+
+        rows = db.session.execute(
+            select(ClickEvent.book_id, ClickEvent.event_type_id, func.count())
+            .where(ClickEvent.id > mark.last_id, ClickEvent.id <= last_id)
+            .group_by(ClickEvent.book_id, ClickEvent.event_type_id)
+        ).all()
+        deltas = defaultdict(float)
+        for book_id, event_type_id, count in rows:
+            deltas[book_id] += WEIGHTS_BY_TYPE_ID.get(event_type_id, 0) * count
+        TrendingScore.add_many(deltas)
+        new_events = sum(count for _, _, count in rows)
+
+    mark.last_id = last_id
+    mark.updated_at = now
+    return new_events
+
+def _ranked(ranking, category):
+    """Query of (book_id, score) for a ranking, best first"""
+    if ranking == 'trending':
+        score = TrendingScore.score
+        query = select(TrendingScore.book_id, score).join(Book, Book.id == TrendingScore.book_id)
+    else:
+        score = BookAnalytics.view_count if ranking == 'most_viewed' else BookAnalytics.download_count
+        query = select(BookAnalytics.book_id, score).join(Book, Book.id == BookAnalytics.book_id)
+    if category:
+        query = query.where(Book.category == category)
+    return query.where(score > 0).order_by(score.desc(), Book.id.desc()).limit(app.config['RANKING_SIZE'])
+
+def update_rankings():
+    """
+    Bring trending scores up to date and rebuild every top-N list, overall
+    and per category, in one transaction. Readers see either the old lists
+    or the new ones. Returns a summary of the run.
+    """
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    new_events = _update_trending(now)
+
+    categories = [''] + [
+        category for (category,) in db.session.execute(
+            select(Book.category).where(Book.category.isnot(None), Book.category != '').distinct()
+        )
+    ]
+    db.session.execute(delete(BookRanking))
+    rows = []
+    for ranking in RANKINGS:
+        for category in categories:
+            for position, (book_id, score) in enumerate(db.session.execute(_ranked(ranking, category)), 1):
+                rows.append({
+                    'ranking': ranking, 'category': category, 'position': position,
+                    'book_id': book_id, 'score': float(score), 'updated_at': now
+                })
+    if rows:
+        db.session.execute(insert(BookRanking), rows)
+    db.session.commit()
+    page_cache.invalidate('rankings')
+
+    return {
+        'new_events': new_events,
+        'categories': len(categories),
+        'rows': len(rows),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+def get_ranking(ranking, category=None, limit=10):
+    """
+    Books of a precomputed ranking in order, read with one indexed query
+    whatever the number of books or events
+    """
+    return (
+        Book.query.join(BookRanking, BookRanking.book_id == Book.id)
+        .filter(
+            BookRanking.ranking == ranking,
+            BookRanking.category == (category or ''),
+            BookRanking.position <= limit
+        )
+        .options(defer(Book.description))
+        .order_by(BookRanking.position)
+        .all()
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Popularity and trending rankings")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    update_parser = subparsers.add_parser("update", help="Update trending scores and rebuild the top-N lists")
+    update_parser.add_argument("--every", type=int, default=0, metavar="SECONDS",
+                               help="keep running, updating at this interval")
+    args = parser.parse_args()
+
+    with app.app_context():
+        while True:
+            try:
+                summary = update_rankings()
+                print(f"Rankings updated: {summary['new_events']} new events, "
+                      f"{summary['rows']} rows over {summary['categories']} lists per ranking "
+                      f"in {summary['seconds']}s")
+            except Exception as e:
+                db.session.rollback()
+                if not args.every:
+                    raise
+                app.logger.error(f"Rankings update failed: {e}")
+            if not args.every:
+                break
+            time.sleep(args.every)
@@ -0,0 +1,137 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from functools import wraps
+from flask import request, jsonify
+from app import app
+
+class MemoryBuckets:
+    """
+    Token buckets held in this process. Each gunicorn worker has its own,
+    so a client spread over several workers gets a proportionally higher limit.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if len(self._buckets) >= self.max_entries and key not in self._buckets:
+                self._prune(now, capacity, rate)
+            self._buckets[key] = (tokens, now)
+            return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def _prune(self, now, capacity, rate):
+        # Buckets that have refilled completely behave like missing ones
+        full_after = capacity / rate
+        self._buckets = {
+            key: entry for key, entry in self._buckets.items() if now - entry[1] < full_after
+        }
+
+class SQLiteBuckets:
+    """
+    Token buckets in a local SQLite file, shared by every worker process on
+    the machine, so limits hold however requests are spread across workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)"
+        )
+
+    def _connect(self):
+        # One connection per thread and process; sqlite3 connections can't be shared across forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate):
+        conn = self._connect()
+        # Wall-clock time, since monotonic clocks aren't comparable across processes
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(now - updated_at, 0) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            # Now and then, drop buckets that have refilled completely
+            if random.random() < 0.001:
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - capacity / rate,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+def _create_backend():
+    backend = app.config['RATE_LIMIT_BACKEND']
+    if backend == 'sqlite':
+        return SQLiteBuckets(app.config['RATE_LIMIT_PATH'])
+    if backend == 'memory':
+        return MemoryBuckets()
+    return None
+
+bucket_backend = _create_backend()
+
+# Requests refused per endpoint in this worker
+throttled = {}
+_throttled_lock = threading.Lock()
+
+def rate_limited(view):
+    """
+    Allow each client IP RATE_LIMIT_BURST requests to the view at once,
+    refilled at RATE_LIMIT_PER_MINUTE. Requests over the limit get a 429
+    with a Retry-After header before the view runs.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if bucket_backend is None:
+            return view(*args, **kwargs)
+
+        capacity = app.config['RATE_LIMIT_BURST']
+        rate = app.config['RATE_LIMIT_PER_MINUTE'] / 60
+        # remote_addr is the client's own address once ProxyFix has read X-Forwarded-For
+        key = f"{request.endpoint}:{request.remote_addr}"
+        try:
+            allowed, retry_after = bucket_backend.take(key, capacity, rate)
+        except Exception as e:
+            # Fail open; a broken limiter shouldn't take the endpoint down
+            app.logger.error(f"Rate limiter failed: {e}")
+            return view(*args, **kwargs)
+
+        if not allowed:
+            with _throttled_lock:
+                throttled[request.endpoint] = throttled.get(request.endpoint, 0) + 1
+            response = jsonify({'error': 'Too many requests'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response
+        return view(*args, **kwargs)
+    return wrapper
+
+def stats():
+    with _throttled_lock:
+        return dict(throttled)
@@ -1,52 +1,175 @@
-import os
+import hmac
+import json
 import uuid
+import zlib
 from datetime import datetime, timedelta
-from flask import render_template, request, redirect, url_for, flash, send_from_directory, jsonify, abort
+from flask import render_template, request, redirect, url_for, flash, jsonify, abort, make_response, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.utils import secure_filename
+from sqlalchemy.orm import contains_eager, defer, selectinload
 from app import app, db
-from models import User, Book, BookAnalytics, ClickEvent
+from models import User, Book, BookAnalytics, ClickEvent, DailyBookStats, DailyUniqueViewers, DailySiteViewers, BookRanking, TrendingScore
 from forms import LoginForm, BookForm
-from utils import save_file, delete_file, increment_analytics
+from utils import save_file, increment_analytics, track_events, get_book_page
+from analytics_buffer import analytics_buffer
+from event_filter import event_filter
+from search import search_books, index_book, remove_book
+from rankings import RANKINGS, get_ranking
+from downloads import send_book_file, download_filename, is_new_download
+from jobs import queue_upload, queue_release, status as job_status
+from auth_cache import SessionUser, login_throttle
+from rate_limit import rate_limited, stats as rate_limit_stats
+from db_routing import replica_reads
+from analytics_export import DATASETS, FORMATS, Export, encode, gzip_chunks, parse_since
+import page_cache
+import query_stats
+import metrics
 
 # Index/Home route
 @app.route('/')
+@replica_reads
 def index():
-    books = Book.query.order_by(Book.created_at.desc()).all()
-    return render_template('index.html', title='Digital Library', books=books, now=datetime.now())
+    cursor = request.args.get('cursor')
+    cache_key = page_cache.page_key('index', cursor=cursor)
+    cached = page_cache.get_page(cache_key)
+    if cached is not None:
+        return cached
+    
+    tags = ['catalogue', 'rankings']
+    generation = page_cache.begin_render(tags)
+    try:
+        books, next_cursor = get_book_page(cursor)
+    except ValueError:
+        abort(400)
+    html = render_template(
+        'index.html', title='Digital Library', books=books, next_cursor=next_cursor,
+        trending_books=get_ranking('trending'), popular_books=get_ranking('most_viewed'),
+        now=datetime.now()
+    )
+    page_cache.set_page(cache_key, html, tags, generation)
+    return html
+
+# Book listing API route for infinite scroll
+@app.route('/api/books')
+@replica_reads
+def list_books():
+    per_page = min(request.args.get('per_page', app.config['BOOKS_PER_PAGE'], type=int), app.config['MAX_BOOKS_PER_PAGE'])
+    try:
+        books, next_cursor = get_book_page(request.args.get('cursor'), per_page=max(per_page, 1), with_analytics=False)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return jsonify({
+        'books': [{
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'category': book.category,
+            'year': book.year,
+            'cover_url': url_for('static', filename=book.cover_variant('grid')) if book.cover_path else None,
+            'cover_fallback_url': url_for('static', filename=book.cover_variant('grid', 'jpeg')) if book.cover_path else None,
+            'url': url_for('book_detail', book_id=book.id)
+        } for book in books],
+        'next_cursor': next_cursor
+    })
+
+# Precomputed rankings API route, optionally for one category
+@app.route('/api/rankings/<ranking>')
+@replica_reads
+def rankings(ranking):
+    if ranking not in RANKINGS:
+        abort(404)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), app.config['RANKING_SIZE'])
+    books = get_ranking(ranking, category=request.args.get('category') or None, limit=limit)
+    
+    return jsonify({
+        'ranking': ranking,
+        'books': [{
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'category': book.category,
+            'year': book.year,
+            'cover_url': url_for('static', filename=book.cover_variant('grid')) if book.cover_path else None,
+            'cover_fallback_url': url_for('static', filename=book.cover_variant('grid', 'jpeg')) if book.cover_path else None,
+            'url': url_for('book_detail', book_id=book.id)
+        } for book in books]
+    })
 
 # Book detail route
 @app.route('/book/<int:book_id>')
+@replica_reads
 def book_detail(book_id):
+    cache_key = page_cache.page_key('book_detail', book_id=book_id)
+    cached = page_cache.get_page(cache_key)
+    if cached is not None:
+        # Cached pages still count as views
+        increment_analytics(book_id, 'view')
+        return cached
+    
+    tags = [f'book:{book_id}']
+    generation = page_cache.begin_render(tags)
     book = Book.query.get_or_404(book_id)
     # Record view event
     increment_analytics(book_id, 'view')
-    return render_template('book_detail.html', title=book.title, book=book, now=datetime.now())
+    html = render_template('book_detail.html', title=book.title, book=book, now=datetime.now())
+    page_cache.set_page(cache_key, html, tags, generation)
+    return html
 
 # Download book route
 @app.route('/book/<int:book_id>/download')
 def download_book(book_id):
     book = Book.query.get_or_404(book_id)
     
-    # Record download event
-    increment_analytics(book_id, 'download')
-    
     # Check if the book has a direct file or external URL
     if book.file_path:
-        # Get the filename from the file_path
-        filename = os.path.basename(book.file_path)
-        filepath = os.path.join('static', book.file_path)
-        directory = os.path.dirname(filepath)
-        return send_from_directory(directory=directory, path=filename, as_attachment=True)
+        response = send_book_file(book.file_path, download_filename(book.title, book.file_path))
+        
+        # Record download event once per transfer, not per range chunk
+        if is_new_download(response):
+            increment_analytics(book_id, 'download')
+        return response
     elif book.book_url:
+        # Record download event
+        increment_analytics(book_id, 'download')
+        
         # Redirect to external URL
         return redirect(book.book_url)
     else:
         flash('This book is not available for download.', 'error')
         return redirect(url_for('book_detail', book_id=book_id))
 
+# Search API route
+@app.route('/api/search')
+@replica_reads
+def search():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(request.args.get('per_page', app.config['BOOKS_PER_PAGE'], type=int), app.config['MAX_BOOKS_PER_PAGE'])
+    books, has_next = search_books(
+        request.args.get('q', ''),
+        category=request.args.get('category') or None,
+        page=page,
+        per_page=max(per_page, 1)
+    )
+    
+    return jsonify({
+        'books': [{
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'category': book.category,
+            'year': book.year,
+            'isbn': book.isbn,
+            'cover_url': url_for('static', filename=book.cover_variant('grid')) if book.cover_path else None,
+            'cover_fallback_url': url_for('static', filename=book.cover_variant('grid', 'jpeg')) if book.cover_path else None,
+            'url': url_for('book_detail', book_id=book.id)
+        } for book in books],
+        'page': page,
+        'has_next': has_next
+    })
+
 # Share book API route
 @app.route('/api/book/<int:book_id>/share', methods=['POST'])
+@rate_limited
 def share_book(book_id):
     book = Book.query.get_or_404(book_id)
     
@@ -63,12 +186,22 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
+        # Refuse throttled clients before spending time on a password hash
+        retry_after = login_throttle.retry_after(form.username.data, request.remote_addr)
+        if retry_after:
+            flash(f'Too many failed login attempts. Try again in {retry_after} seconds.', 'error')
+            response = make_response(render_template('login.html', title='Admin Login', form=form, now=datetime.now()), 429)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        
         user = User.query.filter_by(username=form.username.data).first()
         if user and user.check_password(form.password.data) and user.is_admin:
-            login_user(user)
+            login_throttle.record_success(form.username.data, request.remote_addr)
+            login_user(SessionUser(user))
             next_page = request.args.get('next')
             return redirect(next_page or url_for('admin_dashboard'))
         else:
+            login_throttle.record_failure(form.username.data, request.remote_addr)
             flash('Invalid username or password', 'error')
     
     return render_template('login.html', title='Admin Login', form=form, now=datetime.now())
@@ -83,16 +216,19 @@ def logout():
 
 # Admin dashboard route
 @app.route('/admin')
+@replica_reads
 @login_required
 def admin_dashboard():
     if not current_user.is_admin:
         abort(403)
     
     total_books = Book.query.count()
-    total_views = db.session.query(db.func.sum(BookAnalytics.view_count)).scalar() or 0
-    total_downloads = db.session.query(db.func.sum(BookAnalytics.download_count)).scalar() or 0
+    total_views, total_downloads = db.session.query(
+        db.func.coalesce(db.func.sum(BookAnalytics.view_count), 0),
+        db.func.coalesce(db.func.sum(BookAnalytics.download_count), 0)
+    ).one()
     
-    recent_books = Book.query.order_by(Book.created_at.desc()).limit(5).all()
+    recent_books = Book.query.options(selectinload(Book.analytics)).order_by(Book.created_at.desc()).limit(5).all()
     
     return render_template('admin/dashboard.html', 
                           title='Admin Dashboard',
@@ -104,13 +240,17 @@ def admin_dashboard():
 
 # Admin manage books route
 @app.route('/admin/books')
+@replica_reads
 @login_required
 def manage_books():
     if not current_user.is_admin:
         abort(403)
     
-    books = Book.query.order_by(Book.created_at.desc()).all()
-    return render_template('admin/manage_books.html', title='Manage Books', books=books, now=datetime.now())
+    try:
+        books, next_cursor = get_book_page(request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+    return render_template('admin/manage_books.html', title='Manage Books', books=books, next_cursor=next_cursor, now=datetime.now())
 
 # Admin add book route
 @app.route('/admin/books/add', methods=['GET', 'POST'])
@@ -133,24 +273,24 @@ def add_book():
             book_url=form.book_url.data
         )
         
-        # Handle cover image upload
+        # Uploads are staged as-is; the job worker moves them into the blob store
         if form.cover.data:
-            cover_path = save_file(form.cover.data, 'covers')
-            book.cover_path = cover_path
+            book.cover_path = save_file(form.cover.data, 'covers')
         
-        # Handle book file upload
         if form.book_file.data:
-            file_path = save_file(form.book_file.data, 'books')
-            book.file_path = file_path
+            book.file_path = save_file(form.book_file.data, 'books')
         
-        # Save to database
+        # Save the book, its analytics row, search entry and follow-up jobs in one commit
         db.session.add(book)
+        db.session.flush()
+        db.session.add(BookAnalytics(book_id=book.id))
+        index_book(book)
+        if book.cover_path:
+            queue_upload(book, 'cover_path')
+        if book.file_path:
+            queue_upload(book, 'file_path')
         db.session.commit()
-        
-        # Create analytics entry
-        analytics = BookAnalytics(book_id=book.id)
-        db.session.add(analytics)
-        db.session.commit()
+        page_cache.invalidate_book(book.id)
         
         flash('Book added successfully!', 'success')
         return redirect(url_for('manage_books'))
@@ -168,6 +308,10 @@ def edit_book(book_id):
     form = BookForm(obj=book)
     
     if form.validate_on_submit():
+        # Lock the book so a finalize_upload job can't repoint its files between
+        # reading the old paths here and queueing their release
+        db.session.refresh(book, with_for_update=True)
+        
         # Update book details
         book.title = form.title.data
         book.author = form.author.data
@@ -178,29 +322,30 @@ def edit_book(book_id):
         book.category = form.category.data
         book.book_url = form.book_url.data
         
-        # Handle cover image upload
+        # Handle cover image upload; the old cover is released by the job worker
         if form.cover.data:
-            # Delete old cover if exists
-            if book.cover_path:
-                delete_file(book.cover_path)
-            
-            cover_path = save_file(form.cover.data, 'covers')
-            book.cover_path = cover_path
+            old_cover = book.cover_path
+            book.cover_path = save_file(form.cover.data, 'covers')
+            book.cover_variants = None
+            queue_release(book.id, old_cover, book.cover_path)
+            queue_upload(book, 'cover_path')
         
         # Handle book file upload
         if form.book_file.data:
-            # Delete old file if exists
-            if book.file_path:
-                delete_file(book.file_path)
-            
-            file_path = save_file(form.book_file.data, 'books')
-            book.file_path = file_path
+            old_file = book.file_path
+            book.file_path = save_file(form.book_file.data, 'books')
+            queue_release(book.id, old_file, book.file_path)
+            queue_upload(book, 'file_path')
         
         # Update timestamp
         book.updated_at = datetime.utcnow()
         
+        # Refresh the search index
+        index_book(book)
+        
         # Save to database
         db.session.commit()
+        page_cache.invalidate_book(book.id)
         
         flash('Book updated successfully!', 'success')
         return redirect(url_for('manage_books'))
@@ -214,66 +359,209 @@ def delete_book(book_id):
     if not current_user.is_admin:
         abort(403)
     
-    book = Book.query.get_or_404(book_id)
-    
-    # Delete associated files
-    if book.cover_path:
-        delete_file(book.cover_path)
+    # Locked, so the paths released are the ones the book points at when it's deleted
+    book = Book.query.filter_by(id=book_id).with_for_update().first_or_404()
     
-    if book.file_path:
-        delete_file(book.file_path)
+    # Release associated files once the deletion is committed
+    queue_release(book.id, book.cover_path)
+    queue_release(book.id, book.file_path)
     
     # Delete analytics data
     BookAnalytics.query.filter_by(book_id=book.id).delete()
     ClickEvent.query.filter_by(book_id=book.id).delete()
+    DailyBookStats.query.filter_by(book_id=book.id).delete()
+    DailyUniqueViewers.query.filter_by(book_id=book.id).delete()
+    BookRanking.query.filter_by(book_id=book.id).delete()
+    TrendingScore.query.filter_by(book_id=book.id).delete()
+    remove_book(book.id)
     
     # Delete book
     db.session.delete(book)
     db.session.commit()
+    page_cache.invalidate_book(book_id)
     
     flash('Book deleted successfully!', 'success')
     return redirect(url_for('manage_books'))
 
 # Admin analytics route
 @app.route('/admin/analytics')
+@replica_reads
 @login_required
 def admin_analytics():
     if not current_user.is_admin:
         abort(403)
     
-    books = Book.query.join(BookAnalytics).all()
+    # The most viewed books a page at a time, with their analytics loaded from the join
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['BOOKS_PER_PAGE']
+    books = (
+        Book.query.join(BookAnalytics)
+        .options(contains_eager(Book.analytics), defer(Book.description))
+        .order_by(BookAnalytics.view_count.desc(), Book.id)
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1)
+        .all()
+    )
+    has_next = len(books) > per_page
+    books = books[:per_page]
+    book_ids = [book.id for book in books]
     
-    # Get daily click data for the past 30 days
+    # Get daily click totals for the past 30 days from the rollup table
     thirty_days_ago = datetime.utcnow().date() - timedelta(days=30)
-    daily_clicks = ClickEvent.query.filter(ClickEvent.timestamp >= thirty_days_ago).all()
+    daily_clicks = (
+        db.session.query(DailyBookStats.date, DailyBookStats.event_type, db.func.sum(DailyBookStats.count))
+        .filter(DailyBookStats.date >= thirty_days_ago)
+        .group_by(DailyBookStats.date, DailyBookStats.event_type)
+        .order_by(DailyBookStats.date)
+        .all()
+    )
+    
+    # Per-book totals over the same window for the books on this page
+    book_clicks = (
+        db.session.query(DailyBookStats.book_id, DailyBookStats.event_type, db.func.sum(DailyBookStats.count))
+        .filter(DailyBookStats.date >= thirty_days_ago, DailyBookStats.book_id.in_(book_ids))
+        .group_by(DailyBookStats.book_id, DailyBookStats.event_type)
+        .all()
+    )
+    
+    # Distinct visitors, estimated from the daily sketches
+    unique_viewers = DailyUniqueViewers.estimate(thirty_days_ago, book_ids)
+    daily_unique_viewers = DailySiteViewers.estimate(thirty_days_ago)
     
     return render_template('admin/analytics.html', 
                           title='Analytics Dashboard',
                           books=books,
+                          page=page,
+                          has_next=has_next,
                           daily_clicks=daily_clicks,
+                          book_clicks=book_clicks,
+                          unique_viewers=unique_viewers,
+                          daily_unique_viewers=daily_unique_viewers,
                           now=datetime.now(),
                           date_today=datetime.utcnow(),
                           timedelta=timedelta)
 
-# API route for tracking events
-@app.route('/api/track', methods=['POST'])
-def track_event():
-    data = request.json
-    book_id = data.get('book_id')
-    event_type = data.get('event_type')
+# Admin analytics buffer stats route
+@app.route('/admin/analytics/buffer')
+@login_required
+def analytics_buffer_stats():
+    if not current_user.is_admin:
+        abort(403)
     
-    if not book_id or not event_type:
-        return jsonify({'error': 'Missing required parameters'}), 400
+    return jsonify(dict(analytics_buffer.stats(), filter=event_filter.stats(), rate_limited=rate_limit_stats()))
+
+# Admin SQL statement counts route: the heaviest request seen per endpoint in this worker
+@app.route('/admin/queries')
+@login_required
+def query_stats_view():
+    if not current_user.is_admin:
+        abort(403)
     
-    # Check if book exists
-    book = Book.query.get(book_id)
-    if not book:
-        return jsonify({'error': 'Book not found'}), 404
+    return jsonify({'endpoints': [
+        {'endpoint': endpoint, 'statements': count,
+         'top': [{'statement': statement, 'count': repeats} for statement, repeats in top]}
+        for endpoint, count, top in query_stats.worst_endpoints(request.args.get('limit', 10, type=int))
+    ]})
+
+# Admin background job status route
+@app.route('/admin/jobs')
+@login_required
+def job_queue_status():
+    if not current_user.is_admin:
+        abort(403)
     
-    # Record the event
-    success = increment_analytics(book_id, event_type)
+    return jsonify(job_status())
+
+def _has_bearer_token(token):
+    authorization = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(authorization, f'Bearer {token}')
+
+# Streaming analytics export route for the data warehouse
+@app.route('/api/export/<dataset>')
+def export_analytics(dataset):
+    if not _has_bearer_token(app.config['EXPORT_TOKEN']) and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    if dataset not in DATASETS:
+        abort(404)
     
-    if success:
-        return jsonify({'success': True})
+    file_format = request.args.get('format', 'ndjson')
+    if file_format not in FORMATS:
+        return jsonify({'error': 'Invalid format'}), 400
+    try:
+        export = Export(
+            dataset,
+            start=datetime.fromisoformat(request.args['start']) if request.args.get('start') else None,
+            end=datetime.fromisoformat(request.args['end']) if request.args.get('end') else None,
+            book_id=request.args.get('book_id', type=int),
+            event_type=request.args.get('event_type') or None,
+            since=parse_since(dataset, request.args.get('since')),
+            consumer=request.args.get('consumer') or None,
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    chunks = encode(export, file_format)
+    headers = {
+        'X-Next-Since': export.next_since_param(),
+        'Cache-Control': 'no-store',
+        'Content-Disposition': f'attachment; filename={dataset}.{file_format}',
+    }
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
     else:
-        return jsonify({'error': 'Failed to record event'}), 500
+        chunks = (chunk.encode('utf-8') for chunk in chunks)
+    return Response(stream_with_context(chunks), mimetype=FORMATS[file_format], headers=headers)
+
+# Prometheus metrics route
+@app.route('/metrics')
+def prometheus_metrics():
+    if not _has_bearer_token(app.config['METRICS_TOKEN']) and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# API route for tracking events
+@app.route('/api/track', methods=['POST'])
+@rate_limited
+def track_event():
+    # The same validation as a one-event batch, so a body that isn't an object is a 400, not a 500
+    result = track_events([request.get_json(silent=True)])[0]
+    if result['status'] != 'rejected':
+        return jsonify({'success': True})
+    status = {'Book not found': 404, 'Failed to record event': 500}.get(result['error'], 400)
+    return jsonify({'error': result['error']}), status
+
+# API route for tracking a batch of events in one request
+@app.route('/api/track/batch', methods=['POST'])
+@rate_limited
+def track_batch():
+    body = request.get_data()
+    max_bytes = app.config['TRACK_BATCH_MAX_BYTES']
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        # Bound the decompressed size so a small upload can't expand without limit
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        try:
+            body = decompressor.decompress(body, max_bytes)
+        except zlib.error:
+            return jsonify({'error': 'Invalid gzip body'}), 400
+        if decompressor.unconsumed_tail:
+            return jsonify({'error': 'Batch too large'}), 413
+    elif len(body) > max_bytes:
+        return jsonify({'error': 'Batch too large'}), 413
+    
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({'error': 'Invalid JSON'}), 400
+    events = data.get('events') if isinstance(data, dict) else data
+    if not isinstance(events, list) or not events:
+        return jsonify({'error': 'Expected a list of events'}), 400
+    if len(events) > app.config['TRACK_BATCH_MAX_EVENTS']:
+        return jsonify({'error': f"At most {app.config['TRACK_BATCH_MAX_EVENTS']} events per batch"}), 413
+    
+    results = track_events(events)
+    return jsonify({
+        'results': results,
+        'recorded': sum(1 for result in results if result['status'] == 'recorded')
+    })
@@ -0,0 +1,280 @@
+import sys
+from datetime import datetime
+from sqlalchemy import text, inspect
+from app import app, db
+import models  # Register every model on db.metadata
+from hyperloglog import HyperLogLog
+
+# Versioned schema migrations, applied in order by migrate() from the release
+# step. Each runs once in its own transaction, or in several if it works in
+# batches, and is recorded in the schema_version table. Append new migrations; never edit applied ones.
+#
+# Databases created before versioning went through db.create_all() and the old
+# idempotent upgrade statements, so every migration must also be safe to run
+# against a schema that already has its changes.
+
+# Arbitrary key for the PostgreSQL advisory lock that serialises concurrent releases
+MIGRATION_LOCK_KEY = 724311
+
+# Click events converted per batch when moving their strings to lookup tables
+COMPACT_BATCH_SIZE = 10000
+
+def _create_tables(conn):
+    """Create any missing tables from the models"""
+    db.metadata.create_all(conn)
+
+def _unique_book_analytics(conn):
+    # Merge duplicate analytics rows into the oldest one before enforcing one row per book
+    conn.execute(text("""
+        UPDATE book_analytics SET
+            view_count = (SELECT SUM(COALESCE(b2.view_count, 0)) FROM book_analytics b2 WHERE b2.book_id = book_analytics.book_id),
+            download_count = (SELECT SUM(COALESCE(b2.download_count, 0)) FROM book_analytics b2 WHERE b2.book_id = book_analytics.book_id),
+            share_count = (SELECT SUM(COALESCE(b2.share_count, 0)) FROM book_analytics b2 WHERE b2.book_id = book_analytics.book_id)
+        WHERE id IN (SELECT MIN(id) FROM book_analytics GROUP BY book_id HAVING COUNT(*) > 1)
+    """))
+    conn.execute(text("DELETE FROM book_analytics WHERE id NOT IN (SELECT MIN(id) FROM book_analytics GROUP BY book_id)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_book_analytics_book_id ON book_analytics (book_id)"))
+
+def _catalogue_indexes(conn):
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_book_created_at_id ON book (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_isbn ON book (isbn)",
+        "CREATE INDEX IF NOT EXISTS ix_book_category_created_at_id ON book (category, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_click_event_book_id_timestamp ON click_event (book_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_click_event_timestamp ON click_event (timestamp)",
+    ]:
+        conn.execute(text(statement))
+
+def _full_text_search(conn):
+    if conn.dialect.name == 'postgresql':
+        # Full-text search vector maintained by search.index_book
+        conn.execute(text("ALTER TABLE book ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_book_search_vector ON book USING GIN (search_vector)"))
+    elif conn.dialect.name == 'sqlite':
+        # FTS5 table for offline development and tests, keyed by book id
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+                title, author, publisher, description, category,
+                tokenize = 'unicode61', prefix = '2 3 4', detail = column
+            )
+        """))
+
+def _add_column(conn, table_name, column_name):
+    """Add a model column that an existing table doesn't have yet"""
+    existing = {column['name'] for column in inspect(conn).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = db.metadata.tables[table_name].c[column_name]
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+
+def _book_cover_variants(conn):
+    _add_column(conn, 'book', 'cover_variants')
+
+def _daily_unique_viewers(conn):
+    db.metadata.create_all(conn, tables=[models.DailyUniqueViewers.__table__])
+
+def _rankings(conn):
+    db.metadata.create_all(conn, tables=[
+        models.BookRanking.__table__, models.TrendingScore.__table__, models.HighWaterMark.__table__,
+    ])
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_book_analytics_view_count ON book_analytics (view_count)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_book_analytics_download_count ON book_analytics (download_count)"))
+
+def _jobs(conn):
+    db.metadata.create_all(conn, tables=[models.Job.__table__])
+
+def _export_marks(conn):
+    _add_column(conn, 'high_water_mark', 'last_timestamp')
+
+def _compact_click_events(conn):
+    """
+    Move click event strings to lookup tables and pack IPs. Large tables are
+    converted in id ranges of COMPACT_BATCH_SIZE, each committed on its own
+    (see migrate()), with the last converted id kept in compact_progress so
+    an interrupted release picks up where it stopped.
+    """
+    columns = {column['name'] for column in inspect(conn).get_columns('click_event')}
+    if 'ip_packed' not in columns:
+        _prepare_compaction(conn, columns)
+        # Commit the new tables and columns before converting any rows
+        return 'event_type' not in columns
+
+    # Addresses are converted inside the database, like IPAddress: invalid ones become NULL
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("""
+            CREATE OR REPLACE FUNCTION pg_temp.to_inet(value text) RETURNS inet AS $$
+            BEGIN
+                RETURN value::inet;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql IMMUTABLE
+        """))
+        pack_ip = "pg_temp.to_inet(ip_address)"
+    else:
+        conn.connection.driver_connection.create_function('pack_ip', 1, models._pack_ip, deterministic=True)
+        pack_ip = "pack_ip(ip_address)"
+    convert = f"""
+        UPDATE click_event SET
+            event_type_id = (SELECT id FROM event_type WHERE name = click_event.event_type),
+            user_agent_id = (SELECT id FROM user_agent WHERE value = click_event.user_agent),
+            referrer_id = (SELECT id FROM referrer WHERE value = click_event.referrer),
+            ip_packed = {pack_ip}
+    """
+
+    last_id = conn.execute(text("SELECT last_id FROM compact_progress")).scalar()
+    high = conn.execute(text("SELECT MAX(id) FROM click_event")).scalar() or 0
+    if last_id < high:
+        end = last_id + COMPACT_BATCH_SIZE
+        conn.execute(text(convert + " WHERE id > :start AND id <= :end"), {'start': last_id, 'end': end})
+        conn.execute(text("UPDATE compact_progress SET last_id = :end"), {'end': end})
+        app.logger.info(f"Compacted click events up to id {min(end, high)} of {high}")
+        return False
+
+    # Rows written by the previous release while the batches ran are converted under
+    # the lock the column changes take anyway, which is held until this commits
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("LOCK TABLE click_event IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text(convert + " WHERE id > :start"), {'start': last_id})
+    for column in ('event_type', 'user_agent', 'ip_address', 'referrer'):
+        conn.execute(text(f"ALTER TABLE click_event DROP COLUMN {column}"))
+    conn.execute(text("ALTER TABLE click_event RENAME COLUMN ip_packed TO ip_address"))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("ALTER TABLE click_event ALTER COLUMN event_type_id SET NOT NULL"))
+        for column, table in [('event_type_id', 'event_type'), ('user_agent_id', 'user_agent'), ('referrer_id', 'referrer')]:
+            conn.execute(text(f"ALTER TABLE click_event ADD FOREIGN KEY ({column}) REFERENCES {table} (id)"))
+    conn.execute(text("DROP TABLE compact_progress"))
+
+def _prepare_compaction(conn, columns):
+    db.metadata.create_all(conn, tables=[
+        models.EventType.__table__, models.UserAgent.__table__, models.Referrer.__table__,
+    ])
+    existing = set(conn.execute(text("SELECT name FROM event_type")).scalars())
+    for name, type_id in models.EVENT_TYPE_IDS.items():
+        if name not in existing:
+            conn.execute(text("INSERT INTO event_type (id, name) VALUES (:id, :name)"), {'id': type_id, 'name': name})
+    if conn.dialect.name == 'postgresql':
+        # Custom event types are numbered after the built-in ones
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('event_type', 'id'), (SELECT MAX(id) FROM event_type))"))
+
+    if 'event_type' not in columns:
+        return
+    for table, column, source in [
+        ('event_type', 'name', 'event_type'),
+        ('user_agent', 'value', 'user_agent'),
+        ('referrer', 'value', 'referrer'),
+    ]:
+        conn.execute(text(f"""
+            INSERT INTO {table} ({column})
+            SELECT DISTINCT {source} FROM click_event
+            WHERE {source} IS NOT NULL AND {source} NOT IN (SELECT {column} FROM {table})
+        """))
+    for column in ('event_type_id', 'user_agent_id', 'referrer_id'):
+        _add_column(conn, 'click_event', column)
+    ip_type = models.ClickEvent.__table__.c.ip_address.type
+    conn.execute(text(f"ALTER TABLE click_event ADD COLUMN ip_packed {ip_type.compile(dialect=conn.dialect)}"))
+    conn.execute(text("CREATE TABLE compact_progress (last_id INTEGER NOT NULL)"))
+    conn.execute(text("INSERT INTO compact_progress (last_id) VALUES (0)"))
+
+def _normalize_isbns(conn):
+    # Same form as models.normalize_isbn, so search and the catalogue import match either spelling
+    conn.execute(text(
+        "UPDATE book SET isbn = upper(replace(replace(isbn, '-', ''), ' ', '')) "
+        "WHERE isbn LIKE '%-%' OR isbn LIKE '% %' OR isbn <> upper(isbn)"
+    ))
+
+def _daily_site_viewers(conn):
+    db.metadata.create_all(conn, tables=[models.DailySiteViewers.__table__])
+    if conn.execute(text("SELECT 1 FROM daily_site_viewers LIMIT 1")).first():
+        return
+    # Merge the per-book sketches of past days; today's are still changing and are merged when read
+    merged = {}
+    for date, data in conn.execute(
+        db.select(models.DailyUniqueViewers.date, models.DailyUniqueViewers.sketch)
+        .where(models.DailyUniqueViewers.date < datetime.utcnow().date())
+    ):
+        merged.setdefault(date, HyperLogLog()).merge_bytes(data)
+    if merged:
+        conn.execute(models.DailySiteViewers.__table__.insert(), [
+            {'date': date, 'sketch': sketch.to_bytes()} for date, sketch in merged.items()
+        ])
+
+MIGRATIONS = [
+    (1, 'create tables', _create_tables),
+    (2, 'one analytics row per book', _unique_book_analytics),
+    (3, 'catalogue and click event indexes', _catalogue_indexes),
+    (4, 'full-text search index', _full_text_search),
+    (5, 'book cover variants', _book_cover_variants),
+    (6, 'daily unique viewer sketches', _daily_unique_viewers),
+    (7, 'popularity and trending rankings', _rankings),
+    (8, 'background job queue', _jobs),
+    (9, 'timestamp high-water marks for exports', _export_marks),
+    (10, 'click event strings in lookup tables', _compact_click_events),
+    (11, 'normalized ISBNs', _normalize_isbns),
+    (12, 'daily site-wide unique viewer sketches', _daily_site_viewers),
+]
+
+def _ensure_version_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+def applied_versions(conn):
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+def migrate():
+    """
+    Apply pending migrations in order. Returns the (version, name) pairs applied.
+    A migration that returns False has committed part of its work and is run
+    again in a new transaction until it finishes.
+    """
+    applied = []
+    with db.engine.connect() as conn:
+        with conn.begin():
+            _ensure_version_table(conn)
+        for version, name, apply in MIGRATIONS:
+            done = False
+            while not done:
+                with conn.begin():
+                    if conn.dialect.name == 'postgresql':
+                        # Another release running at the same time waits here, then skips what it applied
+                        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+                    if version in applied_versions(conn):
+                        break
+                    done = apply(conn) is not False
+                    if done:
+                        conn.execute(text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                                     {'version': version, 'name': name})
+            if done:
+                app.logger.info(f"Applied migration {version}: {name}")
+                applied.append((version, name))
+    return applied
+
+def pending_migrations():
+    """Return the (version, name) pairs not yet applied"""
+    with db.engine.connect() as conn:
+        done = applied_versions(conn)
+        conn.commit()
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in done]
+
+if __name__ == "__main__":
+    action = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+
+    with app.app_context():
+        if action == "status":
+            pending = pending_migrations()
+            for version, name in pending:
+                print(f"Pending: {version} {name}")
+            print(f"{len(MIGRATIONS) - len(pending)} of {len(MIGRATIONS)} migrations applied.")
+        elif action == "migrate":
+            applied = migrate()
+            print(f"Applied {len(applied)} migrations." if applied else "Schema is up to date.")
+        else:
+            print("Usage: python schema.py [migrate|status]")
+            sys.exit(1)
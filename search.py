@@ -0,0 +1,229 @@
+import re
+import sys
+from sqlalchemy import text, bindparam
+from sqlalchemy.orm import defer
+from app import app, db
+from models import Book, normalize_isbn
+
+# Longest query we tokenize; anything past this is ignored
+MAX_QUERY_TERMS = 8
+
+ISBN_PATTERN = re.compile(r'^(?:\d[\d-]{8,15}[\dXx])$')
+
+def _dialect():
+    return db.engine.dialect.name
+
+def _terms(query):
+    """
+    Split a user query into lowercase tokens the way the index splits text.
+    On PostgreSQL that's the 'simple' parser itself, which keeps '3.14' and
+    'self-help' as tokens that \\w+ would break apart.
+    """
+    if _dialect() == 'postgresql':
+        return [row[0] for row in db.session.execute(
+            text("SELECT lexeme FROM unnest(to_tsvector('simple', :query)) ORDER BY positions[1] LIMIT :limit").columns(),
+            {'query': query, 'limit': MAX_QUERY_TERMS}
+        )]
+    return re.findall(r'\w+', query.lower())[:MAX_QUERY_TERMS]
+
+def _tsquery_term(term):
+    """Quote a lexeme for to_tsquery, so characters like ':' or '&' in it aren't operators"""
+    return "'" + term.replace('\\', '\\\\').replace("'", "''") + "'"
+
+def _category_token(category):
+    """Single FTS token for a category, so 'self-help' isn't split in two"""
+    return re.sub(r'\W', '', category or '').lower()
+
+# Weighted document vector for PostgreSQL: title ranks above author, then publisher, then description
+SEARCH_VECTOR_SQL = """
+    setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(author, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(publisher, '')), 'C') ||
+    setweight(to_tsvector('simple', coalesce(description, '')), 'D')
+"""
+
+def _insert_fts_rows(rows):
+    db.session.execute(text("""
+        INSERT INTO book_fts (rowid, title, author, publisher, description, category)
+        VALUES (:id, :title, :author, :publisher, :description, :category)
+    """), [dict(row, category=_category_token(row['category'])) for row in rows])
+
+def index_book(book):
+    """Add or refresh a book's entry in the full-text index"""
+    # Make sure the row and its id reflect any pending changes
+    db.session.flush()
+    index_books([book.id])
+
+def index_books(book_ids):
+    """Add or refresh the full-text index entries for several books at once"""
+    if not book_ids:
+        return
+    ids = bindparam('ids', expanding=True)
+    if _dialect() == 'postgresql':
+        db.session.execute(
+            text(f"UPDATE book SET search_vector = {SEARCH_VECTOR_SQL} WHERE id IN :ids").bindparams(ids),
+            {'ids': list(book_ids)}
+        )
+        return
+    
+    db.session.execute(text("DELETE FROM book_fts WHERE rowid IN :ids").bindparams(ids), {'ids': list(book_ids)})
+    rows = db.session.execute(
+        text("""
+            SELECT id, title, author, coalesce(publisher, '') AS publisher,
+                   coalesce(description, '') AS description, category
+            FROM book WHERE id IN :ids
+        """).bindparams(ids),
+        {'ids': list(book_ids)}
+    ).mappings().all()
+    if rows:
+        _insert_fts_rows(rows)
+
+def remove_book(book_id):
+    """Remove a book from the full-text index"""
+    if _dialect() != 'postgresql':
+        db.session.execute(text("DELETE FROM book_fts WHERE rowid = :id"), {'id': book_id})
+
+def reindex_all(batch_size=1000):
+    """Rebuild the full-text index for every book"""
+    if _dialect() == 'postgresql':
+        db.session.execute(text(f"UPDATE book SET search_vector = {SEARCH_VECTOR_SQL}"))
+        db.session.commit()
+        return Book.query.count()
+
+    db.session.execute(text("DELETE FROM book_fts"))
+    count = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(text("""
+            SELECT id, title, author, coalesce(publisher, '') AS publisher,
+                   coalesce(description, '') AS description, category
+            FROM book WHERE id > :last_id ORDER BY id LIMIT :limit
+        """), {'last_id': last_id, 'limit': batch_size}).mappings().all()
+        if not rows:
+            break
+        _insert_fts_rows(rows)
+        count += len(rows)
+        last_id = rows[-1]['id']
+    db.session.commit()
+    return count
+
+def _ranked_ids(terms, category, limit, offset):
+    """
+    Return ids of matching books, best first. Every term must match; the last
+    one is matched as a prefix so partially typed words still hit.
+
+    Queries matching up to SEARCH_MAX_CANDIDATES books are ranked in full.
+    Broader ones rank their title matches, which outrank body matches anyway,
+    and only the newest SEARCH_MAX_CANDIDATES of those if there are more;
+    every other match follows, newest first. Ranking cost stays bounded, and
+    every match is still on some page.
+    """
+    params = {'category': category, 'skip': app.config['SEARCH_MAX_CANDIDATES']}
+
+    if _dialect() == 'postgresql':
+        table, id_column = 'book', 'id'
+        quoted = [_tsquery_term(term) for term in terms]
+        params['query'] = ' & '.join(quoted[:-1] + [f"{quoted[-1]}:*"])
+        # Weight A is the title
+        params['title_query'] = ' & '.join([f"{term}:A" for term in quoted[:-1]] + [f"{quoted[-1]}:*A"])
+        match = "search_vector @@ to_tsquery('simple', :query)"
+        title_match = "search_vector @@ to_tsquery('simple', :title_query)"
+        if category:
+            match += " AND category = :category"
+            title_match += " AND category = :category"
+        rank = "ts_rank_cd(search_vector, to_tsquery('simple', :query)) DESC"
+    else:
+        table, id_column = 'book_fts', 'rowid'
+        query = ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+        # Filter inside the index instead of joining every match to book
+        category_filter = f' AND category : "{_category_token(category)}"' if category else ''
+        params['query'] = query + category_filter
+        params['title_query'] = f'title : ({query}){category_filter}'
+        match = "book_fts MATCH :query"
+        title_match = "book_fts MATCH :title_query"
+        # bm25 is lower-is-better; column weights mirror the tsvector weights
+        rank = "bm25(book_fts, 10.0, 5.0, 2.0, 1.0, 0.0)"
+
+    # columns() makes these textual SELECTs, which db_routing may send to the read replica
+    def ids(sql, **extra):
+        return [row[0] for row in db.session.execute(text(sql).columns(), dict(params, **extra))]
+
+    def ranked(where, limit, offset):
+        return ids(
+            f"SELECT {id_column} FROM {table} WHERE {where} "
+            f"ORDER BY {rank}, {id_column} DESC LIMIT :limit OFFSET :offset",
+            limit=limit, offset=offset
+        )
+
+    def newest_beyond_skip(where):
+        found = ids(f"SELECT {id_column} FROM {table} WHERE {where} ORDER BY {id_column} DESC LIMIT 1 OFFSET :skip")
+        return found[0] if found else None
+
+    if newest_beyond_skip(match) is None:
+        return ranked(match, limit, offset)
+
+    bound = newest_beyond_skip(title_match)
+    window = f"{title_match} AND {id_column} > :bound"
+    params['bound'] = bound or 0
+    found = ranked(window, limit, offset)
+    if len(found) == limit:
+        return found
+
+    window_size = db.session.execute(
+        text(f"SELECT count(*) FROM {table} WHERE {window}").columns(), params
+    ).scalar()
+    return found + ids(
+        f"SELECT {id_column} FROM {table} WHERE {match} "
+        f"AND {id_column} NOT IN (SELECT {id_column} FROM {table} WHERE {window}) "
+        f"ORDER BY {id_column} DESC LIMIT :limit OFFSET :offset",
+        limit=limit - len(found), offset=max(offset - window_size, 0)
+    )
+
+def search_books(query, category=None, page=1, per_page=None):
+    """
+    Search the catalogue. Returns (books, has_next) for the requested page.
+    ISBNs and bare category filters are answered with indexed exact matches;
+    everything else goes through the full-text index ranked by relevance.
+    """
+    per_page = per_page or app.config['BOOKS_PER_PAGE']
+    offset = (page - 1) * per_page
+    query = (query or '').strip()
+    base = Book.query.options(defer(Book.description))
+
+    # Exact-match fast path for ISBNs
+    if ISBN_PATTERN.match(query):
+        books = base.filter(Book.isbn == normalize_isbn(query)).order_by(Book.id.desc()).all()
+        if category:
+            books = [book for book in books if book.category == category]
+        return books[offset:offset + per_page], len(books) > offset + per_page
+
+    terms = _terms(query)
+
+    # Category browsing without a text query
+    if not terms:
+        if not category:
+            return [], False
+        books = (
+            base.filter(Book.category == category)
+            .order_by(Book.created_at.desc(), Book.id.desc())
+            .limit(per_page + 1).offset(offset).all()
+        )
+        return books[:per_page], len(books) > per_page
+
+    ids = _ranked_ids(terms, category, per_page + 1, offset)
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    if not ids:
+        return [], False
+
+    books = {book.id: book for book in base.filter(Book.id.in_(ids))}
+    return [books[book_id] for book_id in ids if book_id in books], has_next
+
+if __name__ == "__main__":
+    action = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if action == "reindex":
+        with app.app_context():
+            print(f"Indexed {reindex_all()} books.")
+    else:
+        print("Usage: python search.py reindex")
@@ -0,0 +1,117 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import update
+from app import app, db
+from models import Book
+import page_cache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; covers are served at full size without it
+    Image = None
+
+# Variant name -> bounding box in pixels
+COVER_SIZES = {
+    'grid': (240, 360),
+    'detail': (480, 720),
+    'retina': (960, 1440),
+}
+
+# WebP for browsers that support it, JPEG as the fallback
+COVER_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'], thread_name_prefix='thumbnails')
+    return _executor
+
+def generate_variants(cover_path):
+    """
+    Write every size and format of a cover and return {size: {format: path}}
+    with paths relative to the static folder. Variants are named after the
+    source file, so books sharing a cover blob share its variants too.
+    """
+    source = os.path.join('static', cover_path)
+    stem = os.path.splitext(os.path.basename(cover_path))[0]
+    relative_dir = os.path.join('uploads', 'covers', 'variants', stem[:2])
+    os.makedirs(os.path.join('static', relative_dir), exist_ok=True)
+
+    with Image.open(source) as original:
+        # Apply the EXIF rotation before the metadata is dropped
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        variants = {}
+        for size, box in COVER_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail(box, Image.LANCZOS)
+            variants[size] = {}
+            for image_format, options in COVER_FORMATS.items():
+                extension = 'jpg' if image_format == 'jpeg' else image_format
+                relative_path = os.path.join(relative_dir, f"{stem}_{size}.{extension}")
+                full_path = os.path.join('static', relative_path)
+                if not os.path.exists(full_path):
+                    # Saving a fresh image writes no EXIF or other metadata
+                    tmp_path = f"{full_path}.tmp"
+                    resized.save(tmp_path, **options)
+                    os.replace(tmp_path, full_path)
+                variants[size][image_format] = relative_path
+    return variants
+
+def process_cover(book_id, cover_path):
+    """Generate a book's cover variants and record them on the book"""
+    try:
+        variants = generate_variants(cover_path)
+    except Exception as e:
+        app.logger.error(f"Error generating cover variants for book {book_id}: {e}")
+        return None
+
+    with app.app_context():
+        # Skip the update if the cover was replaced while we were working
+        db.session.execute(
+            update(Book)
+            .where(Book.id == book_id, Book.cover_path == cover_path)
+            .values(cover_variants=variants)
+        )
+        db.session.commit()
+    
+    # Pages embed the cover paths
+    page_cache.invalidate_book(book_id)
+    return variants
+
+def regenerate_all(missing_only=False):
+    """Regenerate cover variants for every book with a cover"""
+    query = Book.query.filter(Book.cover_path.isnot(None))
+    if missing_only:
+        query = query.filter(Book.cover_variants.is_(None))
+    books = [(book.id, book.cover_path) for book in query.with_entities(Book.id, Book.cover_path)]
+
+    futures = [_get_executor().submit(process_cover, book_id, cover_path) for book_id, cover_path in books]
+    return sum(1 for future in futures if future.result() is not None)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cover image variants")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    regenerate_parser = subparsers.add_parser("regenerate", help="Regenerate resized covers for existing books")
+    regenerate_parser.add_argument("--missing-only", action="store_true",
+                                   help="only books whose variants haven't been generated")
+    args = parser.parse_args()
+
+    if Image is None:
+        raise SystemExit("Pillow is required: pip install pillow")
+
+    with app.app_context():
+        print(f"Generated variants for {regenerate_all(args.missing_only)} covers.")
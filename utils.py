@@ -1,76 +1,149 @@
-import os
-import uuid
+import base64
+import binascii
 from datetime import datetime
 from flask import request
-from werkzeug.utils import secure_filename
+from sqlalchemy import tuple_, select
+from sqlalchemy.orm import defer, selectinload
 from app import app, db
-from models import BookAnalytics, ClickEvent
+from models import Book
+from analytics_buffer import analytics_buffer
+from event_filter import event_filter
+import blob_store
 
 def save_file(file, subfolder):
     """
-    Save an uploaded file to the specified subfolder
+    Stage an uploaded file for the specified subfolder; queue
+    jobs.finalize_upload to move it into the blob store.
     Returns the path relative to the static folder
     """
-    filename = secure_filename(file.filename)
-    # Add unique identifier to filename to prevent overwriting
-    unique_filename = f"{uuid.uuid4().hex}_{filename}"
-    
-    # Create subfolder if it doesn't exist
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], subfolder)
-    os.makedirs(upload_path, exist_ok=True)
-    
-    # Save the file
-    file_path = os.path.join(upload_path, unique_filename)
-    file.save(file_path)
-    
-    # Return the path relative to static folder
-    return os.path.join('uploads', subfolder, unique_filename)
+    return blob_store.stage_upload(file, subfolder)
 
 def delete_file(file_path):
     """
-    Delete a file from the file system
+    Release a stored file; shared blobs stay until nothing references them
     """
     try:
-        if file_path and os.path.exists(os.path.join('static', file_path)):
-            os.remove(os.path.join('static', file_path))
-            return True
+        if file_path:
+            return blob_store.release(file_path)
     except Exception as e:
         app.logger.error(f"Error deleting file: {e}")
     return False
 
+def _request_event(book_id, event_type):
+    """Build an analytics event for the current request"""
+    return {
+        'book_id': book_id,
+        'event_type': event_type,
+        # Truncate to the column sizes so one long header can't fail a whole batch
+        'user_agent': request.user_agent.string[:255],
+        # The visitor's own address once ProxyFix has applied X-Forwarded-For (TRUSTED_PROXY_HOPS);
+        # deduplication and unique viewer counts depend on it
+        'ip_address': request.remote_addr,
+        'referrer': request.referrer[:255] if request.referrer else None,
+        'timestamp': datetime.utcnow()
+    }
+
 def increment_analytics(book_id, event_type):
     """
-    Increment analytics counters for a book and record click event
+    Queue an analytics event for a book unless it's from a bot or a repeat;
+    counters and the click event are written by the background flusher in
+    analytics_buffer
     """
     try:
-        # Get or create analytics record
-        analytics = BookAnalytics.query.filter_by(book_id=book_id).first()
-        if not analytics:
-            analytics = BookAnalytics(book_id=book_id)
-            db.session.add(analytics)
-        
-        # Update the appropriate counter
-        if event_type == 'view':
-            analytics.view_count += 1
-        elif event_type == 'download':
-            analytics.download_count += 1
-        elif event_type == 'share':
-            analytics.share_count += 1
-        
-        # Record the click event
-        click_event = ClickEvent(
-            book_id=book_id,
-            event_type=event_type,
-            user_agent=request.user_agent.string,
-            ip_address=request.remote_addr,
-            referrer=request.referrer
-        )
-        db.session.add(click_event)
-        
-        # Commit changes
-        db.session.commit()
-        return True
+        event = _request_event(book_id, event_type)
+        # Bots and repeated hits are accepted but not recorded
+        if not event_filter.accept(event):
+            return True
+        return analytics_buffer.record(event)
     except Exception as e:
         app.logger.error(f"Error recording analytics: {e}")
-        db.session.rollback()
         return False
+
+def track_events(items):
+    """
+    Validate and queue a batch of {book_id, event_type} dicts posted by a
+    client. All referenced books are checked with one query and the accepted
+    events are written in a single transaction. Returns one result dict per
+    item with a status of 'recorded', 'ignored' (bot, repeat or shed) or
+    'rejected' with an error.
+    """
+    allowed_types = app.config['TRACK_EVENT_TYPES']
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        book_id = item.get('book_id') if isinstance(item, dict) else None
+        event_type = item.get('event_type') if isinstance(item, dict) else None
+        if isinstance(book_id, str) and book_id.isdigit():
+            book_id = int(book_id)
+        if not isinstance(book_id, int) or isinstance(book_id, bool) or not event_type:
+            results.append({'index': index, 'status': 'rejected', 'error': 'Missing required parameters'})
+        elif not isinstance(event_type, str) or event_type not in allowed_types:
+            results.append({'index': index, 'status': 'rejected', 'error': 'Invalid event type'})
+        else:
+            results.append({'index': index, 'status': 'recorded'})
+            valid.append((index, book_id, event_type))
+
+    book_ids = {book_id for _, book_id, _ in valid}
+    existing = set(db.session.scalars(select(Book.id).where(Book.id.in_(book_ids)))) if book_ids else set()
+
+    queued = []
+    for index, book_id, event_type in valid:
+        if book_id not in existing:
+            results[index] = {'index': index, 'status': 'rejected', 'error': 'Book not found'}
+            continue
+        event = _request_event(book_id, event_type)
+        if not event_filter.accept(event):
+            results[index]['status'] = 'ignored'
+            continue
+        queued.append((index, event))
+
+    outcomes = analytics_buffer.record_many([event for _, event in queued])
+    for (index, _), outcome in zip(queued, outcomes):
+        if outcome == 'shed':
+            results[index]['status'] = 'ignored'
+        elif outcome == 'dropped':
+            results[index] = {'index': index, 'status': 'rejected', 'error': 'Failed to record event'}
+    return results
+
+def encode_cursor(book):
+    """
+    Encode a book's position in the catalogue as an opaque cursor string
+    """
+    raw = f"{book.created_at.isoformat()}|{book.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor into (created_at, id); raises ValueError if it's malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, book_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(book_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def get_book_page(cursor=None, per_page=None, with_description=False, with_analytics=True):
+    """
+    Return one page of books, newest first, and the cursor for the next page.
+    Uses keyset pagination on (created_at, id) so deep pages cost the same
+    as the first one. The description column is skipped unless requested,
+    and the analytics rows are loaded in one extra query for the whole page.
+    """
+    per_page = per_page or app.config['BOOKS_PER_PAGE']
+    query = Book.query.order_by(Book.created_at.desc(), Book.id.desc())
+    
+    if with_analytics:
+        query = query.options(selectinload(Book.analytics))
+    
+    if not with_description:
+        query = query.options(defer(Book.description))
+    
+    if cursor:
+        created_at, book_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Book.created_at, Book.id) < tuple_(created_at, book_id))
+    
+    # Fetch one extra row to know whether there is a next page
+    books = query.limit(per_page + 1).all()
+    next_cursor = encode_cursor(books[per_page - 1]) if len(books) > per_page else None
+    return books[:per_page], next_cursor